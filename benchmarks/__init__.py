@@ -0,0 +1 @@
+"""Benchmarks scripts, to be run with python -m benchmarks.<name>"""
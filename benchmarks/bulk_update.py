@@ -0,0 +1,105 @@
+"""Compare bulk writes with statement level versioning triggers (current)
+and with the previous row level ones
+
+The row level trigger checking versions and setting last_edit is still there
+(see 006-statement-level-versioning): its cost is measured by dropping it.
+
+Everything runs in transactions which are rolled back,
+but they lock folksonomy table: do not use on a production database::
+
+    python -m benchmarks.bulk_update --rows 100000
+
+Medians of 5 runs with 100,000 rows here (product documents, statistics
+and indexes maintenance take most of the time)::
+
+    triggers                      insert      update
+    row triggers                 10794ms     11689ms
+    statement triggers            9780ms     10393ms
+    no timestamp trigger          8752ms      9802ms
+"""
+
+import argparse
+import asyncio
+import time
+
+from folksonomy import db
+
+BENCH_KEY = "bench_bulk"
+
+# versioning triggers as they were before 006-statement-level-versioning
+# (with columns listed, as folksonomy now has computed ones)
+ROW_LEVEL_TRIGGERS = """
+DROP TRIGGER folksonomy_insert_versionning ON folksonomy;
+DROP TRIGGER folksonomy_update_versionning ON folksonomy;
+DROP TRIGGER folksonomy_delete_versionning ON folksonomy;
+CREATE FUNCTION pg_temp.folksonomy_archive() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO folksonomy_versions (product, k, v, owner, version, editor, last_edit, comment)
+        VALUES (
+            NEW.product, NEW.k, NEW.v, NEW.owner, NEW.version, NEW.editor, NEW.last_edit,
+            NEW.comment
+        );
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER folksonomy_versionning AFTER INSERT OR UPDATE on folksonomy
+    FOR EACH ROW EXECUTE FUNCTION pg_temp.folksonomy_archive();
+"""
+
+# cost left to the row level trigger checking versions and setting last_edit
+# (only to measure it: versions are not checked, and last_edit stays NULL)
+WITHOUT_TIMESTAMP_TRIGGER = "DROP TRIGGER folksonomy_autotimestamp ON folksonomy"
+
+STATEMENTS = {
+    "insert": f"""
+        INSERT INTO folksonomy (product, k, v, owner, version, editor, comment)
+        SELECT lpad(i::text, 13, '0'), '{BENCH_KEY}', 'v', '', 1, 'bench', ''
+        FROM generate_series(1, %s) AS i
+    """,
+    "update": f"""
+        UPDATE folksonomy SET v = 'v2', version = version + 1
+        WHERE owner = '' AND k = '{BENCH_KEY}'
+    """,
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+async def run(rows, setup=None):
+    timings = {}
+    try:
+        async with db.transaction():
+            if setup:
+                await db.db_exec(setup)
+            for name, statement in STATEMENTS.items():
+                start = time.monotonic()
+                await db.db_exec(statement, (rows,) if "%s" in statement else ())
+                timings[name] = time.monotonic() - start
+            raise Rollback()
+    except Rollback:
+        pass
+    return timings
+
+
+async def main(rows):
+    results = {
+        "row triggers": await run(rows, ROW_LEVEL_TRIGGERS),
+        "statement triggers": await run(rows),
+        "no timestamp trigger": await run(rows, WITHOUT_TIMESTAMP_TRIGGER),
+    }
+    await db.terminate()
+    print(f"{'triggers':<24}" + "".join(f"{name:>12}" for name in STATEMENTS))
+    for triggers, timings in results.items():
+        print(
+            f"{triggers:<24}"
+            + "".join(f"{timings[name] * 1000:>10.0f}ms" for name in STATEMENTS)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows))
@@ -0,0 +1,99 @@
+"""Measure workers cold start: boot time and first requests latency
+
+Each run starts a fresh uvicorn worker, and measures the time until it answers
+a first request, then the latency of first requests to /openapi.json and /docs,
+with the OpenAPI schema generated by the worker, or read from a generated file
+(OPENAPI_FILE). Import time of the API alone is measured too.
+
+It needs a database, configured by POSTGRES_* environment variables::
+
+    python -m benchmarks.cold_start --runs 5
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+IMPORT_TIME = (
+    "import time; start = time.perf_counter(); import folksonomy.api; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=10) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def import_time():
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_TIME], text=True)
+    return float(output)
+
+
+def run(openapi_file):
+    """Start a worker, return its boot time and first requests latencies"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, OPENAPI_FILE=openapi_file)
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "folksonomy.api:app", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                get(url + "/")
+                break
+            except OSError:
+                if worker.poll() is not None:
+                    raise RuntimeError("worker exited, is the database configured?")
+                time.sleep(0.005)
+        boot = time.perf_counter() - start
+        return {
+            "boot": boot,
+            "first /openapi.json": get(url + "/openapi.json"),
+            "next /openapi.json": get(url + "/openapi.json"),
+            "first /docs": get(url + "/docs"),
+        }
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+def main(runs):
+    imports = [import_time() for _ in range(runs)]
+    print(f"{'import folksonomy.api':<32}{statistics.median(imports) * 1000:>10.1f}ms")
+    with tempfile.NamedTemporaryFile(suffix=".json") as schema:
+        subprocess.run(
+            [sys.executable, "generate_openapi_json.py"], stdout=schema, check=True
+        )
+        for name, openapi_file in (("generated", ""), ("from file", schema.name)):
+            results = [run(openapi_file) for _ in range(runs)]
+            print(f"OpenAPI schema {name}:")
+            for measure in results[0]:
+                median = statistics.median(result[measure] for result in results)
+                print(f"  {measure:<30}{median * 1000:>10.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    main(args.runs)
@@ -0,0 +1,139 @@
+"""Compare plans and latency of /products, /products/stats and /values/{k} queries
+with covering indexes (current, see 009-covering-indexes) and with previous ones
+
+Synthetic tags are added (and deleted at the end), on keys starting with bench_cover,
+for public tags and for the private owner bench_cover.
+Previous indexes are used in a transaction which is rolled back,
+but it locks folksonomy table: do not use on a production database::
+
+    python -m benchmarks.covering_indexes --rows 1000000
+"""
+
+import argparse
+import statistics
+
+import psycopg2
+
+from folksonomy import settings
+
+BENCH_KEY = "bench_cover"
+KEYS = 10
+VALUES = 1000
+EDITORS = 100
+
+PREVIOUS_INDEXES = """
+DROP INDEX folksonomy_public_k_v_product_idx;
+DROP INDEX folksonomy_private_owner_k_v_product_idx;
+CREATE INDEX folksonomy_public_k_v_idx ON folksonomy_public (k, v);
+CREATE INDEX folksonomy_private_owner_k_v_idx ON folksonomy_private (owner, k, v);
+ANALYZE folksonomy_public, folksonomy_private;
+"""
+
+QUERIES = {
+    "/products?k=&v=": """
+        SELECT product, k, v FROM folksonomy WHERE owner = %s AND k = %s AND v = %s
+    """,
+    "/products/stats?k=": """
+        SELECT product, count(*), max(last_edit), count(distinct(editor))
+        FROM folksonomy WHERE owner = %s AND k = %s
+        GROUP BY product
+    """,
+    "/values/{k}": """
+        SELECT v, count(*) FROM folksonomy WHERE owner = %s AND k = %s
+        GROUP BY v ORDER BY count(*) DESC LIMIT 50
+    """,
+}
+
+
+def connect():
+    conn = psycopg2.connect(
+        dbname=settings.POSTGRES_DATABASE,
+        user=settings.POSTGRES_USER,
+        password=settings.POSTGRES_PASSWORD,
+        host=settings.POSTGRES_HOST,
+    )
+    conn.autocommit = True
+    return conn
+
+
+def add_tags(cur, rows):
+    for owner in ("", BENCH_KEY):
+        cur.execute(
+            f"""
+            INSERT INTO folksonomy (product, k, v, owner, version, editor, comment)
+            SELECT
+                lpad((i / {KEYS})::text, 13, '0'), '{BENCH_KEY}_' || mod(i, {KEYS}),
+                'value ' || mod(i * 7, {VALUES}), %s, 1, 'editor' || mod(i, {EDITORS}),
+                ''
+            FROM generate_series(0, %s - 1) AS i
+            """,
+            (owner, rows),
+        )
+    # index only scans need an up to date visibility map
+    cur.execute("VACUUM ANALYZE folksonomy_public, folksonomy_private")
+
+
+def delete_tags(cur):
+    for table in ("folksonomy", "folksonomy_versions"):
+        cur.execute(f"DELETE FROM {table} WHERE k LIKE '{BENCH_KEY}%'")
+
+
+def scans(plan):
+    """Scan nodes of a plan, with their heap fetches if any"""
+    node = plan["Node Type"]
+    if "Scan" in node:
+        fetches = plan.get("Heap Fetches")
+        yield node if fetches is None else f"{node} ({fetches} heap fetches)"
+    for child in plan.get("Plans", []):
+        yield from scans(child)
+
+
+def measure(cur, repeat):
+    results = {}
+    for owner in ("", BENCH_KEY):
+        for name, query in QUERIES.items():
+            params = (owner, BENCH_KEY + "_1", "value 427")[: query.count("%s")]
+            timings = []
+            for _ in range(repeat):
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+                explain = cur.fetchone()[0][0]
+                timings.append(explain["Execution Time"])
+            plan = explain["Plan"]
+            buffers = plan["Shared Hit Blocks"] + plan["Shared Read Blocks"]
+            results[(owner or "public", name)] = (
+                statistics.median(timings),
+                buffers,
+                sorted(set(scans(plan))),
+            )
+    return results
+
+
+def main(rows, repeat):
+    conn = connect()
+    cur = conn.cursor()
+    delete_tags(cur)
+    add_tags(cur, rows)
+    try:
+        cur.execute("BEGIN")
+        cur.execute(PREVIOUS_INDEXES)
+        results = {"previous indexes": measure(cur, repeat)}
+        cur.execute("ROLLBACK")
+        results["covering indexes"] = measure(cur, repeat)
+    finally:
+        delete_tags(cur)
+        conn.close()
+    for indexes, measures in results.items():
+        print(f"\n{indexes}")
+        print(f"{'owner':<13}{'query':<20}{'median':>10}{'buffers':>9}  scans")
+        for (owner, name), (timing, buffers, nodes) in measures.items():
+            print(
+                f"{owner:<13}{name:<20}{timing:>8.2f}ms{buffers:>9}  {', '.join(nodes)}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
@@ -0,0 +1,104 @@
+"""Compare database backends side by side on queries typical of the API
+
+Each iteration runs in its own transaction, as a request would.
+Use a database with some data, but not a production one
+(it creates and deletes tags on product 0000000000000)::
+
+    python -m benchmarks.db_backends --iterations 2000 --concurrency 10
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import time
+
+from folksonomy import db, models, settings
+
+BENCH_PRODUCT = "0000000000000"
+
+
+async def ping():
+    cur, _ = await db.db_exec("SELECT current_timestamp AT TIME ZONE 'GMT'", ())
+    await cur.fetchone()
+
+
+async def product_tags():
+    cur, _ = await db.db_exec(
+        """
+        SELECT json_agg(j)::json FROM (
+            SELECT * FROM folksonomy
+            WHERE product = %s AND owner = %s
+            ORDER BY k
+        ) as j;
+        """,
+        (BENCH_PRODUCT, ""),
+    )
+    await cur.fetchone()
+
+
+async def values_by_key():
+    cur, _ = await db.db_exec(
+        """
+        SELECT product, k, v FROM folksonomy
+        WHERE owner = %s AND k = %s
+        LIMIT 100
+        """,
+        ("", "bench"),
+    )
+    await cur.fetchall()
+
+
+async def write_tag():
+    tag = models.ProductTag(product=BENCH_PRODUCT, k="bench", v="1", editor="bench")
+    await db.db_exec(*db.create_product_tag_req(tag))
+    tag.version, tag.v = 2, "2"
+    await db.db_exec(*db.update_product_tag_req(tag))
+    await db.db_exec(
+        "DELETE FROM folksonomy WHERE product = %s AND owner = %s AND k = %s",
+        (BENCH_PRODUCT, "", "bench"),
+    )
+
+
+SCENARIOS = [ping, product_tags, values_by_key, write_tag]
+
+
+async def run(scenario, iterations, concurrency):
+    async def worker(n):
+        for _ in range(n):
+            async with db.transaction():
+                await scenario()
+
+    # warm up pool and statement caches
+    await worker(concurrency)
+    start = time.monotonic()
+    await asyncio.gather(
+        *(worker(iterations // concurrency) for _ in range(concurrency))
+    )
+    return time.monotonic() - start
+
+
+async def main(backends, iterations, concurrency):
+    print(f"{'scenario':<16}" + "".join(f"{name:>16}" for name in backends))
+    results = {}
+    for name in backends:
+        settings.DB_BACKEND = name
+        for scenario in SCENARIOS:
+            results[name, scenario.__name__] = await run(
+                scenario, iterations, concurrency
+            )
+        await db.terminate()
+    for scenario in SCENARIOS:
+        line = f"{scenario.__name__:<16}"
+        for name in backends:
+            elapsed = results[name, scenario.__name__]
+            line += f"{iterations / elapsed:>11.0f} tx/s"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    backends = [name for name in ("aiopg", "asyncpg") if importlib.util.find_spec(name)]
+    asyncio.run(main(backends, args.iterations, args.concurrency))
@@ -0,0 +1,74 @@
+"""Compare size and encoding time of response formats for lists of rows
+
+Rows are generated, shaped like /values results (no database needed)::
+
+    python -m benchmarks.formats --rows 10000
+"""
+
+import argparse
+import datetime
+import gzip
+import time
+
+from fastapi.responses import JSONResponse
+
+from folksonomy import formats
+
+COLUMNS = ("product", "k", "v", "owner", "version", "editor", "last_edit")
+
+
+def sample_rows(count):
+    now = datetime.datetime(2025, 1, 1, 12, 0, 0, 123456)
+    return [
+        (
+            "%013d" % (3700000000000 + i),
+            ("color", "size", "packaging:material")[i % 3],
+            "value %d" % (i % 50),
+            "",
+            1 + i % 3,
+            "editor%d" % (i % 20),
+            now,
+        )
+        for i in range(count)
+    ]
+
+
+def encode_objects(rows):
+    # what the default JSON path does with rows decoded from json_agg
+    content = [dict(zip(COLUMNS, row[:-1] + (row[-1].isoformat(),))) for row in rows]
+    return JSONResponse(content=content).body
+
+
+def encoders():
+    yield "json objects", encode_objects
+    for media_type in (formats.COLUMNAR_JSON, formats.MSGPACK):
+        if media_type == formats.MSGPACK and formats.msgpack is None:
+            continue
+        yield (
+            media_type,
+            lambda rows, media_type=media_type: formats.encode_columns(
+                formats.to_columns(COLUMNS, rows), media_type
+            ),
+        )
+
+
+def main(count, repeat):
+    rows = sample_rows(count)
+    print(f"{'format':<42}{'bytes':>10}{'gzipped':>10}{'encode':>12}")
+    for name, encode in encoders():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            body = encode(rows)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(
+            f"{name:<42}{len(body):>10}{len(gzip.compress(body)):>10}"
+            f"{elapsed * 1000:>10.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
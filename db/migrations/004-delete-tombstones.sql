@@ -0,0 +1,20 @@
+-- Archive deletions with a DELETE trigger, so that a tag is deleted in one statement
+-- depends: 003-add-user-roles
+
+-- a deletion is archived as a version 0, with comment DELETE,
+-- the deleting user is taken from folksonomy.editor setting
+-- (set by the DELETE statement), defaulting to the last editor
+CREATE OR REPLACE FUNCTION folksonomy_archive_delete() RETURNS trigger AS $folksonomy_archive_delete$
+    BEGIN
+        INSERT INTO folksonomy_versions (product, k, v, owner, version, editor, last_edit, comment)
+        VALUES (
+            OLD.product, OLD.k, OLD.v, OLD.owner, 0,
+            coalesce(nullif(current_setting('folksonomy.editor', true), ''), OLD.editor),
+            current_timestamp AT TIME ZONE 'GMT',
+            'DELETE'
+        );
+        RETURN NULL;
+    END;
+$folksonomy_archive_delete$ LANGUAGE plpgsql;
+CREATE TRIGGER folksonomy_delete_versionning AFTER DELETE on folksonomy
+    FOR EACH ROW EXECUTE FUNCTION folksonomy_archive_delete();
@@ -0,0 +1,19 @@
+-- Background jobs for admin bulk operations
+-- depends: 004-delete-tombstones
+
+-- status is one of pending, running, paused, cancelled, failed, done
+CREATE TABLE folksonomy_jobs (
+    id          serial        PRIMARY KEY,
+    kind        varchar       NOT NULL,
+    params      jsonb         NOT NULL,
+    status      varchar       NOT NULL DEFAULT 'pending',
+    editor      varchar       NOT NULL,
+    total       integer       NOT NULL DEFAULT 0,
+    processed   integer       NOT NULL DEFAULT 0,
+    error       varchar,
+    created     timestamp     NOT NULL DEFAULT (current_timestamp AT TIME ZONE 'GMT'),
+    updated     timestamp     NOT NULL DEFAULT (current_timestamp AT TIME ZONE 'GMT')
+);
+
+-- for workers to find jobs to run
+CREATE INDEX ON folksonomy_jobs (id) WHERE status IN ('pending', 'running');
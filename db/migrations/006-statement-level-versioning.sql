@@ -0,0 +1,50 @@
+-- Archive versions with statement level triggers, using transition tables
+-- depends: 005-jobs
+
+-- one set based INSERT per statement, instead of one per row
+-- (folksonomy_timestamp row trigger still checks versions and sets last_edit:
+-- a PL/pgSQL call per row, about 1s for 100,000 rows inserted, 0.6s updated,
+-- see benchmarks/bulk_update.py. Old and new rows of an update can't be matched
+-- in transition tables when keys change, as for property renames, so versions
+-- can't be checked by statement triggers)
+CREATE OR REPLACE FUNCTION folksonomy_archive_rows() RETURNS trigger AS $folksonomy_archive_rows$
+    BEGIN
+        INSERT INTO folksonomy_versions (product, k, v, owner, version, editor, last_edit, comment)
+        SELECT product, k, v, owner, version, editor, last_edit, comment
+        FROM new_rows;
+        RETURN NULL;
+    END;
+$folksonomy_archive_rows$ LANGUAGE plpgsql;
+
+-- deletions are archived as a version 0, see 004-delete-tombstones
+-- folksonomy.editor is reset once used: it is set for the whole transaction,
+-- but only applies to the statement which set it
+CREATE OR REPLACE FUNCTION folksonomy_archive_deleted_rows() RETURNS trigger AS $folksonomy_archive_deleted_rows$
+    BEGIN
+        INSERT INTO folksonomy_versions (product, k, v, owner, version, editor, last_edit, comment)
+        SELECT
+            product, k, v, owner, 0,
+            coalesce(nullif(current_setting('folksonomy.editor', true), ''), editor),
+            current_timestamp AT TIME ZONE 'GMT',
+            'DELETE'
+        FROM old_rows;
+        PERFORM set_config('folksonomy.editor', '', true);
+        RETURN NULL;
+    END;
+$folksonomy_archive_deleted_rows$ LANGUAGE plpgsql;
+
+DROP TRIGGER folksonomy_versionning ON folksonomy;
+DROP TRIGGER folksonomy_delete_versionning ON folksonomy;
+DROP FUNCTION folksonomy_archive();
+DROP FUNCTION folksonomy_archive_delete();
+
+-- transition tables need one trigger per event
+CREATE TRIGGER folksonomy_insert_versionning AFTER INSERT ON folksonomy
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_archive_rows();
+CREATE TRIGGER folksonomy_update_versionning AFTER UPDATE ON folksonomy
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_archive_rows();
+CREATE TRIGGER folksonomy_delete_versionning AFTER DELETE ON folksonomy
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_archive_deleted_rows();
@@ -0,0 +1,23 @@
+-- Store hashed tokens with an expiry, and index auth on user_id
+-- depends: 006-statement-level-versioning
+
+ALTER TABLE auth ADD COLUMN token_hash bytea;
+ALTER TABLE auth ADD COLUMN expires_at timestamp;
+
+DELETE FROM auth WHERE token IS NULL;
+UPDATE auth SET
+    token_hash = sha256(convert_to(token, 'UTF8')),
+    expires_at = coalesce(last_use, current_timestamp AT TIME ZONE 'GMT') + interval '30 days';
+-- a token should only be there once
+DELETE FROM auth AS a USING auth AS b
+WHERE a.token_hash = b.token_hash AND a.ctid < b.ctid;
+
+ALTER TABLE auth ALTER COLUMN token_hash SET NOT NULL;
+ALTER TABLE auth ALTER COLUMN expires_at SET NOT NULL;
+ALTER TABLE auth DROP COLUMN token;
+
+CREATE UNIQUE INDEX auth_token_hash_idx ON auth (token_hash);
+CREATE INDEX auth_user_id_idx ON auth (user_id);
+-- expires_at is not indexed, so that updating it on use is a HOT update
+-- (the table stays small, the purge scanning it now and then is cheap)
+ALTER TABLE auth SET (fillfactor = 80);
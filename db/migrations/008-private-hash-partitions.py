@@ -0,0 +1,142 @@
+"""
+Hash sub-partition private tags by owner
+
+folksonomy_private becomes a partitioned table, with FOLKSONOMY_PRIVATE_PARTITIONS
+(default 8) hash partitions on owner, so that per owner queries only use one
+of them, and each is vacuumed on its own.
+
+Data is moved online: a new partitioned table is kept in sync with the current one
+by a trigger, while existing rows are copied by batches,
+then tables are swapped in a short transaction.
+"""
+
+import contextlib
+import os
+
+from yoyo import step
+
+__depends__ = {"007-auth-token-hash"}
+__transactional__ = False
+
+PARTITIONS = int(os.environ.get("FOLKSONOMY_PRIVATE_PARTITIONS", 8))
+BATCH_SIZE = 10000
+
+MIRROR_FUNCTION = """
+CREATE FUNCTION folksonomy_private_mirror() RETURNS trigger AS $folksonomy_private_mirror$
+    BEGIN
+        IF (TG_OP IN ('UPDATE', 'DELETE')) THEN
+            DELETE FROM folksonomy_private_hash
+            WHERE product = OLD.product AND owner = OLD.owner AND k = OLD.k;
+        END IF;
+        IF (TG_OP IN ('INSERT', 'UPDATE')) THEN
+            INSERT INTO folksonomy_private_hash SELECT NEW.*;
+        END IF;
+        RETURN NULL;
+    END;
+$folksonomy_private_mirror$ LANGUAGE plpgsql
+"""
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Explicit transaction, as the connection is in autocommit mode"""
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        yield cur
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+
+def create_hash_partitions(conn):
+    with transaction(conn) as cur:
+        # the check constraint spares a scan when attaching it as default partition
+        cur.execute(
+            """
+            CREATE TABLE folksonomy_private_hash (LIKE folksonomy, CHECK (owner <> ''))
+            PARTITION BY HASH (owner)
+            """
+        )
+        for i in range(PARTITIONS):
+            cur.execute(
+                f"""
+                CREATE TABLE folksonomy_private_{i} PARTITION OF folksonomy_private_hash
+                FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {i})
+                """
+            )
+        cur.execute(
+            "CREATE UNIQUE INDEX folksonomy_private_hash_product_owner_k_idx "
+            "ON folksonomy_private_hash (product, owner, k)"
+        )
+        cur.execute(
+            "CREATE INDEX folksonomy_private_hash_owner_k_v_idx "
+            "ON folksonomy_private_hash (owner, k, v)"
+        )
+        # from now on, changes are mirrored to the new table
+        cur.execute(MIRROR_FUNCTION)
+        cur.execute(
+            """
+            CREATE TRIGGER folksonomy_private_mirror
+                AFTER INSERT OR UPDATE OR DELETE ON folksonomy_private
+                FOR EACH ROW EXECUTE FUNCTION folksonomy_private_mirror()
+            """
+        )
+
+
+def copy_rows(conn):
+    """Copy existing rows, a batch per transaction, following the unique index
+
+    Rows are locked while being copied, so that their changes are mirrored after.
+    """
+    last = None
+    while True:
+        after = "WHERE (product, owner, k) > (%s, %s, %s)" if last else ""
+        with transaction(conn) as cur:
+            cur.execute(
+                f"""
+                WITH batch AS (
+                    SELECT * FROM folksonomy_private {after}
+                    ORDER BY product, owner, k
+                    LIMIT %s
+                    FOR SHARE
+                ),
+                copied AS (
+                    INSERT INTO folksonomy_private_hash SELECT * FROM batch
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT product, owner, k FROM batch
+                ORDER BY product DESC, owner DESC, k DESC
+                LIMIT 1
+                """,
+                (*(last or ()), BATCH_SIZE),
+            )
+            last = cur.fetchone()
+        if last is None:
+            return
+
+
+def swap_tables(conn):
+    with transaction(conn) as cur:
+        cur.execute("LOCK TABLE folksonomy IN ACCESS EXCLUSIVE MODE")
+        cur.execute("ALTER TABLE folksonomy DETACH PARTITION folksonomy_private")
+        cur.execute("DROP TABLE folksonomy_private")
+        cur.execute("DROP FUNCTION folksonomy_private_mirror()")
+        cur.execute("ALTER TABLE folksonomy_private_hash RENAME TO folksonomy_private")
+        for index in ("product_owner_k_idx", "owner_k_v_idx"):
+            cur.execute(
+                f"ALTER INDEX folksonomy_private_hash_{index} "
+                f"RENAME TO folksonomy_private_{index}"
+            )
+        cur.execute(
+            "ALTER TABLE folksonomy ATTACH PARTITION folksonomy_private DEFAULT"
+        )
+    conn.cursor().execute("ANALYZE folksonomy_private")
+
+
+steps = [
+    step(create_hash_partitions),
+    step(copy_rows),
+    step(swap_tables),
+]
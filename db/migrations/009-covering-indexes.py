@@ -0,0 +1,81 @@
+"""
+Covering indexes for properties and values queries
+
+(k, v) on public tags and (owner, k, v) on private ones are replaced by indexes
+having product as last key, and including editor and last_edit,
+so that /products, /products/stats and /values/{k} use index only scans.
+
+Indexes are built concurrently, not to block writes: as it is not possible
+on a partitioned table, the private one is created on the parent only,
+then on each of its partitions, which are attached to it.
+A failed concurrent build leaves an invalid index: indexes are dropped first,
+so that the migration can be run again.
+"""
+
+from yoyo import step
+
+__depends__ = {"008-private-hash-partitions"}
+__transactional__ = False
+
+INCLUDE = "INCLUDE (editor, last_edit)"
+
+
+def create_public_index(conn):
+    cur = conn.cursor()
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS folksonomy_public_k_v_product_idx")
+    # owner is always '', but queries filter on it, so it must be in the index
+    cur.execute(
+        """
+        CREATE INDEX CONCURRENTLY folksonomy_public_k_v_product_idx
+        ON folksonomy_public (k, v, product) INCLUDE (owner, editor, last_edit)
+        """
+    )
+
+
+def create_private_index(conn):
+    cur = conn.cursor()
+    # also drops indexes of partitions already attached to it
+    cur.execute("DROP INDEX IF EXISTS folksonomy_private_owner_k_v_product_idx")
+    # invalid until all partitions indexes are attached
+    cur.execute(
+        f"""
+        CREATE INDEX folksonomy_private_owner_k_v_product_idx
+        ON ONLY folksonomy_private (owner, k, v, product) {INCLUDE}
+        """
+    )
+    cur.execute(
+        """
+        SELECT relid::text FROM pg_partition_tree('folksonomy_private')
+        WHERE isleaf ORDER BY relid::text
+        """
+    )
+    for (partition,) in cur.fetchall():
+        cur.execute(
+            f"DROP INDEX CONCURRENTLY IF EXISTS {partition}_owner_k_v_product_idx"
+        )
+        cur.execute(
+            f"""
+            CREATE INDEX CONCURRENTLY {partition}_owner_k_v_product_idx
+            ON {partition} (owner, k, v, product) {INCLUDE}
+            """
+        )
+        cur.execute(
+            f"""
+            ALTER INDEX folksonomy_private_owner_k_v_product_idx
+            ATTACH PARTITION {partition}_owner_k_v_product_idx
+            """
+        )
+
+
+def drop_previous_indexes(conn):
+    cur = conn.cursor()
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS folksonomy_public_k_v_idx")
+    # partitioned indexes can't be dropped concurrently, but this is quick
+    cur.execute("DROP INDEX IF EXISTS folksonomy_private_owner_k_v_idx")
+
+
+steps = [
+    step(create_public_index),
+    step(create_private_index),
+    step(drop_previous_indexes),
+]
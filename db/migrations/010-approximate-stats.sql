@@ -0,0 +1,69 @@
+-- Statistics of keys and products, with HyperLogLog sketches, for approximate counts
+-- depends: 009-covering-indexes
+
+-- changes of tags (1 for added tags, -1 for removed ones),
+-- merged by batches into stats tables by API workers (see folksonomy/stats.py)
+CREATE TABLE folksonomy_stats_log (
+    id          bigserial     PRIMARY KEY,
+    product     varchar(24)   NOT NULL,
+    k           varchar       NOT NULL,
+    v           varchar       NOT NULL,
+    owner       varchar       NOT NULL,
+    editor      varchar       NOT NULL,
+    last_edit   timestamp,
+    delta       smallint      NOT NULL
+);
+
+-- tags count, last edit, and a sketch of distinct values, by key
+-- removed is the number of removals since the sketch was (re)built,
+-- as it can't forget values
+CREATE TABLE folksonomy_key_stats (
+    owner       varchar       NOT NULL,
+    k           varchar       NOT NULL,
+    tags        integer       NOT NULL,
+    last_edit   timestamp,
+    sketch      bytea         NOT NULL,
+    estimate    integer       NOT NULL,
+    removed     integer       NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner, k)
+);
+
+-- same by product, with a sketch of distinct editors
+CREATE TABLE folksonomy_product_stats (
+    owner       varchar       NOT NULL,
+    product     varchar(24)   NOT NULL,
+    tags        integer       NOT NULL,
+    last_edit   timestamp,
+    sketch      bytea         NOT NULL,
+    estimate    integer       NOT NULL,
+    removed     integer       NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner, product)
+);
+
+CREATE OR REPLACE FUNCTION folksonomy_log_stats() RETURNS trigger AS $folksonomy_log_stats$
+    BEGIN
+        IF (TG_OP IN ('UPDATE', 'DELETE')) THEN
+            INSERT INTO folksonomy_stats_log (product, k, v, owner, editor, last_edit, delta)
+            SELECT product, k, v, owner, editor, last_edit, -1 FROM old_rows;
+        END IF;
+        IF (TG_OP IN ('INSERT', 'UPDATE')) THEN
+            INSERT INTO folksonomy_stats_log (product, k, v, owner, editor, last_edit, delta)
+            SELECT product, k, v, owner, editor, last_edit, 1 FROM new_rows;
+        END IF;
+        RETURN NULL;
+    END;
+$folksonomy_log_stats$ LANGUAGE plpgsql;
+
+CREATE TRIGGER folksonomy_insert_stats AFTER INSERT ON folksonomy
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_log_stats();
+CREATE TRIGGER folksonomy_update_stats AFTER UPDATE ON folksonomy
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_log_stats();
+CREATE TRIGGER folksonomy_delete_stats AFTER DELETE ON folksonomy
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_log_stats();
+
+-- existing tags are merged like new ones
+INSERT INTO folksonomy_stats_log (product, k, v, owner, editor, last_edit, delta)
+SELECT product, k, v, owner, editor, last_edit, 1 FROM folksonomy;
@@ -0,0 +1,23 @@
+-- Numeric values, for range queries and sorting on /products
+-- depends: 010-approximate-stats
+
+-- values looking like numbers (without NaN or infinity), as numeric, else NULL
+-- the exponent is limited so that casting can't overflow
+-- (adding a stored column rewrites the table)
+ALTER TABLE folksonomy ADD COLUMN v_num numeric GENERATED ALWAYS AS (
+    CASE
+        WHEN v ~ '^[-+]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]{1,3})?$'
+        THEN v::numeric
+    END
+) STORED;
+
+-- partial indexes, for index only range scans (and sorts) on numeric values of a key
+-- owner is always '' in public tags, but queries filter on it (see 009-covering-indexes)
+CREATE INDEX folksonomy_public_k_v_num_idx
+    ON folksonomy_public (k, v_num, product) INCLUDE (owner, v)
+    WHERE v_num IS NOT NULL;
+CREATE INDEX folksonomy_private_owner_k_v_num_idx
+    ON folksonomy_private (owner, k, v_num, product) INCLUDE (v)
+    WHERE v_num IS NOT NULL;
+
+ANALYZE folksonomy;
@@ -0,0 +1,18 @@
+-- Full-text search on values, for /search
+-- depends: 011-numeric-values
+
+-- words of values as is ('simple'), and stemmed in the main languages of products,
+-- so that one index serves searches in any of them (see SEARCH_LANGUAGES in api.py)
+-- (adding a stored column rewrites the table)
+ALTER TABLE folksonomy ADD COLUMN v_tsv tsvector GENERATED ALWAYS AS (
+    to_tsvector('simple', v)
+    || to_tsvector('english', v)
+    || to_tsvector('french', v)
+    || to_tsvector('german', v)
+    || to_tsvector('italian', v)
+    || to_tsvector('spanish', v)
+) STORED;
+
+CREATE INDEX folksonomy_v_tsv_idx ON folksonomy USING gin (v_tsv);
+
+ANALYZE folksonomy;
@@ -0,0 +1,13 @@
+-- Outcome of asynchronous writes (POST /product?async=1), see folksonomy/writes.py
+-- depends: 012-full-text-search
+
+-- status is one of created, conflict, failed
+-- tickets are deleted after ASYNC_TICKET_LIFETIME
+CREATE TABLE folksonomy_write_tickets (
+    ticket      uuid          PRIMARY KEY,
+    status      varchar       NOT NULL,
+    error       varchar,
+    created     timestamp     NOT NULL DEFAULT (current_timestamp AT TIME ZONE 'GMT')
+);
+
+CREATE INDEX ON folksonomy_write_tickets (created);
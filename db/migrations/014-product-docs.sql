@@ -0,0 +1,97 @@
+-- JSON documents of products tags, ready to serve by /product/{product}
+-- depends: 013-write-tickets
+
+-- doc is the JSON array of tags of the product, sorted by key,
+-- with the columns of TAG_COLUMNS in api.py
+CREATE TABLE folksonomy_product_docs (
+    product     varchar(24)   NOT NULL,
+    owner       varchar       NOT NULL,
+    doc         text          NOT NULL,
+    PRIMARY KEY (product, owner)
+);
+
+CREATE OR REPLACE FUNCTION folksonomy_product_doc(product varchar, owner varchar)
+RETURNS text AS $$
+    SELECT json_agg(j ORDER BY j.k)::text FROM (
+        SELECT f.product, f.k, f.v, f.owner, f.version, f.editor, f.last_edit, f.comment
+        FROM folksonomy AS f
+        WHERE f.product = folksonomy_product_doc.product
+            AND f.owner = folksonomy_product_doc.owner
+    ) AS j;
+$$ LANGUAGE sql STABLE;
+
+-- rebuild documents of changed products
+-- changes of the same products are serialized by locking their document rows
+-- (held until commit), taken in a consistent order: placeholders are upserted
+-- for missing documents, and a concurrent transaction deleting a document makes
+-- the upsert insert it anew. The rebuild, in later statements (with a new snapshot),
+-- sees changes of transactions which held them before.
+-- Row locks are not kept in the shared lock table, so a statement can change
+-- any number of products (unlike advisory locks, see max_locks_per_transaction).
+-- Documents are only reached by their primary key (upserts) or ctid, not by joins
+-- whose plans would depend on the number of products (from one to thousands)
+CREATE OR REPLACE FUNCTION folksonomy_refresh_product_docs(products varchar[], owners varchar[])
+RETURNS void AS $$
+    DECLARE
+        empty_docs tid[];
+    BEGIN
+        INSERT INTO folksonomy_product_docs AS d (product, owner, doc)
+        SELECT DISTINCT product, owner, '[]'
+        FROM unnest(products, owners) AS c(product, owner)
+        ORDER BY product, owner
+        ON CONFLICT (product, owner) DO UPDATE SET doc = d.doc;
+        -- products without tags get an empty doc, deleted right after
+        WITH rebuilt AS (
+            INSERT INTO folksonomy_product_docs (product, owner, doc)
+            SELECT product, owner, coalesce(folksonomy_product_doc(product, owner), '')
+            FROM (
+                SELECT DISTINCT product, owner FROM unnest(products, owners) AS c(product, owner)
+            ) AS changed
+            ON CONFLICT (product, owner) DO UPDATE SET doc = excluded.doc
+            RETURNING ctid, doc
+        )
+        SELECT array_agg(ctid) INTO empty_docs FROM rebuilt WHERE doc = '';
+        IF empty_docs IS NOT NULL THEN
+            DELETE FROM folksonomy_product_docs WHERE ctid = ANY(empty_docs);
+        END IF;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION folksonomy_update_product_docs() RETURNS trigger AS $folksonomy_update_product_docs$
+    DECLARE
+        products varchar[];
+        owners varchar[];
+    BEGIN
+        IF (TG_OP = 'INSERT') THEN
+            SELECT array_agg(product), array_agg(owner) INTO products, owners
+            FROM (SELECT DISTINCT product, owner FROM new_rows) AS c;
+        ELSIF (TG_OP = 'UPDATE') THEN
+            SELECT array_agg(product), array_agg(owner) INTO products, owners
+            FROM (
+                SELECT product, owner FROM old_rows
+                UNION SELECT product, owner FROM new_rows
+            ) AS c;
+        ELSE
+            SELECT array_agg(product), array_agg(owner) INTO products, owners
+            FROM (SELECT DISTINCT product, owner FROM old_rows) AS c;
+        END IF;
+        IF products IS NOT NULL THEN
+            PERFORM folksonomy_refresh_product_docs(products, owners);
+        END IF;
+        RETURN NULL;
+    END;
+$folksonomy_update_product_docs$ LANGUAGE plpgsql;
+
+CREATE TRIGGER folksonomy_insert_docs AFTER INSERT ON folksonomy
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_update_product_docs();
+CREATE TRIGGER folksonomy_update_docs AFTER UPDATE ON folksonomy
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_update_product_docs();
+CREATE TRIGGER folksonomy_delete_docs AFTER DELETE ON folksonomy
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION folksonomy_update_product_docs();
+
+INSERT INTO folksonomy_product_docs (product, owner, doc)
+SELECT product, owner, folksonomy_product_doc(product, owner)
+FROM folksonomy GROUP BY product, owner;
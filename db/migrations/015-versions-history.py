@@ -0,0 +1,107 @@
+"""
+Order of versions, and index by product and time, for /product/{product}/history and as_of
+
+Versions archived by the same transaction have the same last_edit: id tells which one
+came last (eg. a deletion after an update).
+
+The column is added without a default, and new versions get ids from a sequence,
+so that the table is not rewritten while writes (which archive versions) wait.
+Existing versions are then numbered by batches of products, in order of last_edit,
+a deletion coming after a version archived at the same time.
+
+Versions of a product are scanned from the most recent one, in the order of history pages,
+or from a point in time. The index is built concurrently, not to block writes
+(see 009-covering-indexes).
+"""
+
+import contextlib
+
+from yoyo import step
+
+__depends__ = {"014-product-docs"}
+__transactional__ = False
+
+BATCH_SIZE = 1000
+"""number of products whose versions are numbered in a transaction"""
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Explicit transaction, as the connection is in autocommit mode"""
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        yield cur
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+
+def add_id(conn):
+    with transaction(conn) as cur:
+        cur.execute("CREATE SEQUENCE folksonomy_versions_id_seq AS bigint")
+        # without a default, existing rows are not rewritten (their id is NULL),
+        # and a default set afterwards only applies to new rows
+        cur.execute("ALTER TABLE folksonomy_versions ADD COLUMN id bigint")
+        cur.execute(
+            """
+            ALTER TABLE folksonomy_versions
+            ALTER COLUMN id SET DEFAULT nextval('folksonomy_versions_id_seq')
+            """
+        )
+        cur.execute(
+            "ALTER SEQUENCE folksonomy_versions_id_seq OWNED BY folksonomy_versions.id"
+        )
+
+
+def number_versions(conn):
+    """Give ids to existing versions, a batch of products per transaction"""
+    last = None
+    while True:
+        after = "WHERE product > %s" if last else ""
+        with transaction(conn) as cur:
+            cur.execute(
+                f"""
+                WITH products AS (
+                    SELECT DISTINCT product FROM folksonomy_versions {after}
+                    ORDER BY product
+                    LIMIT %s
+                ), batch AS (
+                    SELECT ctid AS row_id FROM folksonomy_versions
+                    WHERE product IN (SELECT product FROM products) AND id IS NULL
+                    ORDER BY last_edit, version = 0, version
+                ), numbered AS (
+                    SELECT row_id, nextval('folksonomy_versions_id_seq') AS id FROM batch
+                ), updated AS (
+                    UPDATE folksonomy_versions AS v SET id = numbered.id
+                    FROM numbered WHERE v.ctid = numbered.row_id
+                )
+                SELECT max(product) FROM products
+                """,
+                (*([last] if last else []), BATCH_SIZE),
+            )
+            last = cur.fetchone()[0]
+        if last is None:
+            return
+
+
+def create_index(conn):
+    cur = conn.cursor()
+    # an interrupted build leaves an invalid index behind
+    cur.execute(
+        "DROP INDEX CONCURRENTLY IF EXISTS folksonomy_versions_product_owner_last_edit_idx"
+    )
+    cur.execute(
+        """
+        CREATE INDEX CONCURRENTLY folksonomy_versions_product_owner_last_edit_idx
+        ON folksonomy_versions (product, owner, last_edit DESC, id DESC)
+        """
+    )
+
+
+steps = [
+    step(add_id),
+    step(number_versions),
+    step(create_index),
+]
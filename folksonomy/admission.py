@@ -0,0 +1,186 @@
+"""Admission control and rate limits, applied to requests before they get a connection
+
+Each worker processes at most ADMISSION_MAX_CONCURRENT requests at once, others wait.
+Their expected wait is estimated from the number of waiting requests and the average
+duration of requests: if it is over ADMISSION_WAIT_BUDGET, or if the wait actually
+lasts that long, the request is rejected (503), instead of queuing until proxies time out.
+
+Clients are identified by their token, once it has been checked by a previous request
+(see token_checked), or else by their address, and limited by token buckets: RATE_LIMIT_READ, RATE_LIMIT_WRITE and RATE_LIMIT_ADMIN
+requests per second (with bursts of RATE_LIMIT_BURST seconds of requests)
+for reads, writes, and /admin/ requests. Requests over the limit are rejected (429).
+Both are disabled by default, and limits apply to each worker.
+"""
+
+import asyncio
+import collections
+import contextlib
+import math
+import time
+import weakref
+
+from . import settings
+from . import tokens
+
+DURATION_SMOOTHING = 0.1
+"""weight of the last request in the moving average of requests durations"""
+
+MAX_CLIENTS = 100000
+"""maximum number of token buckets (and checked tokens) kept,
+least recently used ones are dropped"""
+
+CHECKED_TOKEN_LIFETIME = 60
+"""seconds during which a valid token identifies its client, without being checked"""
+
+checked_tokens = collections.OrderedDict()
+"""expiry (monotonic time) of digests of valid tokens"""
+
+limiters = weakref.WeakKeyDictionary()
+"""associate each event loop with its concurrency limiter"""
+
+
+class RejectedError(Exception):
+    """Request refused, to be retried after retry_after seconds"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.duration = 0.0
+        """moving average of requests durations (in seconds)"""
+
+    def expected_wait(self) -> float:
+        if not self.semaphore.locked():
+            return 0.0
+        return (self.waiting + 1) * self.duration / self.limit
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Wait for a free slot, raise RejectedError if it would be too long"""
+        budget = settings.ADMISSION_WAIT_BUDGET
+        expected = self.expected_wait()
+        if expected > budget:
+            raise RejectedError(503, "Server overloaded, try again later", expected)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), budget)
+        except asyncio.TimeoutError:
+            raise RejectedError(503, "Server overloaded, try again later", budget)
+        finally:
+            self.waiting -= 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+            elapsed = time.monotonic() - start
+            self.duration += DURATION_SMOOTHING * (elapsed - self.duration)
+
+
+def get_limiter():
+    """Concurrency limiter of current event loop, None if there is no limit"""
+    limit = settings.ADMISSION_MAX_CONCURRENT
+    if limit <= 0:
+        return None
+    loop = asyncio.get_running_loop()
+    limiter = limiters.get(loop)
+    if limiter is None or limiter.limit != limit:
+        limiter = limiters[loop] = ConcurrencyLimiter(limit)
+    return limiter
+
+
+class RateLimiter:
+    """Token buckets, by kind of request and client"""
+
+    def __init__(self):
+        self.buckets = collections.OrderedDict()
+        """available requests and time of last update, by (kind, client)"""
+
+    def acquire(self, kind: str, client, rate: float):
+        """Take a request from the bucket of client, raise RejectedError if empty"""
+        burst = max(1.0, rate * settings.RATE_LIMIT_BURST)
+        now = time.monotonic()
+        key = (kind, client)
+        available, updated = self.buckets.pop(key, (burst, now))
+        available = min(burst, available + (now - updated) * rate)
+        if available < 1:
+            self.buckets[key] = (available, now)
+            raise RejectedError(429, "Too many requests", (1 - available) / rate)
+        self.buckets[key] = (available - 1, now)
+        while len(self.buckets) > MAX_CLIENTS:
+            self.buckets.popitem(last=False)
+
+    def clear(self):
+        self.buckets.clear()
+
+
+rate_limiter = RateLimiter()
+
+
+def token_checked(token: str):
+    """Record that token is valid, so that it identifies the client of next requests"""
+    digest = tokens.hash_token(token)
+    checked_tokens.pop(digest, None)
+    checked_tokens[digest] = time.monotonic() + CHECKED_TOKEN_LIFETIME
+    while len(checked_tokens) > MAX_CLIENTS:
+        checked_tokens.popitem(last=False)
+
+
+def client_key(request):
+    """Token (digest) of the request if it was checked, else client address
+
+    Unchecked tokens are not trusted, otherwise clients sending a new token
+    with each request would never be limited.
+    """
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token:
+        digest = tokens.hash_token(token)
+        if checked_tokens.get(digest, 0) > time.monotonic():
+            return digest
+    if settings.RATE_LIMIT_IP_HEADER:
+        address = request.headers.get(settings.RATE_LIMIT_IP_HEADER)
+        if address:
+            # the last address is the one added by our proxy, others come from the client
+            return address.split(",")[-1].strip()
+    return request.client.host if request.client else None
+
+
+def request_kind(request, readonly: bool) -> str:
+    if request.url.path.startswith("/admin/"):
+        return "admin"
+    return "read" if readonly else "write"
+
+
+RATES = {
+    "read": lambda: settings.RATE_LIMIT_READ,
+    "write": lambda: settings.RATE_LIMIT_WRITE,
+    "admin": lambda: settings.RATE_LIMIT_ADMIN,
+}
+"""rate limit setting of each kind of request"""
+
+
+@contextlib.asynccontextmanager
+async def admit(request, readonly: bool):
+    """Let request in, or raise RejectedError"""
+    if request.method == "OPTIONS":
+        yield
+        return
+    kind = request_kind(request, readonly)
+    rate = RATES[kind]()
+    if rate > 0:
+        rate_limiter.acquire(kind, client_key(request), rate)
+    limiter = get_limiter()
+    if limiter is None:
+        yield
+        return
+    async with limiter.slot():
+        yield
@@ -2,15 +2,17 @@
 
 import asyncio
 import contextlib
+import json
 import logging
 import logging.handlers
 import re
 import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
 from typing import List, Optional
 
-import aiohttp  # async requests to call OFF for login/password check
-import psycopg2  # interface with postgresql
 from fastapi import (
+    Body,
     Cookie,
     Depends,
     FastAPI,
@@ -24,24 +26,45 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
+from . import admission
+from . import auth_client
+from . import coalesce
+from . import compression
 from . import db
+from . import formats
+from . import hll
+from . import query
+from . import jobs
 from . import settings
+from . import stats
+from . import tokens
+from . import writes
 from .models import (
+    MAX_BATCH_DELETE,
     HelloResponse,
     KeyStats,
     PingResponse,
+    ProductHistory,
     ProductList,
+    ProductsQueryRequest,
+    ProductsQueryResult,
     ProductStats,
     ProductTag,
+    ProductTagVersion,
     PropertyClashCheck,
+    PropertyClashCounts,
+    PropertyClashesCheckRequest,
     PropertyDeleteRequest,
     PropertyRenameRequest,
     PropertyClashCheckRequest,
+    SearchResult,
     ValueDeleteRequest,
     ValueRenameRequest,
+    ValuesLookupRequest,
     TokenResponse,
     User,
     ValueCount,
+    WriteTicket,
 )
 
 
@@ -53,6 +76,26 @@ The API use the main following variables:
 * **k**: "key", meaning the property or tag
 * **v**: "value", the value for a related key
 
+## Response formats
+
+Endpoints returning many rows (`/products`, `/values`) can return columns instead of objects,
+depending on the `Accept` header:
+* `application/json` (default): `[{"product": ..., "k": ..., "v": ...}, ...]`
+* `application/vnd.folksonomy.columnar+json`: `{"product": [...], "k": [...], "v": [...]}`
+* `application/msgpack`: same columns, encoded with [MessagePack](https://msgpack.org)
+
+"""
+description += f"""
+## Approximate counts
+
+`/keys` and `/products/stats` accept `approx=true`, to read statistics precomputed
+from tags changes, instead of counting tags, which is slow on large sets of tags.
+Tags counts are then exact, but numbers of distinct values (or editors) are
+estimated with HyperLogLog sketches, with a relative standard error of {hll.ERROR:.1%}
+(within {2 * hll.ERROR:.1%} for 95% of them, small counts being nearly exact).
+Statistics are updated every {settings.STATS_MERGE_INTERVAL:g} seconds.
+"""
+description += """
 ## See also
 
 * [Project page](https://wiki.openfoodfacts.org/Folksonomy_Engine)
@@ -60,14 +103,31 @@ The API use the main following variables:
 * [Documented properties](https://wiki.openfoodfacts.org/Folksonomy/Property)
 """
 
+APPROX_DESCRIPTION = "use precomputed statistics, with estimated distinct counts"
+
+TAG_COLUMNS = "product, k, v, owner, version, editor, last_edit, comment"
+"""columns of tags in responses (folksonomy has computed ones too, like v_num)"""
+
+SEARCH_LANGUAGES = ("simple", "english", "french", "german", "italian", "spanish")
+"""text search configurations of v_tsv (see 012-full-text-search)"""
+
 
 # Setup FastAPI app lifespan
 @contextlib.asynccontextmanager
 async def app_lifespan(app: FastAPI):
     async with app_logging():
+        await auth_client.start()
+        jobs.start()
+        tokens.start()
+        stats.start()
         try:
             yield
         finally:
+            await writes.terminate()
+            await stats.terminate()
+            await tokens.terminate()
+            await jobs.terminate()
+            await auth_client.terminate()
             await db.terminate()
 
 
@@ -94,6 +154,24 @@ app = FastAPI(
     ],
 )
 
+
+def openapi():
+    """OpenAPI schema, read from OPENAPI_FILE if configured, else generated"""
+    if app.openapi_schema is None and settings.OPENAPI_FILE:
+        try:
+            with open(settings.OPENAPI_FILE, encoding="utf-8") as f:
+                schema = json.load(f)
+        except OSError as e:
+            logging.getLogger(__name__).warning("OpenAPI schema not read: %s", e)
+        else:
+            # servers are configured at runtime
+            schema["servers"] = app.servers
+            app.openapi_schema = schema
+    return FastAPI.openapi(app)
+
+
+app.openapi = openapi
+
 # Allow anyone to call the API from their own apps
 app.add_middleware(
     CORSMiddleware,
@@ -126,13 +204,57 @@ async def app_logging():
     yield
 
 
+# POST endpoints which only read data (they use a body for large queries)
+READONLY_POSTS = {"/values/lookup", "/products/query"}
+
+
+def is_readonly(request: Request):
+    return request.method in ("GET", "HEAD") or request.url.path in READONLY_POSTS
+
+
+# reads served by the primary: tickets are written after the response to their POST,
+# so its x-pg-lsn does not guarantee that a replica has them
+PRIMARY_READS = ("/tickets/",)
+
+
 @app.middleware("http")
 async def initialize_transactions(request: Request, call_next):
-    """middleware that enclose request processing in a transaction"""
-    # eventually log user
-    async with db.transaction():
+    """middleware that enclose request processing in a transaction
+
+    When read replicas are configured, GET requests are served by a replica
+    (except PRIMARY_READS), other requests by the primary, which returns its WAL position
+    in x-pg-lsn header. Clients sending back this header on reads are guaranteed
+    to see their writes.
+    """
+    readonly = is_readonly(request)
+    async with db.transaction(
+        readonly=readonly and not request.url.path.startswith(PRIMARY_READS),
+        min_lsn=request.headers.get("x-pg-lsn"),
+    ):
         response = await call_next(request)
-        return response
+    if settings.POSTGRES_REPLICA_HOSTS and not readonly and response.status_code < 400:
+        # only known once the write is committed
+        response.headers["x-pg-lsn"] = await db.primary_lsn()
+    return response
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """middleware rejecting requests over rate limits, or which would wait too long
+    for a database connection (see admission)"""
+    try:
+        async with admission.admit(request, is_readonly(request)):
+            return await call_next(request)
+    except admission.RejectedError as e:
+        return JSONResponse(
+            status_code=e.status_code,
+            content={"detail": e.detail},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+# added last to be the outermost middleware, compressing final responses
+app.add_middleware(compression.CompressionMiddleware)
 
 
 @app.get(
@@ -147,15 +269,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     Get current user and check token validity if present
     """
     if token and "__U" in token:
-        cur = db.cursor()
-        await cur.execute(
-            "UPDATE auth SET last_use = current_timestamp AT TIME ZONE 'GMT' WHERE token = %s",
-            (token,),
-        )
-        if cur.rowcount == 1:
-            return User(user_id=token.split("__U", 1)[0])
-        else:
-            return User(user_id=None)
+        user_id = await tokens.check(token)
+        if user_id is not None:
+            admission.token_checked(token)
+        return User(user_id=user_id)
 
 
 def sanitize_data(k, v):
@@ -224,6 +341,14 @@ def get_auth_server(request: Request):
     return base_url
 
 
+def _auth_server_unavailable_error():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Authentication server unavailable, please retry later",
+        headers={"Retry-After": str(int(settings.AUTH_CIRCUIT_RESET_TIME))},
+    )
+
+
 @app.post("/auth", response_model=TokenResponse, tags=["Authentication"])
 async def authentication(
     request: Request,
@@ -245,24 +370,14 @@ async def authentication(
     auth_url = get_auth_server(request) + "/cgi/auth.pl"
     print(auth_url)
     auth_data = {"user_id": user_id, "password": password, "body": "1"}
-    async with aiohttp.ClientSession() as http_session:
-        async with http_session.post(auth_url, data=auth_data) as resp:
-            status_code = resp.status
-            try:
-                response_data = await resp.json()
-            except (aiohttp.ContentTypeError, ValueError):
-                response_data = {}
+    try:
+        status_code, response_data = await auth_client.post(auth_url, data=auth_data)
+    except auth_client.AuthServerUnavailableError:
+        raise _auth_server_unavailable_error()
     if status_code == 200:
         is_admin, is_moderator, is_user = extract_user_roles(response_data)
 
-        cur, timing = await db.db_exec(
-            """
-            DELETE FROM auth WHERE user_id = %s;
-            INSERT INTO auth (user_id, token, last_use, admin, moderator, "user")
-            VALUES (%s, %s, current_timestamp AT TIME ZONE 'GMT', %s, %s, %s);
-        """,
-            (user_id, user_id, token, is_admin, is_moderator, is_user),
-        )
+        cur = await tokens.store(user_id, token, is_admin, is_moderator, is_user)
         if cur.rowcount == 1:
             return {"access_token": token, "token_type": "bearer"}
     elif status_code == 403:
@@ -303,24 +418,17 @@ async def authentication_by_cookie(
         raise HTTPException(status_code=422, detail="Malformed 'session' cookie")
 
     auth_url = get_auth_server(request) + "/cgi/auth.pl"
-    async with aiohttp.ClientSession() as http_session:
-        async with http_session.post(
-            auth_url, cookies={"session": session}, data={"body": "1"}
-        ) as resp:
-            auth_data = await resp.json()
-            status_code = resp.status
+    try:
+        status_code, auth_data = await auth_client.check_session_cookie(
+            auth_url, session
+        )
+    except auth_client.AuthServerUnavailableError:
+        raise _auth_server_unavailable_error()
 
     if status_code == 200:
         is_admin, is_moderator, is_user = extract_user_roles(auth_data)
 
-        cur, timing = await db.db_exec(
-            """
-            DELETE FROM auth WHERE user_id = %s;
-            INSERT INTO auth (user_id, token, last_use, admin, moderator, "user")
-            VALUES (%s, %s, current_timestamp AT TIME ZONE 'GMT', %s, %s, %s);
-            """,
-            (user_id, user_id, token, is_admin, is_moderator, is_user),
-        )
+        cur = await tokens.store(user_id, token, is_admin, is_moderator, is_user)
         if cur.rowcount == 1:
             return {"access_token": token, "token_type": "bearer"}
     elif status_code == 403:
@@ -333,31 +441,99 @@ async def authentication_by_cookie(
     raise HTTPException(status_code=500, detail="Server error")
 
 
-def property_where(owner: str, k: str, v: str):
-    """Build a SQL condition on a property, filtering by owner and eventually key and value"""
-    conditions = ["owner=%s"]
-    params = [owner]
+def property_where(owner: str, k: str, v: str, overlay: bool = False):
+    """Build a SQL condition on a property, filtering by owner and eventually key and value
+
+    With overlay, owners are already filtered by tags_source.
+    """
+    conditions, params = ([], []) if overlay else (["owner=%s"], [owner])
     if k != "":
         conditions.append("k=%s")
         params.append(k)
         if v != "":
             conditions.append("v=%s")
             params.append(v)
-    where = " AND ".join(conditions)
+    where = " AND ".join(conditions) or "TRUE"
     return where, params
 
 
+OVERLAY_DESCRIPTION = (
+    "with owner, add the public tags it has not overridden (no tag with the same key), "
+    "the owner of each tag telling where it comes from"
+)
+
+
+def tags_source(owner: str, overlay: bool = False, as_of: datetime = None):
+    """SQL source of tags (named folksonomy), and its parameters
+
+    With as_of, tags are rebuilt from their versions, as they were at that time.
+    With overlay, tags of owner come with the public tags it has not overridden
+    (on the same product, with the same key), and the source is already filtered by
+    owner. Conditions on product and k are pushed down by PostgreSQL to the tables.
+    """
+    source, params = "folksonomy", []
+    if as_of is not None:
+        # the last version of each tag, unless it is a deletion (version 0)
+        source = f"""(
+            SELECT * FROM (
+                SELECT DISTINCT ON (product, owner, k) {TAG_COLUMNS}
+                FROM folksonomy_versions
+                WHERE last_edit <= %s::timestamp
+                ORDER BY product, owner, k, last_edit DESC, id DESC
+            ) AS versions
+            WHERE version > 0
+        ) AS folksonomy"""
+        params.append(as_of)
+    if overlay:
+        # private tags first
+        source = f"""(
+            SELECT DISTINCT ON (product, k) * FROM {source}
+            WHERE owner IN ('', %s)
+            ORDER BY product, k, owner = ''
+        ) AS folksonomy"""
+        params.append(owner)
+    return source, params
+
+
 @app.get("/products/stats", response_model=List[ProductStats], tags=["Products"])
 async def product_stats(
-    response: Response, owner="", k="", v="", user: User = Depends(get_current_user)
+    response: Response,
+    owner="",
+    k="",
+    v="",
+    approx: bool = Query(False, description=APPROX_DESCRIPTION),
+    user: User = Depends(get_current_user),
 ):
     """
     Get the list of products with tags statistics
 
-    The products list can be limited to some tags (k or k=v)
+    The products list can be limited to some tags (k or k=v).
+    With approx=true and no k, statistics are read from precomputed ones.
     """
     check_owner_user(user, owner, allow_anonymous=True)
     k, v = sanitize_data(k, v)
+    if approx and k == "":
+        # when a key is given, each product has a single matching tag,
+        # so exact statistics are cheap
+        cur, timing = await db.db_exec(
+            """
+            SELECT json_agg(json_build_object(
+                'product', product,
+                'keys', tags,
+                'last_edit', last_edit,
+                'editors', estimate
+            ))
+            FROM folksonomy_product_stats
+            WHERE owner = %s
+            """,
+            (owner,),
+        )
+        out = await cur.fetchone()
+        return JSONResponse(
+            status_code=200,
+            content=out[0] if out and out[0] is not None else [],
+            headers={"x-pg-timing": timing},
+        )
     where, params = property_where(owner, k, v)
     cur, timing = await db.db_exec(
         """
@@ -391,8 +567,14 @@ async def product_stats(
     )
 
 
-@app.get("/products", response_model=List[ProductList], tags=["Products"])
+@app.get(
+    "/products",
+    response_model=List[ProductList],
+    responses=formats.ROWS_RESPONSES,
+    tags=["Products"],
+)
 async def product_list(
+    request: Request,
     response: Response,
     k: str,
     owner: str = "",
@@ -400,6 +582,13 @@ async def product_list(
     code: str = Query(
         None, description="Comma-separated list of product code to filter by"
     ),
+    v_min: Optional[Decimal] = Query(None, description="Minimum numeric value"),
+    v_max: Optional[Decimal] = Query(None, description="Maximum numeric value"),
+    sort: Optional[str] = Query(
+        None, pattern="^(asc|desc)$", description="Sort by numeric value"
+    ),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of products"),
+    overlay: bool = Query(False, description=OVERLAY_DESCRIPTION),
     user: User = Depends(get_current_user),
 ):
     """
@@ -409,10 +598,21 @@ async def product_list(
     - **owner**: Owner filter (optional, default empty for public)
     - **v**: Property value filter (optional)
     - **code**: Comma-separated list of product code to filter by (optional)
+    - **v_min**, **v_max**: Range of numeric values, bounds included (optional)
+    - **sort**: asc or desc, to sort by numeric value (optional)
+    - **limit**: Maximum number of products, eg. the top ones with sort (optional)
+    - **overlay**: With owner, add public tags it has not overridden,
+      with the owner of each tag (optional)
+
+    With v_min, v_max or sort, only products with a numeric value are listed.
+
+    Columns can be asked for instead of objects, see Response formats.
     """
     check_owner_user(user, owner, allow_anonymous=True)
     k, v = sanitize_data(k, v)
-    where, params = property_where(owner, k, v)
+    source, params = tags_source(owner, overlay)
+    where, where_params = property_where(owner, k, v, overlay)
+    params.extend(where_params)
 
     # Add product ID filter if code is provided
     if code:
@@ -422,19 +622,44 @@ async def product_list(
             where += f" AND product IN ({placeholders})"
             params.extend(product_code)
 
+    # numeric values use partial indexes on v_num
+    if v_min is not None or v_max is not None or sort:
+        where += " AND v_num IS NOT NULL"
+    if v_min is not None:
+        where += " AND v_num >= %s::numeric"
+        params.append(v_min)
+    if v_max is not None:
+        where += " AND v_num <= %s::numeric"
+        params.append(v_max)
+    if sort:
+        # same direction for both columns, to follow the index
+        where += " ORDER BY v_num {0}, product {0}".format(sort.upper())
+    if limit:
+        where += " LIMIT %s"
+        params.append(limit)
+
+    columns = ("product", "k", "v", "owner") if overlay else ("product", "k", "v")
+    media_type = formats.negotiate(request.headers.get("accept"))
+    if media_type != formats.JSON:
+        cur, timing = await db.db_exec(
+            "SELECT %s FROM %s WHERE %s" % (", ".join(columns), source, where), params
+        )
+        return formats.columnar_response(
+            columns,
+            await cur.fetchall(),
+            media_type,
+            headers={"x-pg-timing": timing},
+        )
+
     cur, timing = await db.db_exec(
         """
         SELECT coalesce(json_agg(j.j)::json, '[]'::json) FROM(
-            SELECT json_build_object(
-                'product',product,
-                'k',k,
-                'v',v
-                ) as j
-            FROM folksonomy
+            SELECT json_build_object(%s) as j
+            FROM %s
             WHERE %s
             ) as j;
         """
-        % where,
+        % (", ".join(f"'{c}',{c}" for c in columns), source, where),
         params,
     )
     out = await cur.fetchone()
@@ -442,54 +667,204 @@ async def product_list(
     return JSONResponse(
         status_code=200,
         content=out[0] if out and out[0] is not None else [],
+        headers={"x-pg-timing": timing, "Vary": "Accept"},
+    )
+
+
+@app.post("/products/query", response_model=ProductsQueryResult, tags=["Products"])
+async def products_query(
+    request: ProductsQueryRequest,
+    owner: str = "",
+    after: Optional[str] = Query(
+        None, description="product code from which to continue (next_after)"
+    ),
+    limit: int = Query(1000, ge=1, le=10000),
+    user: User = Depends(get_current_user),
+):
+    """
+    Get products matching a boolean query on their properties
+
+    The query combines conditions on properties, `{"k": "color"}` (products having
+    a color), or `{"k": "color", "v": "red"}`, with `{"and": [...]}`, `{"or": [...]}`,
+    and `{"not": ...}` (only in an "and", with other conditions), eg.
+    `{"and": [{"k": "color", "v": "red"}, {"not": {"k": "size"}}]}`
+
+    Products codes are sorted, if there are more than **limit**,
+    use next_after as **after** to get the following ones.
+    """
+    check_owner_user(user, owner, allow_anonymous=True)
+    stats = await query.keys_stats(owner, request.query)
+    try:
+        sql, params = query.compile_condition(request.query, owner, after, stats)
+    except query.QueryError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    cur, timing = await db.db_exec(
+        f"""
+        SELECT coalesce(json_agg(product), '[]'::json) FROM (
+            SELECT product FROM ({sql}) AS matches ORDER BY product LIMIT %s
+        ) AS page
+        """,
+        params + [limit],
+    )
+    products = (await cur.fetchone())[0]
+    return JSONResponse(
+        status_code=200,
+        content={
+            "products": products,
+            "next_after": products[-1] if len(products) == limit else None,
+        },
         headers={"x-pg-timing": timing},
     )
 
 
+async def coalesced_json(
+    request: Request, key: tuple, query: str, params, encoded: bool = False
+):
+    """JSON response of query (returning a JSON value, or [] if none)
+
+    If encoded, the query returns the JSON text, which is sent as is.
+    The query, and the encoding of its result, are shared with identical concurrent
+    requests (see coalesce): key must identify the result.
+    """
+
+    async def fetch():
+        cur, timing = await db.db_exec(query, params)
+        out = await cur.fetchone()
+        if encoded:
+            return (out[0] if out else "[]").encode(), timing
+        content = out[0] if out and out[0] is not None else []
+        return JSONResponse(content).body, timing
+
+    key = (request.url.path, request.headers.get("x-pg-lsn")) + key
+    body, timing = await coalesce.run(key, fetch)
+    return Response(
+        body, media_type="application/json", headers={"x-pg-timing": timing}
+    )
+
+
 @app.get("/product/{product}", response_model=List[ProductTag], tags=["Product Tags"])
 async def product_tags_list(
-    response: Response,
+    request: Request,
     product: str,
     owner: str = "",
     keys: str = Query(
         None,
         description="Comma-separated list of keys to filter by. If not provided, all keys are returned.",
     ),
+    as_of: Optional[datetime] = Query(
+        None, description="get tags as they were at this time (UTC if no time zone)"
+    ),
+    overlay: bool = Query(False, description=OVERLAY_DESCRIPTION),
     user: User = Depends(get_current_user),
 ):
     """
     Get a list of existing tags for a product, optionally filtering by specific keys.
+
+    With **as_of**, tags are rebuilt from their versions (see /product/{product}/history).
+    With **overlay**, public tags not overridden by owner are returned too.
     """
 
     check_owner_user(user, owner, allow_anonymous=True)
-    keys_list = [key.strip() for key in keys.split(",")] if keys else None
+    keys_list = sorted({key.strip() for key in keys.split(",")}) if keys else None
+    if not keys_list and as_of is None and not overlay:
+        # documents are kept up to date by triggers on folksonomy
+        return await coalesced_json(
+            request,
+            (product, owner),
+            """
+            SELECT doc FROM folksonomy_product_docs
+            WHERE product = %s AND owner = %s
+            """,
+            (product, owner),
+            encoded=True,
+        )
 
-    placeholders = ", ".join(["%s"] * len(keys_list)) if keys_list else ""
+    # last_edit is in UTC, without time zone
+    if as_of is not None and as_of.tzinfo is not None:
+        as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    source, params = tags_source(owner, overlay, as_of)
+    where = "product = %s"
+    params.append(product)
+    if not overlay:
+        where += " AND owner = %s"
+        params.append(owner)
+    if keys_list:
+        where += " AND k IN (%s)" % ", ".join(["%s"] * len(keys_list))
+        params.extend(keys_list)
 
     query = f"""
         SELECT json_agg(j)::json FROM (
-            SELECT * FROM folksonomy
-            WHERE product = %s AND owner = %s
-            {f"AND k IN ({placeholders})" if keys_list else ""}
+            SELECT {TAG_COLUMNS}
+            FROM {source}
+            WHERE {where}
             ORDER BY k
         ) as j;
     """
 
-    params = [product, owner] + (keys_list if keys_list else [])
+    return await coalesced_json(request, (overlay,) + tuple(params), query, params)
 
-    cur, timing = await db.db_exec(query, tuple(params))
-    out = await cur.fetchone()
 
+# a key named history is still available with /product/{product}?keys=history
+@app.get(
+    "/product/{product}/history",
+    response_model=ProductHistory,
+    tags=["Product Tags"],
+)
+async def product_history(
+    product: str,
+    owner: str = "",
+    after: Optional[str] = Query(
+        None, description="where to continue from (next_after)"
+    ),
+    limit: int = Query(50, ge=1, le=1000),
+    user: User = Depends(get_current_user),
+):
+    """
+    Get versions of all tags of a product, most recent first
+
+    Deletions are versions 0, with comment DELETE.
+    If there are more than **limit** versions,
+    use next_after as **after** to get the following ones.
+    """
+    check_owner_user(user, owner, allow_anonymous=True)
+    params = [product, owner]
+    keyset = ""
+    if after:
+        try:
+            last_edit, after_id = after.split("|", 1)
+            params += [datetime.fromisoformat(last_edit), int(after_id)]
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid after")
+        # versions are sorted by last_edit, then by order of archiving (id), both desc
+        keyset = "AND (last_edit, id) < (%s::timestamp, %s)"
+    cur, timing = await db.db_exec(
+        f"""
+        SELECT coalesce(json_agg(page), '[]'::json) FROM (
+            SELECT {TAG_COLUMNS}, id
+            FROM folksonomy_versions
+            WHERE product = %s AND owner = %s {keyset}
+            ORDER BY last_edit DESC, id DESC
+            LIMIT %s
+        ) AS page
+        """,
+        params + [limit],
+    )
+    results = (await cur.fetchone())[0]
+    # id is only needed for next_after
+    ids = [result.pop("id") for result in results]
+    next_after = None
+    if len(results) == limit:
+        next_after = f"{results[-1]['last_edit']}|{ids[-1]}"
     return JSONResponse(
         status_code=200,
-        content=out[0] if out and out[0] is not None else [],
+        content={"results": results, "next_after": next_after},
         headers={"x-pg-timing": timing},
     )
 
 
 @app.get("/product/{product}/{k}", response_model=ProductTag, tags=["Product Tags"])
 async def product_tag(
-    response: Response,
+    request: Request,
     product: str,
     k: str,
     owner="",
@@ -505,34 +880,24 @@ async def product_tag(
     key = re.sub(r"[^a-z0-9_\:]", "", k)
     check_owner_user(user, owner, allow_anonymous=True)
     if k[-1:] == "*":
-        cur, timing = await db.db_exec(
-            """
+        query = f"""
             SELECT json_agg(j)::json FROM(
-                SELECT *
+                SELECT {TAG_COLUMNS}
                 FROM folksonomy
                 WHERE product = %s AND owner = %s AND k ~ %s
                 ORDER BY k) as j;
-            """,
-            (product, owner, "^%s(:.|$)" % key),
-        )
+        """
+        params = (product, owner, "^%s(:.|$)" % key)
     else:
-        cur, timing = await db.db_exec(
-            """
+        query = f"""
             SELECT row_to_json(j) FROM(
-                SELECT *
+                SELECT {TAG_COLUMNS}
                 FROM folksonomy
                 WHERE product = %s AND owner = %s AND k = %s
                 ) as j;
-            """,
-            (product, owner, key),
-        )
-    out = await cur.fetchone()
-
-    return JSONResponse(
-        status_code=200,
-        content=out[0] if out and out[0] is not None else [],
-        headers={"x-pg-timing": timing},
-    )
+        """
+        params = (product, owner, key)
+    return await coalesced_json(request, params, query, params)
 
 
 @app.get(
@@ -554,9 +919,9 @@ async def product_tag_list_versions(
     check_owner_user(user, owner, allow_anonymous=True)
     k, v = sanitize_data(k, None)
     cur, timing = await db.db_exec(
-        """
+        f"""
         SELECT json_agg(j)::json FROM(
-            SELECT *
+            SELECT {TAG_COLUMNS}
             FROM folksonomy_versions
             WHERE product = %s AND owner = %s AND k = %s
             ORDER BY version DESC
@@ -575,7 +940,14 @@ async def product_tag_list_versions(
 
 @app.post("/product", tags=["Product Tags"])
 async def product_tag_add(
-    response: Response, product_tag: ProductTag, user: User = Depends(get_current_user)
+    response: Response,
+    product_tag: ProductTag,
+    async_: bool = Query(
+        False,
+        alias="async",
+        description="create the tag later, with others, see /tickets/{ticket}",
+    ),
+    user: User = Depends(get_current_user),
 ):
     """
     Create a new product tag (version=1)
@@ -589,17 +961,37 @@ async def product_tag_add(
     Be aware it's not possible to create the same tag twice. Though, you can update
     a tag and add multiple values the way you want (don't forget to document how); comma
     separated list is a good option.
+
+    With async=1, the tag is created within a few milliseconds, in the same transaction
+    as others, which is faster for bots creating many tags. The response (202) is
+    a ticket, to get the outcome from /tickets/{ticket}.
     """
     check_owner_user(user, product_tag.owner, allow_anonymous=False)
     # enforce user
     product_tag.editor = user.user_id
+    if async_:
+        if product_tag.version != 1:
+            raise _create_version_error(1, product_tag.version)
+        try:
+            ticket = writes.enqueue(product_tag)
+        except writes.BufferFullError:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many pending writes, try again later",
+                headers={"Retry-After": "1"},
+            )
+        return JSONResponse(
+            status_code=202,
+            content={"ticket": ticket, "status": "pending", "error": None},
+            headers={"Location": f"/tickets/{ticket}"},
+        )
     # note: version is checked by postgres routine
     try:
         query, params = db.create_product_tag_req(product_tag)
         cur, timing = await db.db_exec(query, params)
-    except psycopg2.Error as e:
-        error_msg = re.sub(r".*@@ (.*) @@\n.*$", r"\1", e.pgerror)[:-1]
-        if "duplicate key value violates unique constraint" in e.pgerror:
+    except db.DatabaseError as e:
+        error_msg = e.trigger_message
+        if e.is_unique_violation:
             return JSONResponse(
                 status_code=422,
                 content={
@@ -615,6 +1007,25 @@ async def product_tag_add(
     return
 
 
+@app.get("/tickets/{ticket}", response_model=WriteTicket, tags=["Product Tags"])
+async def write_ticket(ticket: uuid.UUID):
+    """
+    Get the outcome of an asynchronous tag creation (POST /product?async=1)
+
+    Status is pending, created, conflict (the tag already exists), or failed (see error).
+    Tickets are kept for ASYNC_TICKET_LIFETIME (a day by default). Until its tag is written,
+    a ticket is only known to the worker which received it (404 from others).
+    """
+    outcome = await writes.status(str(ticket))
+    if outcome is None:
+        raise HTTPException(status_code=404, detail="Unknown ticket")
+    status, error = outcome
+    return JSONResponse(
+        status_code=200,
+        content={"ticket": str(ticket), "status": status, "error": error},
+    )
+
+
 def _create_version_error(expected_version: int, received_version: int):
     return HTTPException(
         status_code=422,
@@ -646,41 +1057,70 @@ async def product_tag_update(
     # enforce user
     product_tag.editor = user.user_id
     try:
-        # Fetch the latest version directly from the database
-        cur, timing = await db.db_exec(
-            """
-            SELECT version FROM folksonomy
-            WHERE product = %s AND owner = %s AND k = %s;
-            """,
-            (product_tag.product, product_tag.owner, product_tag.k),
-        )
-        latest_version_row = await cur.fetchone()
-
-        if not latest_version_row:
-            raise HTTPException(status_code=404, detail="Key was not found")
-
-        latest_version = latest_version_row[0]  # Extract version from row
+        # single statement: no race between version check and update
+        cur, timing = await db.db_exec(*db.compare_and_set_product_tag_req(product_tag))
+        current_version, new_version = await cur.fetchone()
+    except db.DatabaseError as e:
+        raise HTTPException(status_code=422, detail=e.trigger_message)
+    if current_version is None:
+        raise HTTPException(status_code=404, detail="Key was not found")
+    if new_version is None:
+        raise _create_version_error(current_version + 1, product_tag.version)
+    return "ok"
+
+
+@app.post("/product/upsert", tags=["Product Tags"])
+async def product_tag_upsert(
+    response: Response,
+    product_tag: ProductTag,
+    expected_version: Optional[int] = Query(
+        None,
+        ge=0,
+        description="only write if current version is this one (0 if the tag must not exist)",
+    ),
+    user: User = Depends(get_current_user),
+):
+    """
+    Create a product tag, or update it if it already exists
 
-        # Validate version increment
-        if product_tag.version != latest_version + 1:
-            raise _create_version_error(latest_version + 1, product_tag.version)
+    - **product**: which product
+    - **k**: which key for the tag
+    - **v**: which value to set for the tag
+    - **owner**: None or empty for public tags, or your own user_id
 
-        req, params = db.update_product_tag_req(product_tag)
-        cur, timing = await db.db_exec(req, params)
-    except psycopg2.Error as e:
+    The version of the body is not used: it is 1 on creation, and incremented on update.
+    Use **expected_version** to avoid overwriting a concurrent edit.
+    Returns the new version of the tag.
+    """
+    check_owner_user(user, product_tag.owner, allow_anonymous=False)
+    # enforce user
+    product_tag.editor = user.user_id
+    try:
+        if expected_version:
+            # the tag must exist: this is a compare and set
+            product_tag.version = expected_version + 1
+            cur, timing = await db.db_exec(
+                *db.compare_and_set_product_tag_req(product_tag)
+            )
+            current_version, version = await cur.fetchone()
+            if current_version is None:
+                raise HTTPException(status_code=404, detail="Key was not found")
+        else:
+            cur, timing = await db.db_exec(
+                *db.upsert_product_tag_req(
+                    product_tag, create_only=expected_version == 0
+                )
+            )
+            row = await cur.fetchone()
+            version = row[0] if row is not None else None
+    except db.DatabaseError as e:
+        raise HTTPException(status_code=422, detail=e.trigger_message)
+    if version is None:
         raise HTTPException(
             status_code=422,
-            detail=re.sub(r".*@@ (.*) @@\n.*$", r"\1", e.pgerror)[:-1],
-        )
-    # Check if exactly one row was updated
-    # Atlease one row will be updated, as version is checked
-    if cur.rowcount == 1:
-        return "ok"
-    else:
-        raise HTTPException(
-            status_code=503,
-            detail="Dubious update - more than one row udpated",
+            detail="Version conflict for this product (might result from a concurrent edit)",
         )
+    return JSONResponse(content={"version": version}, headers={"x-pg-timing": timing})
 
 
 @app.delete("/product/{product}/{k}", tags=["Product Tags"])
@@ -694,58 +1134,84 @@ async def product_tag_delete(
 ):
     """
     Delete a product tag
+
+    The tag is only deleted if it still has this version:
+    returns 404 if it does not exist, and 422 if it has another version.
     """
     check_owner_user(user, owner, allow_anonymous=False)
     k, v = sanitize_data(k, None)
     try:
-        # Setting version to 0, this is seen as a reset,
-        # while maintaining history in folksonomy_versions
+        # history is kept in folksonomy_versions by a trigger, as a version 0
         cur, timing = await db.db_exec(
-            """
-            UPDATE folksonomy SET version = 0, editor = %s, comment = 'DELETE'
-                WHERE product = %s AND owner = %s AND k = %s AND version = %s;
-            """,
-            (user.user_id, product, owner, k, version),
+            *db.delete_product_tag_req(product, owner, k, version, user.user_id)
         )
-    except psycopg2.Error as e:
+        current_version, deleted_version = await cur.fetchone()
+    except db.DatabaseError as e:
         # note: transaction will be rolled back by the middleware
+        raise HTTPException(status_code=422, detail=e.trigger_message)
+    if current_version is None:
         raise HTTPException(
-            status_code=422,
-            detail=re.sub(r".*@@ (.*) @@\n.*$", r"\1", e.pgerror)[:-1],
+            status_code=404,
+            detail="Unknown product/k for this owner",
         )
-    if cur.rowcount != 1:
+    if deleted_version is None:
         raise HTTPException(
             status_code=422,
-            detail="Unknown product/k/version for this owner",
+            detail="version mismatch, last version for this product/k is %s"
+            % current_version,
         )
-    cur, timing = await db.db_exec(
-        """
-        DELETE FROM folksonomy WHERE product = %s AND owner = %s AND k = %s AND version = 0;
-        """,
-        (product, owner, k.lower()),
-    )
-    if cur.rowcount == 1:
-        return "ok"
-    else:
-        # we have a conflict, return an error explaining conflict
+    return "ok"
+
+
+@app.delete("/product", tags=["Product Tags"])
+async def product_tags_delete(
+    response: Response,
+    tags: List[ProductTagVersion] = Body(max_length=MAX_BATCH_DELETE),
+    owner: str = "",
+    user: User = Depends(get_current_user),
+):
+    """
+    Delete many product tags at once
+
+    Body is a list of `{"product": ..., "k": ..., "version": ...}`,
+    a tag is only deleted if it still has this version.
+
+    Returns the number of deleted tags,
+    and tags which were not (missing or with another version).
+    """
+    check_owner_user(user, owner, allow_anonymous=False)
+    try:
         cur, timing = await db.db_exec(
-            """
-            SELECT version FROM folksonomy WHERE product = %s AND owner = %s AND k = %s
+            f"""
+            DELETE FROM folksonomy f
+            USING unnest(%s::text[], %s::text[], %s::int[]) AS d(product, k, version),
+                {db.SET_EDITOR_USING}
+            WHERE f.product = d.product AND f.k = d.k AND f.version = d.version
+                AND f.owner = %s
+            RETURNING f.product, f.k, f.version
             """,
-            (product, owner, k),
+            (
+                [tag.product for tag in tags],
+                [tag.k.lower() for tag in tags],
+                [tag.version for tag in tags],
+                user.user_id,
+                owner,
+            ),
         )
-        if cur.rowcount == 1:
-            out = await cur.fetchone()
-            raise HTTPException(
-                status_code=422,
-                detail="version mismatch, last version for this product/k is %s"
-                % out[0],
-            )
-        else:
-            raise HTTPException(
-                status_code=404,
-                detail="Unknown product/k for this owner",
-            )
+        deleted = {tuple(row) for row in await cur.fetchall()}
+    except db.DatabaseError as e:
+        raise HTTPException(status_code=422, detail=e.trigger_message)
+    return JSONResponse(
+        content={
+            "deleted": len(deleted),
+            "not_deleted": [
+                tag.model_dump()
+                for tag in tags
+                if (tag.product, tag.k.lower(), tag.version) not in deleted
+            ],
+        },
+        headers={"x-pg-timing": timing},
+    )
 
 
 @app.get("/keys", response_model=List[KeyStats], tags=["Keys & Values"])
@@ -753,30 +1219,44 @@ async def keys_list(
     response: Response,
     q: Optional[str] = "",
     owner: str = "",
+    approx: bool = Query(False, description=APPROX_DESCRIPTION),
     user: User = Depends(get_current_user),
 ):
     """
     Get the list of keys with statistics, with an optional search filter.
 
-    The keys list can be restricted to private tags from some owner
+    The keys list can be restricted to private tags from some owner.
+    With approx=true, statistics are read from precomputed ones.
     """
     check_owner_user(user, owner, allow_anonymous=True)
 
     search_filter = "AND k ILIKE %s" if q else ""
-    query = f"""
-        SELECT json_agg(j)::json FROM (
-            SELECT json_build_object(
+    if approx:
+        query = f"""
+            SELECT json_agg(json_build_object(
                 'k', k,
-                'count', COUNT(*),
-                'values', COUNT(distinct v)
-            ) AS j
-            FROM folksonomy
+                'count', tags,
+                'values', estimate
+            ) ORDER BY tags DESC)
+            FROM folksonomy_key_stats
             WHERE owner = %s
             {search_filter}
-            GROUP BY k
-            ORDER BY count(*) DESC
-        ) AS j;
-    """
+        """
+    else:
+        query = f"""
+            SELECT json_agg(j)::json FROM (
+                SELECT json_build_object(
+                    'k', k,
+                    'count', COUNT(*),
+                    'values', COUNT(distinct v)
+                ) AS j
+                FROM folksonomy
+                WHERE owner = %s
+                {search_filter}
+                GROUP BY k
+                ORDER BY count(*) DESC
+            ) AS j;
+        """
 
     query_params = [owner] + ([f"%{q}%"] if q else [])
 
@@ -792,7 +1272,7 @@ async def keys_list(
 
 @app.get("/values/{k}", response_model=List[ValueCount], tags=["Keys & Values"])
 async def get_unique_values(
-    response: Response,
+    request: Request,
     k: str,
     owner: str = "",
     q: str = "",
@@ -837,14 +1317,82 @@ async def get_unique_values(
     """
     params.append(limit)
 
-    cur, timing = await db.db_exec(sql, params)
-    out = await cur.fetchone()
-    data = out[0] if out and out[0] is not None else []
-    return JSONResponse(status_code=200, content=data, headers={"x-pg-timing": timing})
+    return await coalesced_json(request, tuple(params), sql, params)
 
 
-@app.get("/values", tags=["Keys & Values"])
+@app.get("/search", response_model=SearchResult, tags=["Keys & Values"])
+async def search(
+    q: str,
+    owner: str = "",
+    k: str = "",
+    lang: str = Query(
+        "simple",
+        pattern="^(%s)$" % "|".join(SEARCH_LANGUAGES),
+        description="Language of q, for stemming: %s (simple: words as is)"
+        % ", ".join(SEARCH_LANGUAGES),
+    ),
+    after: Optional[str] = Query(
+        None, description="where to continue from (next_after)"
+    ),
+    limit: int = Query(50, ge=1, le=1000),
+    user: User = Depends(get_current_user),
+):
+    """
+    Search words in values, across all keys (or only k), best matches first
+
+    - **q**: Words to search for, "quoted phrases", or, and -excluded words
+
+    If there are more than **limit** matches,
+    use next_after as **after** to get the following ones.
+    """
+    check_owner_user(user, owner, allow_anonymous=True)
+    k, _ = sanitize_data(k, None)
+    where, params = "", [lang, q, owner]
+    if k:
+        where += " AND k = %s"
+        params.append(k)
+    keyset = ""
+    if after:
+        try:
+            rank, product, after_k = after.split("|", 2)
+            rank = float(rank)
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid after")
+        # matches are sorted by rank desc, product, key
+        keyset = """
+            WHERE rank < %s::real OR (rank = %s::real AND (product, k) > (%s, %s))
+        """
+        params += [rank, rank, product, after_k]
+    cur, timing = await db.db_exec(
+        f"""
+        SELECT coalesce(json_agg(page), '[]'::json) FROM (
+            SELECT product, k, v, rank FROM (
+                SELECT product, k, v, ts_rank(v_tsv, query) AS rank
+                FROM folksonomy, websearch_to_tsquery(%s::regconfig, %s) AS query
+                WHERE owner = %s AND v_tsv @@ query {where}
+            ) AS matches
+            {keyset}
+            ORDER BY rank DESC, product, k
+            LIMIT %s
+        ) AS page
+        """,
+        params + [limit],
+    )
+    results = (await cur.fetchone())[0]
+    next_after = None
+    if len(results) == limit:
+        last = results[-1]
+        next_after = f"{last['rank']!r}|{last['product']}|{last['k']}"
+    return JSONResponse(
+        status_code=200,
+        content={"results": results, "next_after": next_after},
+        headers={"x-pg-timing": timing},
+    )
+
+
+@app.get("/values", responses=formats.ROWS_RESPONSES, tags=["Keys & Values"])
 async def get_values_by_codes_and_keys(
+    request: Request,
     response: Response,
     codes: Optional[str] = Query(
         None, description="Comma-separated list of product codes (barcodes)"
@@ -853,6 +1401,7 @@ async def get_values_by_codes_and_keys(
         None, description="Comma-separated list of property keys"
     ),
     owner: str = "",
+    overlay: bool = Query(False, description=OVERLAY_DESCRIPTION),
     user: User = Depends(get_current_user),
 ):
     """
@@ -861,8 +1410,11 @@ async def get_values_by_codes_and_keys(
     - **codes**: Comma-separated list of product codes (barcodes) to filter by
     - **keys**: Comma-separated list of property keys to filter by
     - **owner**: None or empty for public tags, or your own user_id
+    - **overlay**: With owner, add public tags it has not overridden
 
     At least one of 'code' or 'keys' must be provided. Maximum 1000 products and 1000 keys.
+
+    Columns can be asked for instead of objects, see Response formats.
     """
     check_owner_user(user, owner, allow_anonymous=True)
 
@@ -881,7 +1433,33 @@ async def get_values_by_codes_and_keys(
     if keys_list and len(keys_list) > 1000:
         raise HTTPException(status_code=422, detail="Maximum 1000 keys allowed")
 
-    sql = """
+    source, params = tags_source(owner, overlay)
+    where = "TRUE" if overlay else "owner = %s"
+    if not overlay:
+        params.append(owner)
+
+    if codes_list:
+        placeholders = ", ".join(["%s"] * len(codes_list))
+        where += f" AND product IN ({placeholders})"
+        params.extend(codes_list)
+
+    if keys_list:
+        placeholders = ", ".join(["%s"] * len(keys_list))
+        where += f" AND k IN ({placeholders})"
+        params.extend(keys_list)
+
+    media_type = formats.negotiate(request.headers.get("accept"))
+    if media_type != formats.JSON:
+        columns = ("product", "k", "v", "owner", "version", "editor", "last_edit")
+        cur, timing = await db.db_exec(
+            f"SELECT {', '.join(columns)} FROM {source} WHERE {where} ORDER BY product, k",
+            tuple(params),
+        )
+        return formats.columnar_response(
+            columns, await cur.fetchall(), media_type, headers={"x-pg-timing": timing}
+        )
+
+    sql = f"""
         SELECT json_agg(j)::json FROM (
             SELECT json_build_object(
                 'product', product,
@@ -892,22 +1470,11 @@ async def get_values_by_codes_and_keys(
                 'editor', editor,
                 'last_edit', last_edit
             ) AS j
-            FROM folksonomy
-            WHERE owner = %s
+            FROM {source}
+            WHERE {where}
+            ORDER BY product, k
+        ) AS j;
     """
-    params = [owner]
-
-    if codes_list:
-        placeholders = ", ".join(["%s"] * len(codes_list))
-        sql += f" AND product IN ({placeholders})"
-        params.extend(codes_list)
-
-    if keys_list:
-        placeholders = ", ".join(["%s"] * len(keys_list))
-        sql += f" AND k IN ({placeholders})"
-        params.extend(keys_list)
-
-    sql += " ORDER BY product, k) AS j;"
 
     cur, timing = await db.db_exec(sql, tuple(params))
     out = await cur.fetchone()
@@ -915,6 +1482,66 @@ async def get_values_by_codes_and_keys(
     return JSONResponse(
         status_code=200,
         content=out[0] if out and out[0] is not None else [],
+        headers={"x-pg-timing": timing, "Vary": "Accept"},
+    )
+
+
+@app.post("/values/lookup", tags=["Keys & Values"])
+async def lookup_values(
+    lookup: ValuesLookupRequest,
+    owner: str = "",
+    user: User = Depends(get_current_user),
+):
+    """
+    Get values of many products at once, grouped by product: `{product: {k: v}}`
+
+    - **codes**: products for which to get all values (restricted to **keys** if given)
+    - **pairs**: exact `[product, k]` pairs to get the value of
+    - **owner**: None or empty for public tags, or your own user_id
+
+    Up to 50000 codes and 50000 pairs can be given.
+    Products without any matching value are not in the result.
+    """
+    check_owner_user(user, owner, allow_anonymous=True)
+    # join on unnested arrays, so that the query does not grow with the lookup
+    lookups = []
+    params = []
+    if lookup.codes:
+        sql = """
+            SELECT f.product, f.k, f.v
+            FROM folksonomy f JOIN unnest(%s::text[]) AS l(product) USING (product)
+            WHERE f.owner = %s
+        """
+        params.extend([lookup.codes, owner])
+        if lookup.keys:
+            sql += " AND f.k = ANY(%s::text[])"
+            params.append(lookup.keys)
+        lookups.append(sql)
+    if lookup.pairs:
+        lookups.append(
+            """
+            SELECT f.product, f.k, f.v
+            FROM folksonomy f
+            JOIN unnest(%s::text[], %s::text[]) AS l(product, k) USING (product, k)
+            WHERE f.owner = %s
+            """
+        )
+        products, keys = zip(*lookup.pairs)
+        params.extend([list(products), list(keys), owner])
+    cur, timing = await db.db_exec(
+        f"""
+        SELECT json_object_agg(product, kv) FROM (
+            SELECT product, json_object_agg(k, v ORDER BY k) AS kv
+            FROM ({" UNION ".join(lookups)}) AS matches
+            GROUP BY product
+        ) AS p
+        """,
+        params,
+    )
+    out = await cur.fetchone()
+    return JSONResponse(
+        status_code=200,
+        content=out[0] if out and out[0] is not None else {},
         headers={"x-pg-timing": timing},
     )
 
@@ -964,13 +1591,142 @@ async def check_moderator_permission(user: User):
     return True
 
 
+# products having old and/or new property, old_product or new_product being NULL
+# if they have only one (params: old and new property names)
+CLASH_JOIN = """
+    SELECT old_prop.product AS old_product, new_prop.product AS new_product
+    FROM (SELECT product FROM folksonomy WHERE k = %s AND owner = '') AS old_prop
+    FULL OUTER JOIN (
+        SELECT product FROM folksonomy WHERE k = %s AND owner = ''
+    ) AS new_prop ON old_prop.product = new_prop.product
+"""
+
+CLASH_COUNTS = """
+    count(*) FILTER (
+        WHERE old_product IS NOT NULL AND new_product IS NOT NULL
+    ) AS products_with_both,
+    count(*) FILTER (
+        WHERE old_product IS NOT NULL AND new_product IS NULL
+    ) AS products_with_old_only,
+    count(*) FILTER (
+        WHERE old_product IS NULL AND new_product IS NOT NULL
+    ) AS products_with_new_only
+"""
+
+
+async def submit_job(kind: str, params: dict, user: User, not_found: str):
+    """Submit a background job, returning it with a 202 status"""
+    job = await jobs.submit(kind, params, user.user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=not_found)
+    return JSONResponse(status_code=202, content=job)
+
+
+@app.get("/admin/jobs", tags=["Admin - Jobs"])
+async def list_jobs(
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=1000),
+    user: User = Depends(get_current_user),
+):
+    """
+    List background jobs, most recent first, optionally filtered by status
+    (pending, running, paused, cancelled, failed or done)
+    """
+    await check_moderator_permission(user)
+    where, params = ("WHERE status = %s", [status]) if status else ("", [])
+    cur, timing = await db.db_exec(
+        f"""
+        SELECT coalesce(json_agg(j), '[]'::json) FROM (
+            SELECT {jobs.JOB_COLUMNS} FROM folksonomy_jobs
+            {where}
+            ORDER BY id DESC
+            LIMIT %s
+        ) AS j
+        """,
+        params + [limit],
+    )
+    out = await cur.fetchone()
+    return JSONResponse(content=out[0], headers={"x-pg-timing": timing})
+
+
+@app.get("/admin/jobs/{job_id}", tags=["Admin - Jobs"])
+async def get_job(job_id: int, user: User = Depends(get_current_user)):
+    """
+    Get a background job, with its progress: **processed** tags out of **total**
+    (counted at submission)
+    """
+    await check_moderator_permission(user)
+    cur, timing = await db.db_exec(
+        f"SELECT row_to_json(j) FROM (SELECT {jobs.JOB_COLUMNS} FROM folksonomy_jobs WHERE id = %s) AS j",
+        (job_id,),
+    )
+    out = await cur.fetchone()
+    if out is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(content=out[0], headers={"x-pg-timing": timing})
+
+
+async def change_job_status(
+    job_id: int, status: str, from_statuses, action: str, user: User
+):
+    await check_moderator_permission(user)
+    job = await jobs.set_status(job_id, status, from_statuses)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job is False:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Only {' or '.join(from_statuses)} jobs can be {action}",
+        )
+    return job
+
+
+@app.post("/admin/jobs/{job_id}/pause", tags=["Admin - Jobs"])
+async def pause_job(job_id: int, user: User = Depends(get_current_user)):
+    """
+    Pause a job, it stops after current batch
+    """
+    return await change_job_status(
+        job_id, "paused", ("pending", "running"), "paused", user
+    )
+
+
+@app.post("/admin/jobs/{job_id}/resume", tags=["Admin - Jobs"])
+async def resume_job(job_id: int, user: User = Depends(get_current_user)):
+    """
+    Resume a paused or failed job
+    """
+    return await change_job_status(
+        job_id, "pending", ("paused", "failed"), "resumed", user
+    )
+
+
+@app.post("/admin/jobs/{job_id}/cancel", tags=["Admin - Jobs"])
+async def cancel_job(job_id: int, user: User = Depends(get_current_user)):
+    """
+    Cancel a job, it stops after current batch (already processed batches are kept)
+    """
+    return await change_job_status(
+        job_id,
+        "cancelled",
+        ("pending", "running", "paused", "failed"),
+        "cancelled",
+        user,
+    )
+
+
 @app.post(
     "/admin/property/check-clash",
     response_model=PropertyClashCheck,
     tags=["Admin - Property Management"],
 )
 async def check_property_clash(
-    request: PropertyClashCheckRequest, user: User = Depends(get_current_user)
+    request: PropertyClashCheckRequest,
+    after: Optional[str] = Query(
+        None, description="list conflicting products after this one (next_after)"
+    ),
+    limit: int = Query(1000, ge=1, le=10000),
+    user: User = Depends(get_current_user),
 ):
     """
     Check for potential clashes when renaming a property
@@ -979,66 +1735,45 @@ async def check_property_clash(
     - **old_property**: The current property name
     - **new_property**: The target property name
 
-    Returns counts and list of conflicting products where both properties exist
+    Returns counts and list of conflicting products where both properties exist.
+    This list is paginated by product code, up to **limit** products:
+    when there are more, use **next_after** as **after** parameter to get next ones.
     """
     await check_moderator_permission(user)
 
-    # Check if old_property exists
+    # all counts in a single pass
     cur, timing = await db.db_exec(
-        """
-        SELECT COUNT(*) FROM folksonomy
-        WHERE k = %s AND owner = ''
+        f"""
+        SELECT {CLASH_COUNTS}
+        FROM ({CLASH_JOIN}) AS clash
         """,
-        (request.old_property,),
+        (request.old_property, request.new_property),
     )
-    old_property_count = (await cur.fetchone())[0]
-    if old_property_count == 0:
+    both_count, old_only_count, new_only_count = await cur.fetchone()
+    if both_count + old_only_count == 0:
         raise HTTPException(
             status_code=404, detail=f"Property '{request.old_property}' not found"
         )
 
-    # Find products that have both properties
+    # page of products that have both properties
     cur, timing = await db.db_exec(
         """
-        SELECT
-            old_prop.product,
-            old_prop.v as old_value,
-            new_prop.v as new_value
-        FROM
-            (SELECT product, v FROM folksonomy WHERE k = %s AND owner = '') as old_prop
-        INNER JOIN
-            (SELECT product, v FROM folksonomy WHERE k = %s AND owner = '') as new_prop
-        ON old_prop.product = new_prop.product
+        SELECT old_prop.product, old_prop.v, new_prop.v
+        FROM folksonomy AS old_prop
+        JOIN folksonomy AS new_prop
+            ON new_prop.product = old_prop.product
+            AND new_prop.k = %s AND new_prop.owner = ''
+        WHERE old_prop.k = %s AND old_prop.owner = '' AND old_prop.product > %s
+        ORDER BY old_prop.product
+        LIMIT %s
         """,
-        (request.old_property, request.new_property),
+        (request.new_property, request.old_property, after or "", limit + 1),
     )
     conflicting_products = await cur.fetchall()
-
-    # Count products with only old property
-    cur, timing = await db.db_exec(
-        """
-        SELECT COUNT(*) FROM folksonomy
-        WHERE k = %s AND owner = ''
-        AND product NOT IN (
-            SELECT product FROM folksonomy WHERE k = %s AND owner = ''
-        )
-        """,
-        (request.old_property, request.new_property),
-    )
-    old_only_count = (await cur.fetchone())[0]
-
-    # Count products with only new property
-    cur, timing = await db.db_exec(
-        """
-        SELECT COUNT(*) FROM folksonomy
-        WHERE k = %s AND owner = ''
-        AND product NOT IN (
-            SELECT product FROM folksonomy WHERE k = %s AND owner = ''
-        )
-        """,
-        (request.new_property, request.old_property),
-    )
-    new_only_count = (await cur.fetchone())[0]
+    next_after = None
+    if len(conflicting_products) > limit:
+        conflicting_products = conflicting_products[:limit]
+        next_after = conflicting_products[-1][0]
 
     # Format conflicting products list
     conflicts = []
@@ -1054,18 +1789,68 @@ async def check_property_clash(
     return JSONResponse(
         status_code=200,
         content=PropertyClashCheck(
-            products_with_both=len(conflicting_products),
+            products_with_both=both_count,
             products_with_old_only=old_only_count,
             products_with_new_only=new_only_count,
             conflicting_products=conflicts,
+            next_after=next_after,
         ).model_dump(),
         headers={"x-pg-timing": timing},
     )
 
 
+@app.post(
+    "/admin/property/check-clashes",
+    response_model=List[PropertyClashCounts],
+    tags=["Admin - Property Management"],
+)
+async def check_property_clashes(
+    request: PropertyClashesCheckRequest, user: User = Depends(get_current_user)
+):
+    """
+    Check clashes of many candidate renames at once, eg. to plan merges of keys
+
+    - **renames**: list of `{"old_property": ..., "new_property": ...}` (up to 1000)
+
+    Returns counts of products with both properties, or only one, for each rename,
+    in the same order.
+    """
+    await check_moderator_permission(user)
+    cur, timing = await db.db_exec(
+        f"""
+        SELECT coalesce(json_agg(j ORDER BY i), '[]'::json) FROM (
+            SELECT
+                renames.i,
+                renames.old_property,
+                renames.new_property,
+                {CLASH_COUNTS}
+            FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY
+                AS renames(old_property, new_property, i)
+            LEFT JOIN LATERAL (
+                {CLASH_JOIN % ("renames.old_property", "renames.new_property")}
+            ) AS clash ON true
+            GROUP BY renames.i, renames.old_property, renames.new_property
+        ) AS j
+        """,
+        (
+            [rename.old_property for rename in request.renames],
+            [rename.new_property for rename in request.renames],
+        ),
+    )
+    out = await cur.fetchone()
+    return JSONResponse(
+        content=[PropertyClashCounts(**counts).model_dump() for counts in out[0]],
+        headers={"x-pg-timing": timing},
+    )
+
+
 @app.post("/admin/property/rename", tags=["Admin - Property Management"])
 async def rename_property(
-    request: PropertyRenameRequest, user: User = Depends(get_current_user)
+    request: PropertyRenameRequest,
+    background: bool = Query(
+        False, description="run as a background job, see /admin/jobs"
+    ),
+    user: User = Depends(get_current_user),
 ):
     """
     Rename a property across all products
@@ -1076,8 +1861,16 @@ async def rename_property(
 
     - **old_property**: The current property name
     - **new_property**: The target property name
+    - **background**: run as a job, by batches, instead of in a single transaction
     """
     await check_moderator_permission(user)
+    if background:
+        return await submit_job(
+            "property_rename",
+            {"k": request.old_property, "new_k": request.new_property},
+            user,
+            f"Property '{request.old_property}' not found",
+        )
 
     try:
         # Check if old_property exists
@@ -1097,14 +1890,14 @@ async def rename_property(
         # Start transaction for all operations
         # First, handle products that have both properties
         cur, timing = await db.db_exec(
-            """
-            DELETE FROM folksonomy
+            f"""
+            DELETE FROM folksonomy USING {db.SET_EDITOR_USING}
             WHERE k = %s AND owner = ''
             AND product IN (
                 SELECT product FROM folksonomy WHERE k = %s AND owner = ''
             )
             """,
-            (request.old_property, request.new_property),
+            (user.user_id, request.old_property, request.new_property),
         )
         deleted_conflicting = cur.rowcount
 
@@ -1131,7 +1924,7 @@ async def rename_property(
             headers={"x-pg-timing": timing},
         )
 
-    except psycopg2.Error as e:
+    except db.DatabaseError as e:
         raise HTTPException(
             status_code=500, detail=f"Database error during property rename: {str(e)}"
         ) from e
@@ -1141,25 +1934,36 @@ async def rename_property(
 async def delete_property(
     response: Response,
     request: PropertyDeleteRequest,
+    background: bool = Query(
+        False, description="run as a background job, see /admin/jobs"
+    ),
     user: User = Depends(get_current_user),
 ):
     """
     Delete a property from all products
 
     - **property**: The property name to delete
+    - **background**: run as a job, by batches, instead of in a single transaction
     """
     await check_moderator_permission(user)
 
     property_name, _ = sanitize_data(request.property, None)
+    if background:
+        return await submit_job(
+            "property_delete",
+            {"k": property_name},
+            user,
+            f"Property '{property_name}' not found",
+        )
 
     try:
         # Delete all instances of the property
         cur, timing = await db.db_exec(
-            """
-            DELETE FROM folksonomy
+            f"""
+            DELETE FROM folksonomy USING {db.SET_EDITOR_USING}
             WHERE k = %s AND owner = ''
             """,
-            (property_name,),
+            (user.user_id, property_name),
         )
         deleted_count = cur.rowcount
 
@@ -1178,7 +1982,7 @@ async def delete_property(
             headers={"x-pg-timing": timing},
         )
 
-    except psycopg2.Error as e:
+    except db.DatabaseError as e:
         raise HTTPException(
             status_code=500, detail=f"Database error during property deletion: {str(e)}"
         ) from e
@@ -1208,7 +2012,11 @@ async def get_user_info(user: User = Depends(get_current_user)):
 
 @app.post("/admin/value/replace", tags=["Admin - Value Management"])
 async def replace_value(
-    request: ValueRenameRequest, user: User = Depends(get_current_user)
+    request: ValueRenameRequest,
+    background: bool = Query(
+        False, description="run as a background job, see /admin/jobs"
+    ),
+    user: User = Depends(get_current_user),
 ):
     """
     Replace a value for a specific property across all products
@@ -1216,8 +2024,16 @@ async def replace_value(
     - **property**: The property name
     - **old_value**: The value to replace
     - **new_value**: The new value
+    - **background**: run as a job, by batches, instead of in a single transaction
     """
     await check_moderator_permission(user)
+    if background:
+        return await submit_job(
+            "value_replace",
+            {"k": request.property, "v": request.old_value, "new_v": request.new_value},
+            user,
+            f"Value '{request.old_value}' not found for property '{request.property}'",
+        )
 
     try:
         cur, timing = await db.db_exec(
@@ -1246,7 +2062,7 @@ async def replace_value(
             headers={"x-pg-timing": timing},
         )
 
-    except psycopg2.Error as e:
+    except db.DatabaseError as e:
         raise HTTPException(
             status_code=500, detail=f"Database error during value rename: {str(e)}"
         ) from e
@@ -1254,24 +2070,36 @@ async def replace_value(
 
 @app.delete("/admin/value", tags=["Admin - Value Management"])
 async def delete_value(
-    request: ValueDeleteRequest, user: User = Depends(get_current_user)
+    request: ValueDeleteRequest,
+    background: bool = Query(
+        False, description="run as a background job, see /admin/jobs"
+    ),
+    user: User = Depends(get_current_user),
 ):
     """
     Delete a specific value for a property from all products
 
     - **property**: The property name
     - **value**: The value to delete
+    - **background**: run as a job, by batches, instead of in a single transaction
     """
     await check_moderator_permission(user)
+    if background:
+        return await submit_job(
+            "value_delete",
+            {"k": request.property, "v": request.value},
+            user,
+            f"Value '{request.value}' not found for property '{request.property}'",
+        )
 
     try:
         # Delete all instances of the specific value for this property
         cur, timing = await db.db_exec(
-            """
-            DELETE FROM folksonomy
+            f"""
+            DELETE FROM folksonomy USING {db.SET_EDITOR_USING}
             WHERE k = %s AND v = %s AND owner = ''
             """,
-            (request.property, request.value),
+            (user.user_id, request.property, request.value),
         )
         deleted_count = cur.rowcount
 
@@ -1291,7 +2119,7 @@ async def delete_value(
             headers={"x-pg-timing": timing},
         )
 
-    except psycopg2.Error as e:
+    except db.DatabaseError as e:
         raise HTTPException(
             status_code=500, detail=f"Database error during value deletion: {str(e)}"
         ) from e
@@ -0,0 +1,192 @@
+"""Shared http client to check credentials against Open Food Facts auth server
+
+Each worker keeps a single aiohttp session per event loop,
+so that DNS, TCP and TLS setup are paid once and connections are kept alive.
+Calls are bounded by strict timeouts and protected by a circuit breaker,
+and successful session cookie validations are cached for a short time.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+import weakref
+from collections import OrderedDict
+
+import aiohttp
+
+from . import settings
+
+
+log = logging.getLogger(__name__)
+
+sessions = weakref.WeakKeyDictionary()
+"""associate each event_loop with an http client session"""
+
+
+class AuthServerUnavailableError(Exception):
+    """Auth server did not answer in time, or is considered down"""
+
+
+class CircuitBreaker:
+    """Stop calling the auth server for a while after repeated failures
+
+    After AUTH_CIRCUIT_FAILURES consecutive failures the circuit opens
+    and calls fail immediately during AUTH_CIRCUIT_RESET_TIME seconds.
+    Then a single trial call is let through:
+    on success the circuit closes, on failure it opens again.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def before_call(self):
+        """Raise AuthServerUnavailableError if the call must not be made"""
+        if self.opened_at is None:
+            return
+        elapsed = time.monotonic() - self.opened_at
+        if elapsed < settings.AUTH_CIRCUIT_RESET_TIME or self.trial_running:
+            raise AuthServerUnavailableError("Auth server circuit is open")
+        self.trial_running = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.failures >= settings.AUTH_CIRCUIT_FAILURES:
+            if self.opened_at is None:
+                log.warning(
+                    "Auth server failed %s times, opening circuit", self.failures
+                )
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Call was interrupted without telling anything about the server"""
+        self.trial_running = False
+
+
+class SessionCache:
+    """Cache of successful session cookie validations, with a short time to live
+
+    Only a hash of the cookie is kept in memory.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(auth_url: str, session: str):
+        return hashlib.sha256(f"{auth_url}\0{session}".encode()).digest()
+
+    def get(self, auth_url: str, session: str):
+        key = self.key(auth_url, session)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        return data
+
+    def set(self, auth_url: str, session: str, data):
+        if settings.AUTH_SESSION_CACHE_TTL <= 0:
+            return
+        key = self.key(auth_url, session)
+        self.entries[key] = (time.monotonic() + settings.AUTH_SESSION_CACHE_TTL, data)
+        self.entries.move_to_end(key)
+        while len(self.entries) > settings.AUTH_SESSION_CACHE_SIZE:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+breaker = CircuitBreaker()
+session_cache = SessionCache()
+
+
+def _create_session():
+    connector = aiohttp.TCPConnector(
+        limit=settings.AUTH_POOL_SIZE,
+        keepalive_timeout=settings.AUTH_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        connect=settings.AUTH_CONNECT_TIMEOUT,
+        sock_read=settings.AUTH_READ_TIMEOUT,
+    )
+    # we never want a cookie from one user to be sent on behalf of another one
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar()
+    )
+
+
+def get_session():
+    """Get http session for current event loop, creating it if needed"""
+    loop = asyncio.get_running_loop()
+    _session = sessions.get(loop)
+    if _session is None or _session.closed:
+        _session = _create_session()
+        sessions[loop] = _session
+    return _session
+
+
+async def start():
+    """Create the http session, to be called at application startup"""
+    get_session()
+
+
+async def terminate():
+    """Close the http session of current event loop"""
+    loop = asyncio.get_running_loop()
+    _session = sessions.pop(loop, None)
+    if _session is not None:
+        await _session.close()
+
+
+async def post(auth_url: str, data: dict, cookies: dict = None):
+    """Post to auth server, returning status code and decoded json response
+
+    Raise AuthServerUnavailableError if the server can't be reached in time
+    or if the circuit breaker is open.
+    """
+    breaker.before_call()
+    try:
+        async with get_session().post(auth_url, data=data, cookies=cookies) as resp:
+            status_code = resp.status
+            try:
+                response_data = await resp.json()
+            except (aiohttp.ContentTypeError, ValueError):
+                response_data = {}
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breaker.record_failure()
+        raise AuthServerUnavailableError(f"Auth server error: {e!r}") from e
+    except BaseException:
+        breaker.release()
+        raise
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return status_code, response_data
+
+
+async def check_session_cookie(auth_url: str, session: str):
+    """Validate an Open Food Facts session cookie, using cache when possible"""
+    cached = session_cache.get(auth_url, session)
+    if cached is not None:
+        return 200, cached
+    status_code, response_data = await post(
+        auth_url, data={"body": "1"}, cookies={"session": session}
+    )
+    if status_code == 200:
+        session_cache.set(auth_url, session, response_data)
+    return status_code, response_data
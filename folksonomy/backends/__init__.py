@@ -0,0 +1,34 @@
+"""Database backends used by folksonomy.db
+
+A backend is a module providing:
+
+- ``async def create_pool(host=None)`` returning a connection pool
+  using POSTGRES_* settings, on host if given (used for read replicas)
+- ``async def close_pool(pool)``
+- ``transaction(pool)``, an async context manager yielding a cursor
+  inside a transaction (rolled back on error)
+
+Cursors expose the subset of the DB-API used by the application:
+``await execute(query, params)`` with ``%s`` placeholders,
+``rowcount``, ``await fetchone()`` and ``await fetchall()``.
+Errors raised by the database are turned into ``folksonomy.db.DatabaseError``.
+"""
+
+import importlib
+
+BACKENDS = {
+    "aiopg": "folksonomy.backends.aiopg_backend",
+    "asyncpg": "folksonomy.backends.asyncpg_backend",
+}
+
+
+def get_backend(name: str):
+    """Import and return the backend module registered under name"""
+    try:
+        module_name = BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown database backend %r, should be one of %s"
+            % (name, ", ".join(BACKENDS))
+        )
+    return importlib.import_module(module_name)
@@ -0,0 +1,58 @@
+"""aiopg backend, using psycopg2 text protocol"""
+
+import contextlib
+
+import aiopg
+import psycopg2
+
+from .. import db
+from .. import settings
+
+
+class Cursor:
+    """Thin wrapper around aiopg cursor, converting database errors"""
+
+    def __init__(self, cursor):
+        self._cur = cursor
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    async def execute(self, query, params=()):
+        try:
+            await self._cur.execute(query, params)
+        except psycopg2.Error as e:
+            raise db.DatabaseError(e.pgerror or str(e), e.pgcode) from e
+
+    async def fetchone(self):
+        return await self._cur.fetchone()
+
+    async def fetchall(self):
+        return await self._cur.fetchall()
+
+
+async def create_pool(host=None):
+    """Create a pool on host (POSTGRES_HOST by default)"""
+    return await aiopg.create_pool(
+        dbname=settings.POSTGRES_DATABASE,
+        user=settings.POSTGRES_USER,
+        password=settings.POSTGRES_PASSWORD,
+        host=host or settings.POSTGRES_HOST,
+        maxsize=settings.POSTGRES_POOL_SIZE,
+        async_=True,
+    )
+
+
+async def close_pool(pool):
+    pool.terminate()
+    await pool.wait_closed()
+
+
+@contextlib.asynccontextmanager
+async def transaction(pool):
+    async with pool.acquire() as _conn:
+        async with _conn.cursor() as _cur:
+            # begin returns a context manager handling the transaction with rollback on error
+            async with _cur.begin():
+                yield Cursor(_cur)
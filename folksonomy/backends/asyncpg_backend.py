@@ -0,0 +1,195 @@
+"""asyncpg backend, using PostgreSQL binary protocol and prepared statements
+
+Queries are written for psycopg2 (``%s`` placeholders),
+they are translated to asyncpg numbered placeholders (``$1``)
+and prepared statements are cached per connection by asyncpg.
+"""
+
+import contextlib
+import functools
+import json
+import re
+
+import asyncpg
+
+from .. import db
+from .. import settings
+
+
+re_placeholder = re.compile(r"%(%|s)")
+
+re_literal = re.compile(
+    r"""
+    \b[eE]'(?:[^'\\]|\\.|'')*'       # string with escapes
+    | '(?:[^']|'')*'                # string
+    | "(?:[^"]|"")*"                # quoted identifier
+    | (\$(?:[A-Za-z_]\w*)?\$)[\s\S]*?\1  # dollar quoted string
+    | --[^\n]*                      # comment
+    | /\*[\s\S]*?\*/                # comment
+    """,
+    re.VERBOSE,
+)
+
+MAX_QUERIES = 1024
+"""maximum number of queries in returns_rows, oldest ones are dropped"""
+
+returns_rows = {}
+"""whether queries return rows, learnt the first time they are run"""
+
+
+@functools.lru_cache(maxsize=1024)
+def translate_placeholders(query: str) -> str:
+    """Translate psycopg2 placeholders (%s) to asyncpg ones ($1, $2…)
+
+    ``%%`` is turned into a literal ``%``, as psycopg2 does.
+    """
+    counter = 0
+
+    def replace(match):
+        nonlocal counter
+        if match.group(1) == "%":
+            return "%"
+        counter += 1
+        return f"${counter}"
+
+    return re_placeholder.sub(replace, query)
+
+
+def is_multi_statement(query: str) -> bool:
+    """Whether query has semicolons between statements (not in strings or comments)"""
+    code = re_literal.sub(" ", query)
+    return ";" in code.strip().rstrip(";")
+
+
+def rowcount_from_status(status: str, rows) -> int:
+    """Compute DB-API rowcount from PostgreSQL command status (eg. 'UPDATE 3')"""
+    if rows:
+        return len(rows)
+    count = status.rsplit(" ", 1)[-1] if status else ""
+    return int(count) if count.isdigit() else -1
+
+
+def to_database_error(e: Exception) -> "db.DatabaseError":
+    """Convert error, formatting pgerror the same way libpq does
+
+    Errors of the client (eg. on arguments not matching the query) have no code.
+    """
+    if not isinstance(e, asyncpg.PostgresError):
+        return db.DatabaseError("ERROR:  %s\n" % e)
+    data = e.as_dict()
+    pgerror = "%s:  %s\n" % (
+        data.get("severity", "ERROR"),
+        data.get("message") or str(e),
+    )
+    for field, label in (
+        ("detail", "DETAIL"),
+        ("hint", "HINT"),
+        ("context", "CONTEXT"),
+    ):
+        if data.get(field):
+            pgerror += "%s:  %s\n" % (label, data[field])
+    return db.DatabaseError(pgerror, e.sqlstate)
+
+
+class Connection(asyncpg.Connection):
+    async def fetch_with_rowcount(self, query, args):
+        """Run query and return both the rows and the DB-API rowcount
+
+        The rowcount of UPDATE / DELETE statements is only given by their status,
+        returned by execute(), which does not return rows: queries are prepared
+        the first time, to know whether they return rows, then run with fetch()
+        or execute(), which both use the statement cache.
+        """
+        rows_expected = returns_rows.get(query)
+        if rows_expected is None:
+            statement = await self.prepare(query)
+            rows = await statement.fetch(*args)
+            if len(returns_rows) >= MAX_QUERIES:
+                del returns_rows[next(iter(returns_rows))]
+            returns_rows[query] = bool(statement.get_attributes())
+            return rows, rowcount_from_status(statement.get_statusmsg(), rows)
+        if rows_expected:
+            rows = await self.fetch(query, *args)
+            return rows, len(rows)
+        status = await self.execute(query, *args)
+        return [], rowcount_from_status(status, [])
+
+
+class Cursor:
+    """Minimal DB-API like cursor on top of an asyncpg connection"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self._rows = []
+        self._pos = 0
+
+    async def execute(self, query, params=()):
+        try:
+            if not params and is_multi_statement(query):
+                # simple query protocol is needed for multiple statements
+                rows = []
+                rowcount = rowcount_from_status(
+                    await self.connection.execute(query), []
+                )
+            else:
+                rows, rowcount = await self.connection.fetch_with_rowcount(
+                    translate_placeholders(query), params
+                )
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            raise to_database_error(e) from e
+        self._rows = rows
+        self._pos = 0
+        self.rowcount = rowcount
+
+    async def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    async def fetchall(self):
+        rows = self._rows[self._pos :]
+        self._pos = len(self._rows)
+        return rows
+
+
+async def init_connection(connection):
+    # decode json as psycopg2 does
+    for type_name in ("json", "jsonb"):
+        await connection.set_type_codec(
+            type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+        )
+
+
+async def reset_connection(connection):
+    # we only run transactions, which leave no session state behind,
+    # so we can avoid the round-trip of the default reset query on release
+    pass
+
+
+async def create_pool(host=None):
+    """Create a pool on host (POSTGRES_HOST by default)"""
+    return await asyncpg.create_pool(
+        database=settings.POSTGRES_DATABASE,
+        user=settings.POSTGRES_USER,
+        password=settings.POSTGRES_PASSWORD,
+        host=host or settings.POSTGRES_HOST,
+        min_size=1,
+        max_size=settings.POSTGRES_POOL_SIZE,
+        connection_class=Connection,
+        init=init_connection,
+        reset=reset_connection,
+    )
+
+
+async def close_pool(pool):
+    pool.terminate()
+
+
+@contextlib.asynccontextmanager
+async def transaction(pool):
+    async with pool.acquire() as _conn:
+        async with _conn.transaction():
+            yield Cursor(_conn)
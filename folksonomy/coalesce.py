@@ -0,0 +1,56 @@
+"""Single-flight: identical concurrent reads share one query
+
+When identical requests arrive together (eg. for a product on a page going viral),
+the first one runs the query, and those arriving while it runs wait for its result
+instead of running it again. They all get the same object, which must not be modified.
+
+Requests share a result only if their keys are equal, so keys must hold all
+that the result depends on: route, normalized parameters, owner, and the WAL position
+clients must see (x-pg-lsn). Private requests are checked before, so they only
+share results with requests of the same owner.
+"""
+
+import asyncio
+import weakref
+
+from . import settings
+
+flights = weakref.WeakKeyDictionary()
+"""associate each event loop with its running queries futures, by key"""
+
+
+async def run(key, fetch):
+    """Return await fetch(), or the result of a concurrent call with the same key
+
+    Errors of fetch are raised to all callers. If the call running fetch is cancelled,
+    the others run it themselves.
+    """
+    if not settings.COALESCE_READS:
+        return await fetch()
+    loop = asyncio.get_running_loop()
+    running = flights.setdefault(loop, {})
+    future = running.get(key)
+    if future is not None:
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # we are cancelled
+                raise
+        return await fetch()
+    future = running[key] = loop.create_future()
+    try:
+        result = await fetch()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        # it is retrieved by waiting calls, if any
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        del running[key]
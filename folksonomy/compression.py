@@ -0,0 +1,213 @@
+"""Response compression, negotiated with the Accept-Encoding header
+
+gzip is always available, brotli (br) and zstandard (zstd) are used if installed.
+Bodies smaller than COMPRESSION_MIN_SIZE are sent as is,
+large ones are compressed in a thread, not to block the event loop.
+Compressed bodies are kept in a cache keyed by their digest,
+so that a frequently requested payload is only compressed once.
+Only bodies seen before are cached, not to evict repeated payloads with one-off ones.
+"""
+
+import asyncio
+import collections
+import gzip
+import hashlib
+
+from . import settings
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+
+def _zstd_compress(body):
+    # compressors are not thread safe, so we use one per call
+    return zstandard.ZstdCompressor(level=3).compress(body)
+
+
+COMPRESSORS = {}
+"""compression function for each content-coding, by order of preference"""
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd_compress
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=5)
+COMPRESSORS["gzip"] = lambda body: gzip.compress(body, compresslevel=6, mtime=0)
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/msgpack", "+json")
+
+
+def negotiate(accept_encoding: str) -> str:
+    """Return the best supported content-coding of an Accept-Encoding header, or None
+
+    On equal quality, our order of preference (COMPRESSORS) is used.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding.lower()] = q
+    star = qualities.get("*", 0.0)
+    best, best_q = None, 0.0
+    for coding in COMPRESSORS:
+        q = qualities.get(coding, star)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    return any(
+        content_type.startswith(t) if t.endswith("/") else t in content_type
+        for t in COMPRESSIBLE_TYPES
+    )
+
+
+class CompressedCache:
+    """LRU of compressed bodies, limited by their total size (in bytes)
+
+    A body is only admitted the second time it is set:
+    the keys of the last MAX_SEEN bodies set once are remembered for that.
+    """
+
+    MAX_SEEN = 4096
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self._entries = collections.OrderedDict()
+        self._seen = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def set(self, key, value: bytes):
+        if len(value) > self.max_size:
+            return
+        if key not in self._entries and self._seen.pop(key, None) is None:
+            self._seen[key] = True
+            if len(self._seen) > self.MAX_SEEN:
+                self._seen.popitem(last=False)
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self._seen.clear()
+        self.size = 0
+        self.hits = 0
+
+
+cache = CompressedCache(settings.COMPRESSION_CACHE_SIZE)
+
+
+def _digest(body: bytes) -> bytes:
+    return hashlib.sha256(body).digest()
+
+
+async def compress(body: bytes, coding: str) -> bytes:
+    """Compress body using content-coding, using cache and a thread for large bodies"""
+    in_thread = len(body) >= settings.COMPRESSION_THREAD_SIZE
+    # large bodies are hashed in the thread too
+    digest = await asyncio.to_thread(_digest, body) if in_thread else _digest(body)
+    key = (coding, digest)
+    compressed = cache.get(key)
+    if compressed is None:
+        if in_thread:
+            compressed = await asyncio.to_thread(COMPRESSORS[coding], body)
+        else:
+            compressed = COMPRESSORS[coding](body)
+        cache.set(key, compressed)
+    return compressed
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses
+
+    Bodies are buffered until complete (responses go through BaseHTTPMiddleware,
+    which streams them in chunks), our responses being built in memory anyway.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        start_message = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    await self.send_response(
+                        start_message, b"".join(chunks), accept_encoding, send
+                    )
+            else:
+                await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    async def send_response(self, start_message, body, accept_encoding, send):
+        headers = start_message.get("headers", [])
+        header_names = {name for name, _ in headers}
+        content_type = dict(headers).get(b"content-type", b"").decode("latin-1")
+        if (
+            len(body) >= settings.COMPRESSION_MIN_SIZE
+            and b"content-encoding" not in header_names
+            and is_compressible(content_type)
+        ):
+            vary = [v for n, v in headers if n == b"vary"]
+            varying = {f.strip().lower() for v in vary for f in v.split(b",")}
+            if not varying & {b"accept-encoding", b"*"}:
+                headers = [(n, v) for n, v in headers if n != b"vary"]
+                headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+            coding = negotiate(accept_encoding)
+            if coding is not None:
+                body = await compress(body, coding)
+                headers = [(n, v) for n, v in headers if n != b"content-length"]
+                headers.append((b"content-encoding", coding.encode("latin-1")))
+                headers.append((b"content-length", str(len(body)).encode("latin-1")))
+            start_message = dict(start_message, headers=headers)
+        await send(start_message)
+        await send({"type": "http.response.body", "body": body})
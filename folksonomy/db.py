@@ -2,26 +2,33 @@ import asyncio
 import contextlib
 import contextvars
 import logging
+import re
 import time
 import weakref
 
-
-import aiopg  # interface with postgresql
-
-# import psycopg2     # interface with postgresql
-
 from . import models
 from . import settings
+from .backends import get_backend
 
 
 log = logging.getLogger(__name__)
 
+UNIQUE_VIOLATION = "23505"
+"""PostgreSQL error code for unique constraint violations"""
+
 conn = weakref.WeakKeyDictionary()
-"""associate each event_loop with a connection pool"""
+"""associate each event_loop with its connection pools"""
 
-cur = contextvars.ContextVar("cur")
+cur = contextvars.ContextVar("cur", default=None)
 """a context variable for current cursor"""
-cur.set(None)
+
+on_replica = contextvars.ContextVar("on_replica", default=False)
+"""a context variable telling if current cursor is on a read replica"""
+
+re_lsn = re.compile(r"^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$")
+
+REPLICA_POLL_INTERVAL = 0.01
+"""time (in seconds) between two checks of replica replay position"""
 
 
 class NotInTransactionError(Exception):
@@ -32,20 +39,64 @@ class NotInAsyncIOError(Exception):
     """Trying to use connection outside of asyncio context"""
 
 
+class DatabaseError(Exception):
+    """Error reported by the database, whatever the backend
+
+    pgerror is formatted as libpq does, eg. "ERROR:  message\nCONTEXT:  ...\n"
+    and pgcode is the PostgreSQL error code
+    """
+
+    def __init__(self, pgerror: str, pgcode: str = None):
+        super().__init__(pgerror)
+        self.pgerror = pgerror
+        self.pgcode = pgcode
+
+    @property
+    def is_unique_violation(self):
+        return self.pgcode == UNIQUE_VIOLATION
+
+    @property
+    def trigger_message(self):
+        """Message raised by our triggers (between @@), or full error otherwise"""
+        return re.sub(r".*@@ (.*) @@\n.*$", r"\1", self.pgerror)[:-1]
+
+
+class Pools:
+    """Connection pools of an event loop, on the primary and on read replicas"""
+
+    def __init__(self, backend, primary, replicas):
+        self.backend = backend
+        self.primary = primary
+        self.replicas = replicas
+        self._next_replica = 0
+
+    def replica(self):
+        """Pick next replica pool, round robin"""
+        pool = self.replicas[self._next_replica % len(self.replicas)]
+        self._next_replica += 1
+        return pool
+
+    async def close(self):
+        for pool in [self.primary] + self.replicas:
+            await self.backend.close_pool(pool)
+
+
 async def get_conn():
-    """Get current database connection, creating it if needed"""
+    """Get current database connection pools, creating them if needed"""
     global conn
     loop = asyncio.get_running_loop()
     if loop is None:
         raise NotInAsyncIOError("This method only works with asyncio")
     _conn = conn.get(loop)
     if _conn is None:
-        _conn = await aiopg.create_pool(
-            dbname=settings.POSTGRES_DATABASE,
-            user=settings.POSTGRES_USER,
-            password=settings.POSTGRES_PASSWORD,
-            host=settings.POSTGRES_HOST,
-            async_=True,
+        backend = get_backend(settings.DB_BACKEND)
+        _conn = Pools(
+            backend,
+            await backend.create_pool(),
+            [
+                await backend.create_pool(host)
+                for host in settings.POSTGRES_REPLICA_HOSTS
+            ],
         )
         conn[loop] = _conn
     return _conn
@@ -59,36 +110,91 @@ def cursor():
     return cur.get()
 
 
+def in_replica():
+    """Tell if current transaction runs on a read replica (thus is read only)"""
+    return on_replica.get()
+
+
 async def terminate():
     """Close all database connection"""
     global conn
     loop = asyncio.get_running_loop()
     _conn = conn.get(loop)
     if _conn is not None:
-        _conn.terminate()
+        await _conn.close()
         del conn[loop]
 
 
+def is_valid_lsn(lsn):
+    """Check lsn has the textual form of a pg_lsn, eg. '16/B374D848'"""
+    return bool(lsn and re_lsn.match(lsn))
+
+
+async def wait_for_lsn(_cur, lsn):
+    """Wait for the server of _cur to have replayed WAL up to lsn
+
+    Return False if it did not within REPLICA_WAIT_TIMEOUT.
+    On a server which is not a standby, current WAL position is used instead.
+    """
+    deadline = time.monotonic() + settings.REPLICA_WAIT_TIMEOUT
+    while True:
+        await _cur.execute(
+            "SELECT coalesce(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) "
+            ">= %s::text::pg_lsn",
+            (lsn,),
+        )
+        if (await _cur.fetchone())[0]:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(REPLICA_POLL_INTERVAL)
+
+
+async def primary_lsn():
+    """Current WAL position of the primary, to be given back by clients after writes"""
+    async with transaction():
+        cur, _ = await db_exec("SELECT pg_current_wal_lsn()::text")
+        return (await cur.fetchone())[0]
+
+
 @contextlib.asynccontextmanager
-async def transaction():
-    """Context manager creating cursor in a transaction"""
-    global cur
-    global conn
+async def _use_cursor(_cur, replica=False):
+    cur_token = cur.set(_cur)
+    replica_token = on_replica.set(replica)
     try:
-        _pool = await get_conn()
-        async with _pool.acquire() as _conn:
-            async with _conn.cursor() as _cur:
-                # begin returns a context manager handling the transaction with rollback on error
-                async with _cur.begin():
-                    cur.set(_cur)
-                    yield _cur
+        yield _cur
     finally:
-        cur.set(None)
+        cur.reset(cur_token)
+        on_replica.reset(replica_token)
+
+
+@contextlib.asynccontextmanager
+async def transaction(readonly=False, min_lsn=None):
+    """Context manager creating cursor in a transaction
+
+    With readonly=True, the transaction runs on a read replica if some are configured.
+    If min_lsn is given, the replica must have replayed WAL up to it
+    (so that clients read their own writes), otherwise we fall back to the primary.
+    """
+    global conn
+    pools = await get_conn()
+    if readonly and pools.replicas:
+        async with pools.backend.transaction(pools.replica()) as _cur:
+            if not is_valid_lsn(min_lsn) or await wait_for_lsn(_cur, min_lsn):
+                async with _use_cursor(_cur, replica=True):
+                    yield _cur
+                return
+        log.info("Replica did not replay %s in time, using primary", min_lsn)
+    async with pools.backend.transaction(pools.primary) as _cur:
+        async with _use_cursor(_cur):
+            yield _cur
 
 
 async def db_exec(query, params=()):
     """
     Execute postgresql query and collect timing
+
+    Raise DatabaseError on database errors
     """
     t = time.monotonic()
     cur = cursor()
@@ -132,3 +238,86 @@ def update_product_tag_req(product_tag: models.ProductTag):
             product_tag.k.lower(),
         ),
     )
+
+
+def compare_and_set_product_tag_req(product_tag: models.ProductTag):
+    """Request and params to update a product tag if its version is product_tag.version - 1
+
+    In one statement, it returns the version found before update (NULL if tag is missing)
+    and the new version (NULL if not updated, because of a version conflict).
+    """
+    key = (product_tag.product, product_tag.owner, product_tag.k.lower())
+    return (
+        """
+        WITH current AS (
+            SELECT version FROM folksonomy
+            WHERE product = %s AND owner = %s AND k = %s
+        ), updated AS (
+            UPDATE folksonomy SET v = %s, version = %s, editor = %s, comment = %s
+            WHERE product = %s AND owner = %s AND k = %s AND version = %s
+            RETURNING version
+        )
+        SELECT (SELECT version FROM current), (SELECT version FROM updated)
+        """,
+        key
+        + (product_tag.v, product_tag.version, product_tag.editor, product_tag.comment)
+        + key
+        + (product_tag.version - 1,),
+    )
+
+
+def upsert_product_tag_req(product_tag: models.ProductTag, create_only=False):
+    """Request and params to create a product tag, or update it if it exists
+
+    Version is set to 1 on creation, incremented on update. The new version is returned,
+    no row is returned if the tag exists and create_only is True.
+    """
+    return (
+        """
+        INSERT INTO folksonomy (product,k,v,owner,version,editor,comment)
+            VALUES (%s,%s,%s,%s,1,%s,%s)
+        ON CONFLICT (product, owner, k) DO UPDATE
+            SET v = EXCLUDED.v, version = folksonomy.version + 1,
+                editor = EXCLUDED.editor, comment = EXCLUDED.comment
+            WHERE NOT %s
+        RETURNING version
+        """,
+        (
+            product_tag.product,
+            product_tag.k.lower(),
+            product_tag.v,
+            product_tag.owner,
+            product_tag.editor,
+            product_tag.comment,
+            create_only,
+        ),
+    )
+
+
+SET_EDITOR_USING = "(SELECT set_config('folksonomy.editor', %s, true)) AS set_editor"
+"""to use in DELETE ... USING, to give deleting user to the archiving trigger
+
+The trigger resets it, so every DELETE must set it to record its own user.
+"""
+
+
+def delete_product_tag_req(product, owner, k, version, editor):
+    """Request and params to delete a product tag if it has this version
+
+    In one statement, it returns the version found before deletion (NULL if tag is
+    missing) and the deleted version (NULL if not deleted, because of a version conflict).
+    """
+    return (
+        f"""
+        WITH current AS (
+            SELECT version FROM folksonomy
+            WHERE product = %s AND owner = %s AND k = %s
+        ), deleted AS (
+            DELETE FROM folksonomy USING {SET_EDITOR_USING}
+            WHERE product = %s AND owner = %s AND k = %s AND version = %s
+            RETURNING version
+        )
+        SELECT (SELECT version FROM current), (SELECT version FROM deleted)
+        """,
+        (product, owner, k.lower(), editor, product, owner, k.lower(), version),
+    )
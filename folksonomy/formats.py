@@ -0,0 +1,104 @@
+"""Response formats for lists of rows, negotiated with the Accept header
+
+Besides JSON arrays of objects (the default), rows can be returned:
+
+- as columnar JSON (``application/vnd.folksonomy.columnar+json``):
+  ``{"product": [...], "k": [...], "v": [...]}``, so that field names appear only once
+- as MessagePack (``application/msgpack``), with the same columnar shape
+  (needs msgpack to be installed)
+"""
+
+import datetime
+import json
+
+from fastapi import Response
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.folksonomy.columnar+json"
+MSGPACK = "application/msgpack"
+
+MEDIA_TYPES = {
+    JSON: JSON,
+    "application/*": JSON,
+    "*/*": JSON,
+    COLUMNAR_JSON: COLUMNAR_JSON,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+}
+
+ROWS_RESPONSES = {
+    200: {
+        "content": {
+            COLUMNAR_JSON: {},
+            MSGPACK: {},
+        },
+        "description": "Rows, as JSON objects by default, "
+        "or columns if asked for in Accept header",
+    }
+}
+"""to document alternative formats of an endpoint in OpenAPI"""
+
+
+def negotiate(accept: str = None) -> str:
+    """Return the supported media type preferred by the Accept header (JSON by default)
+
+    On equal quality, exact media types are preferred over wildcards,
+    then the first one wins.
+    """
+    if not accept:
+        return JSON
+    best, best_rank = JSON, (0.0, 0)
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        fmt = MEDIA_TYPES.get(media_type.lower())
+        if fmt is None or (fmt == MSGPACK and msgpack is None):
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        # */* is less specific than application/*, itself less specific than exact types
+        rank = (q, 2 - media_type.count("*"))
+        if q > 0 and rank > best_rank:
+            best, best_rank = fmt, rank
+    return best
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def to_columns(names, rows) -> dict:
+    """Turn rows (tuples) into a dict of columns"""
+    if not rows:
+        return {name: [] for name in names}
+    return dict(zip(names, map(list, zip(*rows))))
+
+
+def encode_columns(columns: dict, media_type: str) -> bytes:
+    if media_type == MSGPACK:
+        return msgpack.packb(columns, default=_default)
+    return json.dumps(
+        columns, default=_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def columnar_response(names, rows, media_type: str, headers: dict = None):
+    """Response with rows (tuples of values for names) in columnar media_type"""
+    headers = dict(headers or {}, Vary="Accept")
+    return Response(
+        content=encode_columns(to_columns(names, rows), media_type),
+        media_type=media_type,
+        headers=headers,
+    )
@@ -0,0 +1,86 @@
+"""HyperLogLog sketches, to estimate numbers of distinct values in constant space
+
+A sketch has REGISTERS registers, each keeping the maximum rank (position of the
+first 1 bit) of hashes of values falling in it. Sketches are merged by taking
+the maximum of each register, so they can be updated incrementally.
+
+Estimates have a relative standard error of ERROR (1.04 / sqrt(REGISTERS), about
+1.6%), that is within 3.3% for 95% of them. Small counts (up to a few hundreds)
+are nearly exact, thanks to linear counting.
+
+Sketches are stored sparse (3 bytes per used register) as long as they are smaller
+than the dense form (one byte per register, 4 KB).
+"""
+
+import hashlib
+import math
+import struct
+
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+ERROR = 1.04 / math.sqrt(REGISTERS)
+"""relative standard error of estimates"""
+
+_ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+_RANK_BITS = 64 - PRECISION
+_SPARSE = b"\x00"
+_DENSE = b"\x01"
+
+
+def hash64(value: str) -> int:
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HyperLogLog:
+    def __init__(self, values=()):
+        self.registers = {}
+        """rank by register index, for used registers only"""
+        self.update(values)
+
+    def add(self, value: str):
+        h = hash64(value)
+        index = h >> _RANK_BITS
+        rank = _RANK_BITS - (h & ((1 << _RANK_BITS) - 1)).bit_length() + 1
+        if rank > self.registers.get(index, 0):
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: "HyperLogLog"):
+        registers = self.registers
+        for index, rank in other.registers.items():
+            if rank > registers.get(index, 0):
+                registers[index] = rank
+
+    def estimate(self) -> int:
+        zeros = REGISTERS - len(self.registers)
+        total = zeros + sum(2.0**-rank for rank in self.registers.values())
+        estimate = _ALPHA * REGISTERS * REGISTERS / total
+        if estimate <= 2.5 * REGISTERS and zeros:
+            # linear counting, more accurate for small cardinalities
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return round(estimate)
+
+    def to_bytes(self) -> bytes:
+        if 3 * len(self.registers) < REGISTERS:
+            items = sorted(self.registers.items())
+            return _SPARSE + b"".join(struct.pack(">HB", *item) for item in items)
+        dense = bytearray(REGISTERS)
+        for index, rank in self.registers.items():
+            dense[index] = rank
+        return _DENSE + bytes(dense)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        sketch = cls()
+        data = bytes(data)
+        if data[:1] == _DENSE:
+            sketch.registers = {
+                index: rank for index, rank in enumerate(data[1:]) if rank
+            }
+        else:
+            sketch.registers = dict(struct.iter_unpack(">HB", data[1:]))
+        return sketch
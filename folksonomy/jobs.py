@@ -0,0 +1,245 @@
+"""Background jobs for admin bulk operations on public tags
+
+Jobs are stored in folksonomy_jobs table, and run by a worker task
+in each API process. A job works by batches of JOBS_BATCH_SIZE tags,
+each in its own transaction, locking rows with FOR UPDATE SKIP LOCKED,
+so that users edits are never blocked for long.
+As remaining tags are selected again by each batch, a job can be paused, resumed,
+or taken over by another worker if its process died.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import weakref
+
+from . import db
+from . import settings
+
+log = logging.getLogger(__name__)
+
+KINDS = ("property_rename", "property_delete", "value_replace", "value_delete")
+"""kinds of jobs, params always have k (and v for values) to select tags,
+and new_k (property_rename) or new_v (value_replace)"""
+
+JOB_COLUMNS = (
+    "id, kind, params, status, editor, total, processed, error, created, updated"
+)
+
+workers = weakref.WeakKeyDictionary()
+"""associate each event loop with its worker task"""
+
+
+def _where(params):
+    """SQL condition and args selecting tags of a job"""
+    where, args = "owner = '' AND k = %s", [params["k"]]
+    if "v" in params:
+        where += " AND v = %s"
+        args.append(params["v"])
+    if "new_v" in params:
+        # replaced tags must not be selected again
+        where += " AND v <> %s"
+        args.append(params["new_v"])
+    return where, args
+
+
+async def submit(kind: str, params: dict, editor: str):
+    """Create a job in current transaction, returning it, or None if no tag is concerned"""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown job kind {kind}")
+    where, args = _where(params)
+    cur, _ = await db.db_exec(f"SELECT count(*) FROM folksonomy WHERE {where}", args)
+    total = (await cur.fetchone())[0]
+    if total == 0:
+        return None
+    # params are given as text, not to be encoded again by drivers json adapters
+    cur, _ = await db.db_exec(
+        f"""
+        WITH j AS (
+            INSERT INTO folksonomy_jobs (kind, params, editor, total)
+            VALUES (%s, %s::text::jsonb, %s, %s)
+            RETURNING {JOB_COLUMNS}
+        )
+        SELECT row_to_json(j) FROM j
+        """,
+        (kind, json.dumps(params), editor, total),
+    )
+    return (await cur.fetchone())[0]
+
+
+async def set_status(job_id: int, status: str, from_statuses):
+    """Change status of a job if it is in one of from_statuses, returning the job
+
+    Return None if job does not exist, or False if its status does not permit change.
+    """
+    cur, _ = await db.db_exec(
+        f"""
+        WITH job AS (SELECT status FROM folksonomy_jobs WHERE id = %s),
+        updated AS (
+            UPDATE folksonomy_jobs
+            SET status = %s, updated = current_timestamp AT TIME ZONE 'GMT'
+            WHERE id = %s AND status = ANY(%s::text[])
+            RETURNING {JOB_COLUMNS}
+        )
+        SELECT (SELECT status FROM job), (SELECT row_to_json(u) FROM updated AS u)
+        """,
+        (job_id, status, job_id, list(from_statuses)),
+    )
+    current_status, job = await cur.fetchone()
+    if current_status is None:
+        return None
+    return job or False
+
+
+async def _claim():
+    """Take next job to run, if any"""
+    async with db.transaction():
+        cur, _ = await db.db_exec(
+            """
+            UPDATE folksonomy_jobs
+            SET status = 'running', updated = current_timestamp AT TIME ZONE 'GMT'
+            WHERE id = (
+                SELECT id FROM folksonomy_jobs
+                WHERE status = 'pending' OR (
+                    status = 'running'
+                    AND updated < current_timestamp AT TIME ZONE 'GMT'
+                        - make_interval(secs => %s)
+                )
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, params, editor
+            """,
+            (settings.JOBS_LEASE_TIME,),
+        )
+        return await cur.fetchone()
+
+
+async def _run_batch(kind, params, editor):
+    """Process a batch of tags, returning how many were processed (0 when finished)
+
+    Return None if the only tags left are locked by other transactions.
+    """
+    where, args = _where(params)
+    cur, _ = await db.db_exec(
+        f"""
+        SELECT product FROM folksonomy WHERE {where}
+        LIMIT %s FOR UPDATE SKIP LOCKED
+        """,
+        args + [settings.JOBS_BATCH_SIZE],
+    )
+    products = [row[0] for row in await cur.fetchall()]
+    if not products:
+        cur, _ = await db.db_exec(
+            f"SELECT EXISTS (SELECT 1 FROM folksonomy WHERE {where})", args
+        )
+        return None if (await cur.fetchone())[0] else 0
+    batch_where = where + " AND product = ANY(%s)"
+    args.append(products)
+    if kind == "property_rename":
+        # like the synchronous rename, existing new property wins
+        await db.db_exec(
+            f"""
+            DELETE FROM folksonomy USING {db.SET_EDITOR_USING}
+            WHERE {batch_where} AND product IN (
+                SELECT product FROM folksonomy
+                WHERE owner = '' AND k = %s AND product = ANY(%s)
+            )
+            """,
+            [editor] + args + [params["new_k"], products],
+        )
+        await db.db_exec(
+            f"""
+            UPDATE folksonomy SET k = %s, editor = %s, version = version + 1
+            WHERE {batch_where}
+            """,
+            [params["new_k"], editor] + args,
+        )
+    elif kind == "value_replace":
+        await db.db_exec(
+            f"""
+            UPDATE folksonomy SET v = %s, editor = %s, version = version + 1
+            WHERE {batch_where}
+            """,
+            [params["new_v"], editor] + args,
+        )
+    else:
+        await db.db_exec(
+            f"DELETE FROM folksonomy USING {db.SET_EDITOR_USING} WHERE {batch_where}",
+            [editor] + args,
+        )
+    return len(products)
+
+
+async def run_job(job_id, kind, params, editor):
+    """Run job batch after batch, until it is done, paused or cancelled"""
+    while True:
+        try:
+            async with db.transaction():
+                cur, _ = await db.db_exec(
+                    "SELECT status FROM folksonomy_jobs WHERE id = %s FOR UPDATE",
+                    (job_id,),
+                )
+                row = await cur.fetchone()
+                if row is None or row[0] != "running":
+                    return
+                processed = await _run_batch(kind, params, editor)
+                await db.db_exec(
+                    """
+                    UPDATE folksonomy_jobs
+                    SET processed = processed + %s, status = %s,
+                        updated = current_timestamp AT TIME ZONE 'GMT'
+                    WHERE id = %s
+                    """,
+                    (processed or 0, "running" if processed != 0 else "done", job_id),
+                )
+        except db.DatabaseError as e:
+            log.error("Job %s failed: %s", job_id, e)
+            async with db.transaction():
+                await db.db_exec(
+                    """
+                    UPDATE folksonomy_jobs
+                    SET status = 'failed', error = %s,
+                        updated = current_timestamp AT TIME ZONE 'GMT'
+                    WHERE id = %s
+                    """,
+                    (str(e), job_id),
+                )
+            return
+        if processed == 0:
+            return
+        if processed is None:
+            # remaining tags are being edited, retry later
+            await asyncio.sleep(settings.JOBS_POLL_INTERVAL)
+
+
+async def worker():
+    """Run jobs as they come"""
+    while True:
+        try:
+            job = await _claim()
+            if job is not None:
+                await run_job(*job)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error in jobs worker")
+        await asyncio.sleep(settings.JOBS_POLL_INTERVAL)
+
+
+def start():
+    """Start jobs worker, if enabled"""
+    if settings.JOBS_WORKER:
+        workers[asyncio.get_running_loop()] = asyncio.create_task(worker())
+
+
+async def terminate():
+    """Stop jobs worker, a running job will be resumed later"""
+    task = workers.pop(asyncio.get_running_loop(), None)
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
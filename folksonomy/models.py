@@ -1,12 +1,19 @@
 import re
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Union
 
-from pydantic import BaseModel, model_validator, field_validator
+from pydantic import BaseModel, ConfigDict, Field, model_validator, field_validator
 
 re_barcode = re.compile(r"[0-9]{1,24}")
 re_key = re.compile(r"[a-z0-9_-]+(\:[a-z0-9_-]+)*")
 
+# maximum number of codes or pairs in a values lookup
+MAX_LOOKUP_ITEMS = 50000
+# maximum number of tags in a batch deletion
+MAX_BATCH_DELETE = 10000
+# maximum number of conditions on properties in a products query
+MAX_QUERY_CONDITIONS = 32
+
 
 def strip_and_check(v: str) -> str:
     v = v.strip()
@@ -62,6 +69,16 @@ class ProductTag(BaseModel):
         return version
 
 
+class ProductTagVersion(BaseModel):
+    product: str
+    k: str
+    version: int
+
+    @field_validator("product", "k")
+    def strip(cls, v):
+        return v.strip()
+
+
 class ProductStats(BaseModel):
     product: str
     keys: int
@@ -160,11 +177,17 @@ class ValueRenameRequest(BaseModel):
             raise ValueError("property must be alpha-numeric [a-z0-9_-:]")
         return v
 
-    @field_validator("new_value")
-    def new_value_check(cls, v):
+    @field_validator("old_value", "new_value")
+    def value_check(cls, v):
         v = strip_and_check(v)
         return v
 
+    @model_validator(mode="after")
+    def check_not_same(self):
+        if self.old_value == self.new_value:
+            raise ValueError("old_value and new_value should not be the same.")
+        return self
+
 
 class ValueDeleteRequest(BaseModel):
     property: str
@@ -183,8 +206,144 @@ class ValueDeleteRequest(BaseModel):
         return v
 
 
+class PropertyClashCounts(BaseModel):
+    old_property: str
+    new_property: str
+    products_with_both: int
+    products_with_old_only: int
+    products_with_new_only: int
+
+
 class PropertyClashCheck(BaseModel):
     products_with_both: int
     products_with_old_only: int
     products_with_new_only: int
     conflicting_products: list
+    next_after: Optional[str] = None
+
+
+class PropertyClashesCheckRequest(BaseModel):
+    renames: list[PropertyClashCheckRequest] = Field(min_length=1, max_length=1000)
+
+
+class ValuesLookupRequest(BaseModel):
+    codes: list[str] = Field(
+        default=[],
+        max_length=MAX_LOOKUP_ITEMS,
+        description="products for which to get all values (or values of keys)",
+    )
+    keys: list[str] = Field(
+        default=[],
+        max_length=1000,
+        description="restrict values of codes to these keys",
+    )
+    pairs: list[tuple[str, str]] = Field(
+        default=[],
+        max_length=MAX_LOOKUP_ITEMS,
+        description="exact [product, k] pairs to get the value of",
+    )
+
+    @field_validator("codes", "keys")
+    def strip_items(cls, v):
+        return [item.strip() for item in v]
+
+    @field_validator("pairs")
+    def strip_pairs(cls, v):
+        return [(product.strip(), k.strip()) for product, k in v]
+
+    @model_validator(mode="after")
+    def check_not_empty(self):
+        if not self.codes and not self.pairs:
+            raise ValueError("At least one of 'codes' or 'pairs' must be provided")
+        return self
+
+
+class PropertyCondition(BaseModel):
+    """Products having property k, with value v if given"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    k: str
+    v: Optional[str] = None
+
+    @field_validator("k")
+    def k_check(cls, v):
+        return strip_and_check(v)
+
+    @field_validator("v")
+    def v_strip(cls, v):
+        return v.strip() if v is not None else v
+
+
+class AndCondition(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    and_: list["Condition"] = Field(alias="and", min_length=1)
+
+
+class OrCondition(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    or_: list["Condition"] = Field(alias="or", min_length=1)
+
+
+class NotCondition(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    not_: "Condition" = Field(alias="not")
+
+
+Condition = Union[PropertyCondition, AndCondition, OrCondition, NotCondition]
+
+
+def property_conditions(condition: Condition):
+    """All property conditions of a condition"""
+    if isinstance(condition, PropertyCondition):
+        yield condition
+    elif isinstance(condition, NotCondition):
+        yield from property_conditions(condition.not_)
+    else:
+        for child in getattr(condition, "and_", None) or condition.or_:
+            yield from property_conditions(child)
+
+
+class ProductsQueryRequest(BaseModel):
+    query: Condition = Field(
+        description='eg. {"and": [{"k": "color", "v": "red"}, {"not": {"k": "size"}}]}'
+    )
+
+    @model_validator(mode="after")
+    def check_size(self):
+        if len(list(property_conditions(self.query))) > MAX_QUERY_CONDITIONS:
+            raise ValueError(
+                f"A query can't have more than {MAX_QUERY_CONDITIONS} conditions on properties"
+            )
+        return self
+
+
+class ProductsQueryResult(BaseModel):
+    products: list[str]
+    next_after: Optional[str] = None
+
+
+class ProductHistory(BaseModel):
+    results: list[ProductTag]
+    next_after: Optional[str] = None
+
+
+class SearchMatch(BaseModel):
+    product: str
+    k: str
+    v: str
+    rank: float
+
+
+class SearchResult(BaseModel):
+    results: list[SearchMatch]
+    next_after: Optional[str] = None
+
+
+class WriteTicket(BaseModel):
+    ticket: str
+    status: str
+    error: Optional[str] = None
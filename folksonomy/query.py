@@ -0,0 +1,119 @@
+"""Compile boolean queries on products properties into SQL
+
+Each condition on a property (k exists, or k=v) selects products with an index
+only scan, and conditions are combined with INTERSECT (and), UNION (or)
+and EXCEPT or anti-joins (not).
+Conditions of an "and" are intersected by increasing number of matching products,
+estimated from keys statistics (see stats): most selective first.
+A "not" excludes products from other conditions of its "and": it is an anti-join
+(a lookup by product) if those match fewer products than the excluded condition,
+otherwise an EXCEPT.
+"""
+
+import math
+
+from . import db
+from .models import (
+    AndCondition,
+    Condition,
+    NotCondition,
+    OrCondition,
+    PropertyCondition,
+    property_conditions,
+)
+
+
+class QueryError(ValueError):
+    """A query that can't be compiled"""
+
+
+async def keys_stats(owner: str, condition: Condition) -> dict:
+    """Tags count and estimated number of values of keys in condition"""
+    keys = sorted({c.k for c in property_conditions(condition)})
+    cur, _ = await db.db_exec(
+        """
+        SELECT k, tags, estimate FROM folksonomy_key_stats
+        WHERE owner = %s AND k = ANY(%s::text[])
+        """,
+        (owner, keys),
+    )
+    return {k: (tags, values) for k, tags, values in await cur.fetchall()}
+
+
+def estimate(condition: Condition, stats: dict) -> float:
+    """Estimated number of products matching condition (infinite for a not)"""
+    if isinstance(condition, PropertyCondition):
+        # keys unknown to statistics are most likely new or unused
+        tags, values = stats.get(condition.k, (0, 0))
+        return tags if condition.v is None else tags / max(values, 1)
+    if isinstance(condition, AndCondition):
+        return min(estimate(child, stats) for child in condition.and_)
+    if isinstance(condition, OrCondition):
+        return sum(estimate(child, stats) for child in condition.or_)
+    return math.inf
+
+
+def _property_sql(condition: PropertyCondition, owner: str, after: str):
+    sql = "SELECT product FROM folksonomy WHERE owner = %s AND k = %s"
+    params = [owner, condition.k]
+    if condition.v is not None:
+        sql += " AND v = %s"
+        params.append(condition.v)
+    if after:
+        sql += " AND product > %s"
+        params.append(after)
+    return sql, params
+
+
+def _and_sql(condition: AndCondition, owner: str, after: str, stats: dict):
+    positives = sorted(
+        (c for c in condition.and_ if not isinstance(c, NotCondition)),
+        key=lambda c: estimate(c, stats),
+    )
+    if not positives:
+        raise QueryError("An 'and' needs at least one condition which is not a 'not'")
+    parts = [compile_condition(c, owner, after, stats) for c in positives]
+    sql = " INTERSECT ".join(f"({part_sql})" for part_sql, _ in parts)
+    params = [param for _, part_params in parts for param in part_params]
+    matches = estimate(condition, stats)
+    for negative in condition.and_:
+        if not isinstance(negative, NotCondition):
+            continue
+        excluded = negative.not_
+        if isinstance(excluded, PropertyCondition) and matches < estimate(
+            excluded, stats
+        ):
+            sql = f"""
+                SELECT product FROM ({sql}) AS matches WHERE NOT EXISTS (
+                    SELECT 1 FROM folksonomy AS excluded
+                    WHERE excluded.product = matches.product
+                    AND excluded.owner = %s AND excluded.k = %s
+                    {"AND excluded.v = %s" if excluded.v is not None else ""}
+                )
+            """
+            params += [owner, excluded.k]
+            if excluded.v is not None:
+                params.append(excluded.v)
+        else:
+            excluded_sql, excluded_params = compile_condition(
+                excluded, owner, after, stats
+            )
+            sql = f"({sql}) EXCEPT ({excluded_sql})"
+            params += excluded_params
+    return sql, params
+
+
+def compile_condition(condition: Condition, owner: str, after: str, stats: dict):
+    """SQL selecting products (after the given one, if any) matching condition
+
+    Raise QueryError if it can't be compiled.
+    """
+    if isinstance(condition, PropertyCondition):
+        return _property_sql(condition, owner, after)
+    if isinstance(condition, AndCondition):
+        return _and_sql(condition, owner, after, stats)
+    if isinstance(condition, OrCondition):
+        parts = [compile_condition(c, owner, after, stats) for c in condition.or_]
+        sql = " UNION ".join(f"({part_sql})" for part_sql, _ in parts)
+        return sql, [param for _, part_params in parts for param in part_params]
+    raise QueryError("A 'not' can only be used in an 'and', with other conditions")
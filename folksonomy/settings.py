@@ -9,6 +9,19 @@ POSTGRES_PASSWORD = os.environ.get(
 )  # Leave empty if no password exists for user
 POSTGRES_HOST = os.environ.get("POSTGRES_HOST", None)  # Change if necessary
 POSTGRES_DATABASE = os.environ.get("POSTGRES_DATABASE", "folksonomy")
+# maximum number of connections in the pool of each worker
+POSTGRES_POOL_SIZE = int(os.environ.get("POSTGRES_POOL_SIZE", 10))
+# database driver: "aiopg" (psycopg2) or "asyncpg" (needs asyncpg to be installed)
+DB_BACKEND = os.environ.get("DB_BACKEND", "aiopg")
+# hosts of read replicas, comma separated, leave empty to serve reads from the primary
+POSTGRES_REPLICA_HOSTS = [
+    host.strip()
+    for host in os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",")
+    if host.strip()
+]
+# maximum time (in seconds) to wait for a replica to replay a client's last write,
+# before falling back to the primary
+REPLICA_WAIT_TIMEOUT = float(os.environ.get("REPLICA_WAIT_TIMEOUT", 0.2))
 
 
 # we deduce the URL to which to authenticate from the base url,
@@ -26,10 +39,90 @@ API_SERVERS = [
     },
     {"url": "http://localhost:8000", "description": "Local development server"},
 ]
+# OpenAPI schema generated beforehand (see generate_openapi_json.py), served instead
+# of being generated by each worker on first request (servers are still API_SERVERS)
+OPENAPI_FILE = os.environ.get("OPENAPI_FILE", "")
 
 # time (in seconds) to wait for after a failed authentication attempt (to avoid brute force)
 FAILED_AUTH_WAIT_TIME = 2  # this settings is meant to be overridden by tests only
 
+# http client to the auth server: connection pool size and keep-alive (in seconds)
+AUTH_POOL_SIZE = int(os.environ.get("AUTH_POOL_SIZE", 20))
+AUTH_KEEPALIVE_TIMEOUT = float(os.environ.get("AUTH_KEEPALIVE_TIMEOUT", 30))
+# timeouts (in seconds) to connect to the auth server and to read its response
+AUTH_CONNECT_TIMEOUT = float(os.environ.get("AUTH_CONNECT_TIMEOUT", 2))
+AUTH_READ_TIMEOUT = float(os.environ.get("AUTH_READ_TIMEOUT", 5))
+# circuit breaker: after this number of consecutive failures,
+# stop calling the auth server for AUTH_CIRCUIT_RESET_TIME seconds
+AUTH_CIRCUIT_FAILURES = int(os.environ.get("AUTH_CIRCUIT_FAILURES", 5))
+AUTH_CIRCUIT_RESET_TIME = float(os.environ.get("AUTH_CIRCUIT_RESET_TIME", 10))
+# time (in seconds) during which a successful session cookie validation is reused
+# (0 to disable), and maximum number of cached validations
+AUTH_SESSION_CACHE_TTL = float(os.environ.get("AUTH_SESSION_CACHE_TTL", 60))
+AUTH_SESSION_CACHE_SIZE = int(os.environ.get("AUTH_SESSION_CACHE_SIZE", 10000))
+# tokens not used for this time (in seconds) expire
+AUTH_TOKEN_LIFETIME = float(os.environ.get("AUTH_TOKEN_LIFETIME", 30 * 24 * 3600))
+# token last use (and expiry) is updated at most once in this time (in seconds)
+AUTH_TOUCH_INTERVAL = float(os.environ.get("AUTH_TOUCH_INTERVAL", 300))
+# time (in seconds) between two purges of expired tokens (0 to disable)
+AUTH_PURGE_INTERVAL = float(os.environ.get("AUTH_PURGE_INTERVAL", 3600))
+# number of expired tokens deleted by each transaction of a purge
+AUTH_PURGE_BATCH_SIZE = int(os.environ.get("AUTH_PURGE_BATCH_SIZE", 1000))
+
+# responses smaller than this (in bytes) are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+# responses larger than this (in bytes) are compressed in a thread
+COMPRESSION_THREAD_SIZE = int(os.environ.get("COMPRESSION_THREAD_SIZE", 64 * 1024))
+# maximum total size (in bytes) of compressed bodies kept in cache by each worker
+# (bodies are cached from their second compression)
+COMPRESSION_CACHE_SIZE = int(os.environ.get("COMPRESSION_CACHE_SIZE", 32 * 1024**2))
+
+# run background jobs (admin bulk operations) in this process
+JOBS_WORKER = bool(int(os.environ.get("JOBS_WORKER", 1)))
+# number of rows changed by each transaction of a job
+JOBS_BATCH_SIZE = int(os.environ.get("JOBS_BATCH_SIZE", 2000))
+# time (in seconds) between two checks for new jobs
+JOBS_POLL_INTERVAL = float(os.environ.get("JOBS_POLL_INTERVAL", 1))
+# a running job not updated for this time (in seconds) is taken over by another worker
+JOBS_LEASE_TIME = float(os.environ.get("JOBS_LEASE_TIME", 60))
+
+# time (in seconds) between two merges of tags changes into statistics
+# used by approximate counts (0 to disable)
+STATS_MERGE_INTERVAL = float(os.environ.get("STATS_MERGE_INTERVAL", 10))
+# number of tags changes merged by each transaction
+STATS_MERGE_BATCH_SIZE = int(os.environ.get("STATS_MERGE_BATCH_SIZE", 10000))
+# sketches of a key or product are rebuilt when more than this ratio of its tags
+# were removed since they were built
+STATS_REBUILD_RATIO = float(os.environ.get("STATS_REBUILD_RATIO", 0.1))
+
+# asynchronous creations of tags (POST /product?async=1) are committed together,
+# after at most ASYNC_WRITE_INTERVAL seconds, or by batches of ASYNC_WRITE_BATCH_SIZE
+ASYNC_WRITE_INTERVAL = float(os.environ.get("ASYNC_WRITE_INTERVAL", 0.05))
+ASYNC_WRITE_BATCH_SIZE = int(os.environ.get("ASYNC_WRITE_BATCH_SIZE", 500))
+# maximum number of tags waiting to be written in each worker, new ones are refused
+ASYNC_WRITE_MAX_PENDING = int(os.environ.get("ASYNC_WRITE_MAX_PENDING", 10000))
+# time (in seconds) during which the outcome of asynchronous writes can be queried
+ASYNC_TICKET_LIFETIME = int(os.environ.get("ASYNC_TICKET_LIFETIME", 86400))
+
+# admission control: maximum number of requests processed at once by each worker
+# (0 for no limit), requests expected to wait more than ADMISSION_WAIT_BUDGET seconds
+# for their turn are rejected
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", 0))
+ADMISSION_WAIT_BUDGET = float(os.environ.get("ADMISSION_WAIT_BUDGET", 1))
+# rate limits, in requests per second by token, or by address for anonymous requests,
+# in each worker (0 for no limit), of reads, writes and /admin/ requests
+RATE_LIMIT_READ = float(os.environ.get("RATE_LIMIT_READ", 0))
+RATE_LIMIT_WRITE = float(os.environ.get("RATE_LIMIT_WRITE", 0))
+RATE_LIMIT_ADMIN = float(os.environ.get("RATE_LIMIT_ADMIN", 0))
+# bursts of up to this number of seconds of requests are allowed
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 10))
+# header giving client address behind a proxy (eg. X-Forwarded-For), if any,
+# its last address (the one added by the proxy) is used
+RATE_LIMIT_IP_HEADER = os.environ.get("RATE_LIMIT_IP_HEADER", "")
+
+# identical concurrent reads of a product or of values share their query (see coalesce)
+COALESCE_READS = bool(int(os.environ.get("COALESCE_READS", 1)))
+
 try:
     # override with local_settings
     from local_settings import *  # noqa: F403
@@ -0,0 +1,211 @@
+"""Statistics of keys and products, for approximate counts (approx=true)
+
+Tags changes are logged by triggers in folksonomy_stats_log (see 010-approximate-stats),
+and merged periodically, by batches, by a task in each API process (one at a time),
+into folksonomy_key_stats and folksonomy_product_stats. Those have exact tags counts,
+and HyperLogLog sketches (see hll) of values of each key and of editors of each product,
+with their estimate, so that approximate queries only read them.
+
+Sketches can't forget values: when more than STATS_REBUILD_RATIO of the tags
+of a key or a product were removed since its sketch was built, it is rebuilt from tags.
+Statistics lag behind tags by up to STATS_MERGE_INTERVAL.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import weakref
+
+from . import db
+from . import settings
+from .hll import HyperLogLog
+
+log = logging.getLogger(__name__)
+
+MERGE_LOCK = 0x466F6C6B
+"""advisory lock id, so that only one process merges at a time"""
+
+GROUPS = {
+    "folksonomy_key_stats": ("k", "v"),
+    "folksonomy_product_stats": ("product", "editor"),
+}
+"""stats tables, with the column they group tags by, and the one they count values of"""
+
+LOG_COLUMNS = ("product", "k", "v", "owner", "editor", "last_edit", "delta")
+
+mergers = weakref.WeakKeyDictionary()
+"""associate each event loop with its merge task"""
+
+
+def _changes(rows, group, counted):
+    """Aggregate logged rows by (owner, group)
+
+    For each, we get the tags delta, last edit, and the delta of each counted value:
+    a value added then removed (or the reverse, like on an update keeping it)
+    is neither added nor removed.
+    """
+    changes = {}
+    for row in rows:
+        row = dict(zip(LOG_COLUMNS, row))
+        key = (row["owner"], row[group])
+        change = changes.get(key)
+        if change is None:
+            change = changes[key] = {
+                "tags": 0,
+                "last_edit": None,
+                "values": collections.Counter(),
+            }
+        change["tags"] += row["delta"]
+        change["values"][row[counted]] += row["delta"]
+        if (
+            row["delta"] > 0
+            and row["last_edit"]
+            and (change["last_edit"] is None or row["last_edit"] > change["last_edit"])
+        ):
+            change["last_edit"] = row["last_edit"]
+    return changes
+
+
+async def _rebuild(group, counted, owner, value):
+    """Exact statistics of a group, from tags
+
+    Changes still in the log (which will be merged later) are deduced from tags count.
+    """
+    cur, _ = await db.db_exec(
+        f"""
+        SELECT
+            count(*) - coalesce((
+                SELECT sum(delta) FROM folksonomy_stats_log
+                WHERE owner = %s AND {group} = %s
+            ), 0),
+            max(last_edit),
+            array_agg(DISTINCT {counted})
+        FROM folksonomy WHERE owner = %s AND {group} = %s
+        """,
+        (owner, value, owner, value),
+    )
+    tags, last_edit, values = await cur.fetchone()
+    return tags, last_edit, HyperLogLog(values or ()), 0
+
+
+async def _merge_table(table, rows):
+    group, counted = GROUPS[table]
+    changes = _changes(rows, group, counted)
+    owners, values = (list(column) for column in zip(*changes))
+    cur, _ = await db.db_exec(
+        f"""
+        SELECT owner, {group}, tags, last_edit, sketch, removed FROM {table}
+        WHERE (owner, {group}) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+        """,
+        (owners, values),
+    )
+    current = {(row[0], row[1]): row[2:] for row in await cur.fetchall()}
+    upserts, deletes = [], []
+    for key, change in changes.items():
+        tags, last_edit, sketch, removed = current.get(key, (0, None, None, 0))
+        tags += change["tags"]
+        if tags <= 0:
+            deletes.append(key)
+            continue
+        if change["last_edit"] and (
+            last_edit is None or change["last_edit"] > last_edit
+        ):
+            last_edit = change["last_edit"]
+        sketch = HyperLogLog.from_bytes(sketch) if sketch else HyperLogLog()
+        sketch.update(v for v, delta in change["values"].items() if delta > 0)
+        removed -= sum(delta for delta in change["values"].values() if delta < 0)
+        if removed > settings.STATS_REBUILD_RATIO * tags:
+            tags, last_edit, sketch, removed = await _rebuild(group, counted, *key)
+            if tags == 0:
+                deletes.append(key)
+                continue
+        upserts.append(
+            (*key, tags, last_edit, sketch.to_bytes(), sketch.estimate(), removed)
+        )
+    if upserts:
+        await db.db_exec(
+            f"""
+            INSERT INTO {table} (owner, {group}, tags, last_edit, sketch, estimate, removed)
+            SELECT * FROM unnest(
+                %s::text[], %s::text[], %s::int[], %s::timestamp[], %s::bytea[],
+                %s::int[], %s::int[]
+            )
+            ON CONFLICT (owner, {group}) DO UPDATE SET
+                tags = excluded.tags, last_edit = excluded.last_edit,
+                sketch = excluded.sketch, estimate = excluded.estimate,
+                removed = excluded.removed
+            """,
+            [list(column) for column in zip(*upserts)],
+        )
+    if deletes:
+        await db.db_exec(
+            f"""
+            DELETE FROM {table}
+            WHERE (owner, {group}) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+            """,
+            [list(column) for column in zip(*deletes)],
+        )
+
+
+async def merge():
+    """Merge a batch of logged changes, return how many were merged
+
+    Return None if another process is merging.
+    """
+    async with db.transaction():
+        cur, _ = await db.db_exec("SELECT pg_try_advisory_xact_lock(%s)", (MERGE_LOCK,))
+        if not (await cur.fetchone())[0]:
+            return None
+        cur, _ = await db.db_exec(
+            f"""
+            DELETE FROM folksonomy_stats_log WHERE id = ANY(ARRAY(
+                SELECT id FROM folksonomy_stats_log ORDER BY id LIMIT %s
+            ))
+            RETURNING {", ".join(LOG_COLUMNS)}
+            """,
+            (settings.STATS_MERGE_BATCH_SIZE,),
+        )
+        rows = await cur.fetchall()
+        if rows:
+            for table in GROUPS:
+                await _merge_table(table, rows)
+        return len(rows)
+
+
+async def merge_all():
+    """Merge all logged changes (waiting for another process merging)"""
+    while True:
+        merged = await merge()
+        if merged is None:
+            await asyncio.sleep(0.1)
+        elif merged < settings.STATS_MERGE_BATCH_SIZE:
+            return
+
+
+async def merger():
+    """Merge logged changes periodically"""
+    while True:
+        try:
+            # go on while batches are full, unless another process is merging
+            while (await merge() or 0) >= settings.STATS_MERGE_BATCH_SIZE:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error while merging statistics")
+        await asyncio.sleep(settings.STATS_MERGE_INTERVAL)
+
+
+def start():
+    """Start statistics merge, if enabled"""
+    if settings.STATS_MERGE_INTERVAL > 0:
+        mergers[asyncio.get_running_loop()] = asyncio.create_task(merger())
+
+
+async def terminate():
+    task = mergers.pop(asyncio.get_running_loop(), None)
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
@@ -0,0 +1,143 @@
+"""Bearer tokens storage
+
+Only a sha256 digest of tokens is stored in auth table,
+they are looked up through a unique index on it.
+Tokens expire after AUTH_TOKEN_LIFETIME without being used.
+To keep updates cheap, last use (and expiry) is only updated
+once every AUTH_TOUCH_INTERVAL, and expired tokens are deleted
+by a purge task in each API process, by small batches.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import weakref
+
+from . import db
+from . import settings
+
+log = logging.getLogger(__name__)
+
+NOW = "current_timestamp AT TIME ZONE 'GMT'"
+
+purgers = weakref.WeakKeyDictionary()
+"""associate each event loop with its purge task"""
+
+
+def hash_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def user_id(token: str) -> str:
+    return token.split("__U", 1)[0]
+
+
+async def store(user_id, token, is_admin, is_moderator, is_user):
+    """Store a new token for user, replacing previous ones, return the cursor"""
+    await db.db_exec("DELETE FROM auth WHERE user_id = %s", (user_id,))
+    cur, _ = await db.db_exec(
+        f"""
+        INSERT INTO auth
+            (user_id, token_hash, last_use, expires_at, admin, moderator, "user")
+        VALUES (%s, %s, {NOW}, {NOW} + make_interval(secs => %s), %s, %s, %s)
+        """,
+        (
+            user_id,
+            hash_token(token),
+            settings.AUTH_TOKEN_LIFETIME,
+            is_admin,
+            is_moderator,
+            is_user,
+        ),
+    )
+    return cur
+
+
+async def touch(token: str):
+    """Check token validity, extending its lifetime, return its user_id or None"""
+    cur, _ = await db.db_exec(
+        f"""
+        WITH token AS (
+            SELECT token_hash, last_use FROM auth
+            WHERE token_hash = %s AND expires_at > {NOW}
+        ),
+        touched AS (
+            UPDATE auth
+            SET last_use = {NOW}, expires_at = {NOW} + make_interval(secs => %s)
+            WHERE token_hash = (SELECT token_hash FROM token)
+                AND last_use < {NOW} - make_interval(secs => %s)
+        )
+        SELECT 1 FROM token
+        """,
+        (
+            hash_token(token),
+            settings.AUTH_TOKEN_LIFETIME,
+            settings.AUTH_TOUCH_INTERVAL,
+        ),
+    )
+    return user_id(token) if cur.rowcount == 1 else None
+
+
+async def check(token: str):
+    """Return user_id of a valid token, or None"""
+    if db.in_replica():
+        # replicas are read only, last use is only updated on the primary
+        cur, _ = await db.db_exec(
+            f"SELECT 1 FROM auth WHERE token_hash = %s AND expires_at > {NOW}",
+            (hash_token(token),),
+        )
+        if cur.rowcount == 1:
+            return user_id(token)
+        # token may be too recent to be on the replica
+        async with db.transaction():
+            return await touch(token)
+    return await touch(token)
+
+
+async def purge():
+    """Delete expired tokens, by batches, return how many were deleted"""
+    deleted = 0
+    while True:
+        async with db.transaction():
+            cur, _ = await db.db_exec(
+                f"""
+                DELETE FROM auth WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM auth WHERE expires_at <= {NOW}
+                    LIMIT %s FOR UPDATE SKIP LOCKED
+                ))
+                """,
+                (settings.AUTH_PURGE_BATCH_SIZE,),
+            )
+            count = cur.rowcount
+        deleted += count
+        if count < settings.AUTH_PURGE_BATCH_SIZE:
+            return deleted
+
+
+async def purger():
+    """Purge expired tokens periodically"""
+    while True:
+        try:
+            deleted = await purge()
+            if deleted:
+                log.info("Purged %s expired tokens", deleted)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error while purging expired tokens")
+        await asyncio.sleep(settings.AUTH_PURGE_INTERVAL)
+
+
+def start():
+    """Start expired tokens purge, if enabled"""
+    if settings.AUTH_PURGE_INTERVAL > 0:
+        purgers[asyncio.get_running_loop()] = asyncio.create_task(purger())
+
+
+async def terminate():
+    task = purgers.pop(asyncio.get_running_loop(), None)
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
@@ -0,0 +1,202 @@
+"""Asynchronous creation of tags, committed by groups (POST /product?async=1)
+
+Tags are validated by the request, then appended to a buffer of the worker,
+and a ticket is returned. A task of each worker flushes the buffer every
+ASYNC_WRITE_INTERVAL seconds, or as soon as ASYNC_WRITE_BATCH_SIZE tags are waiting:
+they are created with one statement, in one transaction, so that bots creating tags
+one by one share commits instead of each paying for its own.
+
+The outcome of each ticket is stored in folksonomy_write_tickets, in the same transaction:
+created, conflict if the tag already exists (or an earlier tag of the same batch has
+the same key), or failed, with the error, if the database refused it.
+Tickets waiting in the buffer are only known to their worker. Pending tags are flushed
+when the worker stops, but lost if it dies.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import uuid
+import weakref
+
+from . import db
+from . import settings
+from .models import ProductTag
+
+log = logging.getLogger(__name__)
+
+NOW = "current_timestamp AT TIME ZONE 'GMT'"
+
+buffers = weakref.WeakKeyDictionary()
+"""associate each event loop with its write buffer"""
+
+
+class BufferFullError(Exception):
+    """Too many tags are waiting to be written"""
+
+
+class WriteBuffer:
+    def __init__(self):
+        self.pending = {}
+        """tags waiting to be committed, by ticket, in order"""
+        self.ready = asyncio.Event()
+        """set while there are pending tags"""
+        self.full = asyncio.Event()
+        """set while there is a full batch of pending tags"""
+        self.task = asyncio.create_task(flusher(self))
+
+
+def get_buffer():
+    """Get write buffer of current event loop, creating it if needed"""
+    loop = asyncio.get_running_loop()
+    buffer = buffers.get(loop)
+    if buffer is None:
+        buffer = buffers[loop] = WriteBuffer()
+    return buffer
+
+
+def enqueue(product_tag: ProductTag) -> str:
+    """Add a tag to create to the buffer, return its ticket
+
+    Raise BufferFullError if ASYNC_WRITE_MAX_PENDING tags are already waiting.
+    """
+    buffer = get_buffer()
+    if len(buffer.pending) >= settings.ASYNC_WRITE_MAX_PENDING:
+        raise BufferFullError()
+    ticket = str(uuid.uuid4())
+    buffer.pending[ticket] = product_tag
+    buffer.ready.set()
+    if len(buffer.pending) >= settings.ASYNC_WRITE_BATCH_SIZE:
+        buffer.full.set()
+    return ticket
+
+
+async def _create(batch: dict):
+    """Create tags of batch, storing the outcome of their tickets"""
+    columns = [
+        (
+            ticket,
+            tag.product,
+            tag.k.lower(),
+            tag.v,
+            tag.owner,
+            tag.editor,
+            tag.comment,
+        )
+        for ticket, tag in batch.items()
+    ]
+    await db.db_exec(
+        f"""
+        WITH batch AS (
+            SELECT * FROM unnest(
+                %s::text[], %s::text[], %s::text[], %s::text[], %s::text[],
+                %s::text[], %s::text[]
+            ) WITH ORDINALITY AS b(ticket, product, k, v, owner, editor, comment, n)
+        ), first AS (
+            -- of tags having the same key, only the first one can be created
+            SELECT DISTINCT ON (product, owner, k) * FROM batch
+            ORDER BY product, owner, k, n
+        ), created AS (
+            INSERT INTO folksonomy (product, k, v, owner, version, editor, comment)
+            SELECT product, k, v, owner, 1, editor, comment FROM first
+            ON CONFLICT (product, owner, k) DO NOTHING
+            RETURNING product, owner, k
+        ), purged AS (
+            DELETE FROM folksonomy_write_tickets
+            WHERE created < {NOW} - make_interval(secs => %s)
+        )
+        INSERT INTO folksonomy_write_tickets (ticket, status)
+        SELECT
+            batch.ticket::uuid,
+            CASE WHEN created.k IS NULL THEN 'conflict' ELSE 'created' END
+        FROM batch
+        LEFT JOIN first USING (ticket)
+        LEFT JOIN created
+            ON (created.product, created.owner, created.k)
+            = (first.product, first.owner, first.k)
+        """,
+        [list(column) for column in zip(*columns)] + [settings.ASYNC_TICKET_LIFETIME],
+    )
+
+
+async def flush(buffer: WriteBuffer):
+    """Commit a batch of pending tags, return how many were flushed"""
+    batch = dict(
+        itertools.islice(buffer.pending.items(), settings.ASYNC_WRITE_BATCH_SIZE)
+    )
+    if not batch:
+        return 0
+    try:
+        async with db.transaction():
+            await _create(batch)
+    except db.DatabaseError as e:
+        # one transaction by tag, to find which ones are refused
+        log.warning(
+            "Batch of %d writes refused, retrying one by one: %s", len(batch), e
+        )
+        for ticket, tag in batch.items():
+            try:
+                async with db.transaction():
+                    await _create({ticket: tag})
+            except db.DatabaseError as error:
+                async with db.transaction():
+                    await db.db_exec(
+                        """
+                        INSERT INTO folksonomy_write_tickets (ticket, status, error)
+                        VALUES (%s::uuid, 'failed', %s)
+                        """,
+                        (ticket, error.trigger_message),
+                    )
+            del buffer.pending[ticket]
+    else:
+        for ticket in batch:
+            del buffer.pending[ticket]
+    if len(buffer.pending) < settings.ASYNC_WRITE_BATCH_SIZE:
+        buffer.full.clear()
+    if not buffer.pending:
+        buffer.ready.clear()
+    return len(batch)
+
+
+async def flusher(buffer: WriteBuffer):
+    """Flush pending tags, waiting for a full batch at most ASYNC_WRITE_INTERVAL"""
+    while True:
+        await buffer.ready.wait()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(buffer.full.wait(), settings.ASYNC_WRITE_INTERVAL)
+        try:
+            await flush(buffer)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error while flushing writes")
+            await asyncio.sleep(settings.ASYNC_WRITE_INTERVAL)
+
+
+async def status(ticket: str):
+    """Status of a ticket, and error if it failed, None if the ticket is unknown"""
+    buffer = buffers.get(asyncio.get_running_loop())
+    if buffer is not None and ticket in buffer.pending:
+        return "pending", None
+    cur, _ = await db.db_exec(
+        "SELECT status, error FROM folksonomy_write_tickets WHERE ticket = %s::uuid",
+        (ticket,),
+    )
+    row = await cur.fetchone()
+    return tuple(row) if row else None
+
+
+async def terminate():
+    """Flush pending tags and stop the flush task of current event loop"""
+    buffer = buffers.pop(asyncio.get_running_loop(), None)
+    if buffer is None:
+        return
+    buffer.task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await buffer.task
+    try:
+        while buffer.pending:
+            await flush(buffer)
+    except Exception:
+        log.exception("%d pending writes lost", len(buffer.pending))
@@ -1,6 +1,7 @@
 #! /bin/env python3
 
 import json
+import os
 import sys
 import importlib.util
 
@@ -18,6 +19,9 @@ if "folksonomy.db" not in sys.modules:
     db_mock = types.ModuleType("db")
     sys.modules["folksonomy.db"] = db_mock
 
+# generate the schema from the code, even if a generated one is configured
+os.environ["OPENAPI_FILE"] = ""
+
 from folksonomy.api import app
 
 openapi_spec = app.openapi()
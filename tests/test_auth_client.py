@@ -0,0 +1,145 @@
+"""Tests of the auth server client, against a local stand-in auth server"""
+
+import asyncio
+import contextlib
+import time
+
+import pytest
+from aiohttp import web
+
+from folksonomy import auth_client, settings
+
+
+class StandInAuthServer:
+    """A minimal auth.pl, recording requests and connections it receives"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = 0
+        self.connections = set()
+
+    async def auth(self, request):
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info("peername"))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        data = await request.post()
+        success = data.get("password") == "test" or "&test&" in request.cookies.get(
+            "session", ""
+        )
+        if success:
+            return web.json_response({"user": {"admin": 0, "moderator": 0}})
+        return web.json_response({}, status=403)
+
+
+@contextlib.asynccontextmanager
+async def stand_in_auth_server(**kwargs):
+    server = StandInAuthServer(**kwargs)
+    app = web.Application()
+    app.router.add_post("/cgi/auth.pl", server.auth)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield server, f"http://127.0.0.1:{port}/cgi/auth.pl"
+    finally:
+        await auth_client.terminate()
+        await runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def fresh_client_state(monkeypatch):
+    monkeypatch.setattr(auth_client, "breaker", auth_client.CircuitBreaker())
+    monkeypatch.setattr(auth_client, "session_cache", auth_client.SessionCache())
+
+
+@pytest.mark.asyncio
+async def test_session_created_at_startup():
+    await auth_client.start()
+    session = auth_client.sessions[asyncio.get_running_loop()]
+    # requests reuse it
+    assert auth_client.get_session() is session
+    await auth_client.terminate()
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_login_throughput_reuses_connections():
+    n_logins = 500
+    async with stand_in_auth_server() as (server, auth_url):
+        data = {"user_id": "foo", "password": "test", "body": "1"}
+        results = await asyncio.gather(
+            *(auth_client.post(auth_url, data=data) for _ in range(n_logins))
+        )
+    assert [status for status, _ in results] == [200] * n_logins
+    assert server.requests == n_logins
+    # connections were pooled and kept alive
+    assert len(server.connections) <= settings.AUTH_POOL_SIZE
+
+
+@pytest.mark.asyncio
+async def test_failed_login():
+    async with stand_in_auth_server() as (server, auth_url):
+        data = {"user_id": "foo", "password": "bar", "body": "1"}
+        status_code, _ = await auth_client.post(auth_url, data=data)
+    assert status_code == 403
+    assert auth_client.breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_session_cookie_validation_is_cached():
+    async with stand_in_auth_server() as (server, auth_url):
+        for _ in range(50):
+            status_code, data = await auth_client.check_session_cookie(
+                auth_url, "user_session&test&user_id&foo"
+            )
+            assert status_code == 200
+            assert data == {"user": {"admin": 0, "moderator": 0}}
+        assert server.requests == 1
+        # failures are not cached
+        for _ in range(3):
+            status_code, _ = await auth_client.check_session_cookie(
+                auth_url, "user_session&wrong&user_id&foo"
+            )
+            assert status_code == 403
+        assert server.requests == 4
+
+
+@pytest.mark.asyncio
+async def test_session_cache_expires(monkeypatch):
+    monkeypatch.setattr(settings, "AUTH_SESSION_CACHE_TTL", 0.05)
+    async with stand_in_auth_server() as (server, auth_url):
+        session = "user_session&test&user_id&foo"
+        await auth_client.check_session_cookie(auth_url, session)
+        await auth_client.check_session_cookie(auth_url, session)
+        assert server.requests == 1
+        await asyncio.sleep(0.1)
+        await auth_client.check_session_cookie(auth_url, session)
+        assert server.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_timeout_opens_circuit(monkeypatch):
+    monkeypatch.setattr(settings, "AUTH_READ_TIMEOUT", 0.05)
+    monkeypatch.setattr(settings, "AUTH_CIRCUIT_FAILURES", 3)
+    monkeypatch.setattr(settings, "AUTH_CIRCUIT_RESET_TIME", 0.2)
+    async with stand_in_auth_server(delay=0.5) as (server, auth_url):
+        data = {"user_id": "foo", "password": "test", "body": "1"}
+        for _ in range(3):
+            with pytest.raises(auth_client.AuthServerUnavailableError):
+                await auth_client.post(auth_url, data=data)
+        assert server.requests == 3
+        # circuit is open, server is not called anymore
+        start = time.monotonic()
+        with pytest.raises(auth_client.AuthServerUnavailableError):
+            await auth_client.post(auth_url, data=data)
+        assert time.monotonic() - start < 0.05
+        assert server.requests == 3
+        # after reset time, a trial call is made, and server is back
+        await asyncio.sleep(0.25)
+        server.delay = 0
+        status_code, _ = await auth_client.post(auth_url, data=data)
+        assert status_code == 200
+        assert auth_client.breaker.opened_at is None
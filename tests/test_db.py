@@ -0,0 +1,348 @@
+"""Tests of the database layer, run against each available backend"""
+
+import asyncio
+import importlib.util
+import json
+import re
+
+import pytest
+
+from folksonomy import db, models, settings
+from folksonomy.backends import get_backend
+
+BACKENDS = [
+    pytest.param(
+        name,
+        marks=pytest.mark.skipif(
+            importlib.util.find_spec(name) is None, reason=f"{name} not installed"
+        ),
+    )
+    for name in ("aiopg", "asyncpg")
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    monkeypatch.setattr(settings, "DB_BACKEND", request.param)
+    return request.param
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend("sqlite")
+
+
+def test_translate_placeholders():
+    asyncpg_backend = pytest.importorskip("folksonomy.backends.asyncpg_backend")
+    translate = asyncpg_backend.translate_placeholders
+    assert translate("SELECT 1") == "SELECT 1"
+    assert (
+        translate("SELECT * FROM folksonomy WHERE owner = %s AND k IN (%s, %s)")
+        == "SELECT * FROM folksonomy WHERE owner = $1 AND k IN ($2, $3)"
+    )
+    assert (
+        translate("SELECT '100%%' WHERE v ILIKE %s") == "SELECT '100%' WHERE v ILIKE $1"
+    )
+
+
+def test_is_multi_statement():
+    asyncpg_backend = pytest.importorskip("folksonomy.backends.asyncpg_backend")
+    is_multi = asyncpg_backend.is_multi_statement
+    assert is_multi("TRUNCATE a; TRUNCATE b;")
+    assert not is_multi("SELECT 1;\n")
+    assert not is_multi("SELECT 'a;b', \"c;\" FROM t -- d;\n")
+    assert not is_multi("SELECT E'\\';', $$;$$, $f$ ; $f$ /* ; */")
+    assert is_multi("SELECT ';'; SELECT 2")
+
+
+def test_rowcount_from_status():
+    asyncpg_backend = pytest.importorskip("folksonomy.backends.asyncpg_backend")
+    rowcount = asyncpg_backend.rowcount_from_status
+    assert rowcount("UPDATE 3", []) == 3
+    assert rowcount("INSERT 0 1", []) == 1
+    assert rowcount("SELECT 2", [(1,), (2,)]) == 2
+    assert rowcount("TRUNCATE TABLE", []) == -1
+
+
+async def _clean():
+    async with db.transaction():
+        await db.db_exec("DELETE FROM folksonomy WHERE product = '3701027909999'")
+
+
+@pytest.mark.asyncio
+async def test_backend_queries(backend):
+    await _clean()
+    tag = models.ProductTag(product="3701027909999", k="test_db", v="50%", editor="foo")
+    try:
+        async with db.transaction():
+            cur, timing = await db.db_exec(*db.create_product_tag_req(tag))
+            assert cur.rowcount == 1
+            cur, _ = await db.db_exec(
+                "SELECT k, v, version FROM folksonomy WHERE product = %s AND v LIKE %s",
+                (tag.product, "%\\%"),
+            )
+            assert cur.rowcount == 1
+            assert tuple(await cur.fetchone()) == ("test_db", "50%", 1)
+            assert await cur.fetchone() is None
+            # json is decoded
+            cur, _ = await db.db_exec(
+                "SELECT json_agg(j) FROM (SELECT k, v FROM folksonomy WHERE product = %s) j",
+                (tag.product,),
+            )
+            assert (await cur.fetchone())[0] == [{"k": "test_db", "v": "50%"}]
+            # rowcount of updates
+            tag.version = 2
+            cur, _ = await db.db_exec(*db.update_product_tag_req(tag))
+            assert cur.rowcount == 1
+            # multiple statements without parameters
+            cur, _ = await db.db_exec("SELECT 1; SELECT 2;")
+    finally:
+        await _clean()
+        await db.terminate()
+
+
+@pytest.mark.asyncio
+async def test_backend_errors(backend):
+    await _clean()
+    tag = models.ProductTag(
+        product="3701027909999", k="test_db", v="test", editor="foo"
+    )
+    try:
+        async with db.transaction():
+            await db.db_exec(*db.create_product_tag_req(tag))
+        # trigger errors messages are extracted
+        with pytest.raises(db.DatabaseError) as exc_info:
+            async with db.transaction():
+                tag.version = 3
+                await db.db_exec(*db.update_product_tag_req(tag))
+        assert (
+            exc_info.value.trigger_message == "next version must be equal to 2, was 3"
+        )
+        assert not exc_info.value.is_unique_violation
+        # unique violations are detected
+        with pytest.raises(db.DatabaseError) as exc_info:
+            async with db.transaction():
+                tag.version = 1
+                await db.db_exec(*db.create_product_tag_req(tag))
+        assert exc_info.value.is_unique_violation
+        assert "duplicate key value violates unique constraint" in str(exc_info.value)
+        # arguments not matching the query (psycopg2 can't check their number)
+        mismatches = [("SELECT %s::int", ("x",))]
+        if backend == "asyncpg":
+            mismatches.append(("SELECT %s, %s", (1,)))
+        for query, params in mismatches:
+            with pytest.raises(db.DatabaseError):
+                async with db.transaction():
+                    await db.db_exec(query, params)
+    finally:
+        await _clean()
+        await db.terminate()
+
+
+@pytest.mark.asyncio
+async def test_private_partition_pruning(backend):
+    try:
+        async with db.transaction():
+            cur, _ = await db.db_exec(
+                "EXPLAIN SELECT product FROM folksonomy WHERE owner = %s AND k = %s",
+                ("foo", "test_db"),
+            )
+            plan = "\n".join(row[0] for row in await cur.fetchall())
+        # only one of private hash partitions is scanned
+        assert len(set(re.findall(r"folksonomy_private_\d+\b", plan))) == 1
+        assert "folksonomy_public" not in plan
+    finally:
+        await db.terminate()
+
+
+@pytest.mark.asyncio
+async def test_numeric_values(backend):
+    await _clean()
+    values = ["12.5", "-3", "1e3", "0x10", "12 g", "NaN"]
+    try:
+        async with db.transaction():
+            for i, v in enumerate(values):
+                tag = models.ProductTag(
+                    product="3701027909999", k=f"test_db_{i}", v=v, editor="foo"
+                )
+                await db.db_exec(*db.create_product_tag_req(tag))
+            cur, _ = await db.db_exec(
+                "SELECT v, v_num FROM folksonomy WHERE product = %s",
+                ("3701027909999",),
+            )
+            numbers = {v: v_num for v, v_num in await cur.fetchall()}
+            assert numbers == dict(zip(values, [12.5, -3, 1000, None, None, None]))
+            # tables are too small for indexes to be chosen otherwise
+            await db.db_exec("SET LOCAL enable_seqscan = off")
+            cur, _ = await db.db_exec(
+                """
+                EXPLAIN SELECT product FROM folksonomy
+                WHERE owner = %s AND k = %s AND v_num >= %s::numeric
+                """,
+                ("", "test_db_0", 10),
+            )
+            plan = "\n".join(row[0] for row in await cur.fetchall())
+        assert "folksonomy_public_k_v_num_idx" in plan
+    finally:
+        await _clean()
+        await db.terminate()
+
+
+async def _product_doc():
+    """Stored document of the test product, and the one computed from its tags"""
+    cur, _ = await db.db_exec(
+        """
+        SELECT
+            (SELECT doc FROM folksonomy_product_docs WHERE product = %s AND owner = ''),
+            (SELECT json_agg(j ORDER BY k)::text FROM (
+                SELECT product, k, v, owner, version, editor, last_edit, comment
+                FROM folksonomy WHERE product = %s AND owner = ''
+            ) AS j)
+        """,
+        ("3701027909999", "3701027909999"),
+    )
+    return tuple(await cur.fetchone())
+
+
+@pytest.mark.asyncio
+async def test_product_docs(backend):
+    await _clean()
+    product = "3701027909999"
+    try:
+        started = asyncio.Event()
+
+        async def create(k, wait):
+            async with db.transaction():
+                tag = models.ProductTag(product=product, k=k, v="1", editor="foo")
+                await db.db_exec(*db.create_product_tag_req(tag))
+                started.set()
+                await wait()
+
+        # concurrent transactions must not lose each other's tags
+        await asyncio.gather(
+            create("test_db_a", lambda: asyncio.sleep(0.1)),
+            create("test_db_b", started.wait),
+        )
+        async with db.transaction():
+            doc, expected = await _product_doc()
+            assert doc == expected
+            assert [t["k"] for t in json.loads(doc)] == ["test_db_a", "test_db_b"]
+            await db.db_exec(
+                "UPDATE folksonomy SET v = '2', version = 2 WHERE product = %s AND k = %s",
+                (product, "test_db_b"),
+            )
+            doc, expected = await _product_doc()
+            assert doc == expected
+            assert [t["v"] for t in json.loads(doc)] == ["1", "2"]
+            await db.db_exec("DELETE FROM folksonomy WHERE product = %s", (product,))
+            assert await _product_doc() == (None, None)
+
+        async def change(statement, k, first):
+            """Run statement on tag k, the first one committing 0.1s after it ran"""
+            if not first:
+                await started.wait()
+            async with db.transaction():
+                await db.db_exec(statement, (product, k))
+                if first:
+                    started.set()
+                    await asyncio.sleep(0.1)
+
+        insert = """
+            INSERT INTO folksonomy (product, k, v, owner, version, editor)
+            VALUES (%s, %s, '1', '', 1, 'foo')
+        """
+        delete = "DELETE FROM folksonomy WHERE product = %s AND k = %s"
+        # the last tag is deleted while another one is created, in both orders
+        for changes in ([delete, insert], [insert, delete]):
+            async with db.transaction():
+                await db.db_exec(insert, (product, "test_db_a"))
+            started.clear()
+            await asyncio.gather(
+                *(
+                    change(
+                        statement,
+                        "test_db_a" if statement is delete else "test_db_c",
+                        i == 0,
+                    )
+                    for i, statement in enumerate(changes)
+                )
+            )
+            async with db.transaction():
+                doc, expected = await _product_doc()
+                assert doc == expected
+                assert [t["k"] for t in json.loads(doc)] == ["test_db_c"]
+                await db.db_exec(
+                    "DELETE FROM folksonomy WHERE product = %s", (product,)
+                )
+    finally:
+        await _clean()
+        await db.terminate()
+
+
+@pytest.mark.asyncio
+async def test_product_docs_many_products(backend):
+    # more products than locks a transaction can hold (max_locks_per_transaction)
+    n = 20000
+    delete = "DELETE FROM folksonomy WHERE owner = '' AND k = 'test_db_many'"
+    try:
+        async with db.transaction():
+            await db.db_exec(
+                """
+                INSERT INTO folksonomy (product, k, v, owner, version, editor)
+                SELECT 'test_db_' || i, 'test_db_many', '1', '', 1, 'foo'
+                FROM generate_series(1, %s) AS i
+                """,
+                (n,),
+            )
+            await db.db_exec(
+                "UPDATE folksonomy SET v = '2', version = 2 "
+                "WHERE owner = '' AND k = 'test_db_many'"
+            )
+            cur, _ = await db.db_exec(
+                """
+                SELECT count(*) FROM folksonomy_product_docs
+                WHERE product LIKE 'test_db_%%' AND doc LIKE '%%"v":"2"%%'
+                """
+            )
+            assert (await cur.fetchone())[0] == n
+            await db.db_exec(delete)
+            cur, _ = await db.db_exec(
+                "SELECT count(*) FROM folksonomy_product_docs "
+                "WHERE product LIKE 'test_db_%%'"
+            )
+            assert (await cur.fetchone())[0] == 0
+    finally:
+        async with db.transaction():
+            await db.db_exec(delete)
+        await db.terminate()
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    # the primary stands for its own replica
+    monkeypatch.setattr(settings, "POSTGRES_REPLICA_HOSTS", [settings.POSTGRES_HOST])
+    monkeypatch.setattr(settings, "REPLICA_WAIT_TIMEOUT", 0.05)
+
+
+@pytest.mark.asyncio
+async def test_replica_routing(backend, replica):
+    try:
+        async with db.transaction():
+            assert not db.in_replica()
+            lsn = await db.primary_lsn()
+            assert db.is_valid_lsn(lsn)
+            # nested transactions restore the outer cursor
+            assert not db.in_replica()
+        async with db.transaction(readonly=True):
+            assert db.in_replica()
+        async with db.transaction(readonly=True, min_lsn=lsn):
+            assert db.in_replica()
+        assert not db.in_replica()
+        # replica lagging behind, fall back to primary
+        async with db.transaction(readonly=True, min_lsn="FFFFFFFF/0"):
+            assert not db.in_replica()
+        # invalid lsn are ignored
+        async with db.transaction(readonly=True, min_lsn="0/0; DROP TABLE auth"):
+            assert db.in_replica()
+    finally:
+        await db.terminate()
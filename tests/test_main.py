@@ -3,13 +3,33 @@
 **Important:** you should run tests with PYTHONASYNCIODEBUG=1
 """
 
+import asyncio
+import json
+import subprocess
+import sys
+import uuid
 import pytest
 import time
 
 import aiohttp
+import httpx
 from fastapi.testclient import TestClient
 
-from folksonomy import db, models, settings
+from folksonomy import (
+    admission,
+    coalesce,
+    compression,
+    db,
+    formats,
+    hll,
+    jobs,
+    models,
+    query,
+    settings,
+    stats,
+    tokens,
+    writes,
+)
 from folksonomy.api import app
 
 test_client = TestClient(app)
@@ -131,6 +151,8 @@ async def clean_data():
         raise Exception("Database has %d items - refusing to run tests" % result[0])
     cur, timing = await db.db_exec(
         "TRUNCATE folksonomy; TRUNCATE folksonomy_versions; TRUNCATE auth;"
+        "TRUNCATE folksonomy_jobs, folksonomy_write_tickets, folksonomy_product_docs;"
+        "TRUNCATE folksonomy_stats_log, folksonomy_key_stats, folksonomy_product_stats;"
     )
 
 
@@ -162,13 +184,19 @@ def auth_tokens(event_loop):
 async def _add_auth_tokens():
     # add a token to auth foo and bar
     async with db.transaction():
-        await db.db_exec(
-            """
-            INSERT INTO auth (user_id, token, last_use) VALUES
-            ('foo','foo__Utest-token',current_timestamp AT TIME ZONE 'GMT'),
-            ('bar','bar__Utest-token',current_timestamp AT TIME ZONE 'GMT')
-            """
-        )
+        for user_id in ("foo", "bar"):
+            await tokens.store(user_id, f"{user_id}__Utest-token", False, False, True)
+
+
+@pytest.fixture
+def moderator_token(event_loop):
+    event_loop.run_until_complete(_add_moderator_token())
+    return {"Authorization": "Bearer mod__Utest-token"}
+
+
+async def _add_moderator_token():
+    async with db.transaction():
+        await tokens.store("mod", "mod__Utest-token", False, True, False)
 
 
 class DummyResponse:
@@ -238,67 +266,6 @@ async def check_tag(product, k, **kwargs):
         assert data == expected_data
 
 
-@pytest.mark.asyncio
-async def test_versions_history(with_sample):
-    # after sample insertions we have history
-    async with db.transaction():
-        cur, _ = await db.db_exec(
-            """SELECT product, k, version, v, owner, editor, comment from folksonomy_versions"""
-        )
-        data = await cur.fetchall()
-        data = [
-            dict(zip(["product", "k", "version", "v", "owner", "editor", "comment"], d))
-            for d in data
-        ]
-    assert len(data) == 11  # cumulated versions of SAMPLE
-    # get data corresponding to sample (that is last version)
-    data_by_keys = {(d["product"], d["k"], d["version"]): d for d in data}
-    for k in sample_by_keys.keys():
-        version_data = data_by_keys.pop(k)
-        assert version_data == sample_by_keys[k]
-    # 4 older versions remaining (other where popped)
-    assert len(data_by_keys) == 4
-    old_versions = [data_by_keys[k] for k in sorted(data_by_keys.keys())]
-    assert old_versions == [
-        {
-            "product": "3701027900001",
-            "k": "other",
-            "version": 1,
-            "v": "so-private - 1",
-            "owner": "bar",
-            "editor": "bar",
-            "comment": "",
-        },
-        {
-            "product": "3701027900002",
-            "k": "color",
-            "version": 1,
-            "v": "green - 1",
-            "owner": "",
-            "editor": "foo",
-            "comment": "",
-        },
-        {
-            "product": "3701027900003",
-            "k": "color",
-            "version": 1,
-            "v": "red - 1",
-            "owner": "",
-            "editor": "foo",
-            "comment": "",
-        },
-        {
-            "product": "3701027900003",
-            "k": "color",
-            "version": 2,
-            "v": "red - 2",
-            "owner": "",
-            "editor": "foo",
-            "comment": "",
-        },
-    ]
-
-
 def test_hello(client):
     response = client.get("/")
     assert response.status_code == 200
@@ -312,6 +279,93 @@ def test_ping(client):
     assert response.status_code == 200
 
 
+def test_openapi_file(client, monkeypatch, tmp_path):
+    schema = app.openapi()
+    path = tmp_path / "openapi.json"
+    path.write_text(
+        json.dumps({**schema, "info": {**schema["info"], "title": "from file"}})
+    )
+    monkeypatch.setattr(settings, "OPENAPI_FILE", str(path))
+    monkeypatch.setattr(app, "openapi_schema", None)
+    response = client.get("/openapi.json")
+    assert response.json()["info"]["title"] == "from file"
+    assert response.json()["servers"] == settings.API_SERVERS
+    # generated if the file can't be read
+    monkeypatch.setattr(settings, "OPENAPI_FILE", str(tmp_path / "missing.json"))
+    monkeypatch.setattr(app, "openapi_schema", None)
+    assert client.get("/openapi.json").json() == schema
+
+
+def test_rate_limits(client, monkeypatch, auth_tokens):
+    admission.rate_limiter.clear()
+    admission.checked_tokens.clear()
+    monkeypatch.setattr(settings, "RATE_LIMIT_READ", 1)
+    monkeypatch.setattr(settings, "RATE_LIMIT_ADMIN", 1)
+    monkeypatch.setattr(settings, "RATE_LIMIT_BURST", 2)
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    try:
+        # the token is checked by this request, counted for the address
+        assert client.get(f"/product/{BARCODE_1}", headers=headers).status_code == 200
+        assert [client.get("/ping").status_code for _ in range(2)] == [200, 429]
+        response = client.get("/ping")
+        assert response.headers["retry-after"] == "1"
+        # unchecked tokens are counted for the address
+        forged = {"Authorization": f"Bearer foo__U{uuid.uuid4()}"}
+        assert client.get("/ping", headers=forged).status_code == 429
+        # each valid token, and each kind of request, has its own budget
+        assert client.get("/ping", headers=headers).status_code == 200
+        statuses = [client.get("/admin/jobs").status_code for _ in range(3)]
+        assert statuses == [401, 401, 429]
+        # writes are not limited
+        assert client.post("/product", json={}).status_code == 422
+        # client address given by a proxy, after addresses given by the client
+        monkeypatch.setattr(settings, "RATE_LIMIT_IP_HEADER", "X-Forwarded-For")
+        statuses = [
+            client.get(
+                "/ping", headers={"X-Forwarded-For": f"192.0.2.{i}, 10.0.0.1"}
+            ).status_code
+            for i in range(3)
+        ]
+        assert statuses == [200, 200, 429]
+    finally:
+        admission.rate_limiter.clear()
+        admission.checked_tokens.clear()
+
+
+@pytest.mark.asyncio
+async def test_admission_control(client, monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_WAIT_BUDGET", 0.05)
+    limiter = admission.ConcurrencyLimiter(1)
+    async with limiter.slot():
+        # waiting too long
+        with pytest.raises(admission.RejectedError) as exc_info:
+            async with limiter.slot():
+                pass
+        assert exc_info.value.status_code == 503
+        assert exc_info.value.retry_after == 1
+        # expected to wait too long, from previous requests durations
+        limiter.duration = 2
+        start = time.monotonic()
+        with pytest.raises(admission.RejectedError) as exc_info:
+            async with limiter.slot():
+                pass
+        assert time.monotonic() - start < 0.05
+        assert exc_info.value.retry_after == 2
+    assert limiter.waiting == 0
+    async with limiter.slot():
+        pass
+    assert limiter.duration < 2
+    monkeypatch.setattr(settings, "ADMISSION_MAX_CONCURRENT", 2)
+    assert client.get("/ping").status_code == 200
+
+
+def test_lazy_imports():
+    # database drivers are only imported by the configured backend
+    code = "import sys, folksonomy.api; print(*sys.modules)"
+    modules = subprocess.check_output([sys.executable, "-c", code], text=True).split()
+    assert not {"aiopg", "psycopg2", "asyncpg"} & set(modules)
+
+
 @pytest.mark.asyncio
 async def test_products_stats(with_sample, client):
     response = client.get("/products/stats")
@@ -401,6 +455,165 @@ async def test_products_list_filter_duplicate_code(with_sample, client):
     ]
 
 
+@pytest.mark.asyncio
+async def test_products_list_numeric(with_sample, client):
+    weights = {BARCODE_1: "12.5", BARCODE_2: "3", BARCODE_3: "heavy"}
+    async with db.transaction():
+        await create_data(
+            {"product": product, "k": "weight", "v": v, "version": 1, "editor": "foo"}
+            for product, v in weights.items()
+        )
+
+    def products(**params):
+        response = client.get("/products", params={"k": "weight", **params})
+        assert response.status_code == 200, response.text
+        return [item["product"] for item in response.json()]
+
+    assert sorted(products()) == [BARCODE_1, BARCODE_2, BARCODE_3]
+    # only numeric values are in ranges
+    assert products(v_min=5) == [BARCODE_1]
+    assert products(v_max="3") == [BARCODE_2]
+    assert products(v_min=3, v_max=12.5, sort="asc") == [BARCODE_2, BARCODE_1]
+    assert products(sort="desc") == [BARCODE_1, BARCODE_2]
+    assert products(sort="desc", limit=1) == [BARCODE_1]
+    response = client.get(
+        "/products?k=weight&sort=asc", headers={"Accept": formats.COLUMNAR_JSON}
+    )
+    assert response.json()["v"] == ["3", "12.5"]
+    for params in ({"v_min": "heavy"}, {"sort": "up"}, {"limit": 0}):
+        response = client.get("/products", params={"k": "weight", **params})
+        assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_search(with_sample, client):
+    notes = [
+        (BARCODE_1, "note", "Contains apples and pears"),
+        (BARCODE_2, "note", "Apple juice"),
+        (BARCODE_3, "label", "Organic apples, organic farming"),
+    ]
+    async with db.transaction():
+        await create_data(
+            {"product": product, "k": k, "v": v, "version": 1, "editor": "foo"}
+            for product, k, v in notes
+        )
+
+    def search(**params):
+        response = client.get("/search", params=params)
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    def matches(**params):
+        return [(r["product"], r["k"]) for r in search(**params)["results"]]
+
+    # across keys, best matches first
+    assert matches(q="organic") == [(BARCODE_3, "label")]
+    assert matches(q="apples") == [(BARCODE_1, "note"), (BARCODE_3, "label")]
+    assert matches(q="apples", k="note") == [(BARCODE_1, "note")]
+    # with stemming
+    assert sorted(matches(q="apple", lang="english")) == [
+        (BARCODE_1, "note"),
+        (BARCODE_2, "note"),
+        (BARCODE_3, "label"),
+    ]
+    assert matches(q="apples -organic", lang="english") == [
+        (BARCODE_1, "note"),
+        (BARCODE_2, "note"),
+    ]
+    assert matches(q="blue") == []
+    # pagination
+    results, after = [], None
+    while True:
+        page = search(q="apple", lang="english", limit=2, after=after)
+        results += page["results"]
+        after = page["next_after"]
+        if after is None:
+            break
+    assert results == search(q="apple", lang="english")["results"]
+    for params in ({"q": "apple", "lang": "klingon"}, {"q": "apple", "after": "x"}):
+        response = client.get("/search", params=params)
+        assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_overlay(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    before = client.get(f"/product/{BARCODE_1}").json()
+    # foo overrides the public color of BARCODE_1
+    response = client.post(
+        "/product",
+        headers=headers,
+        json={"product": BARCODE_1, "k": "color", "v": "blue", "owner": "foo"},
+    )
+    assert response.status_code == 200, response.text
+    response = client.get(f"/product/{BARCODE_1}?owner=foo&overlay=true")
+    assert response.status_code == 401
+    response = client.get(
+        f"/product/{BARCODE_1}?owner=foo&overlay=true", headers=headers
+    )
+    assert response.status_code == 200, response.text
+    assert [(t["k"], t["v"], t["owner"]) for t in response.json()] == [
+        ("color", "blue", "foo"),
+        ("private", "private", "foo"),
+        ("size", "medium", ""),
+    ]
+    response = client.get(
+        f"/product/{BARCODE_1}?owner=foo&overlay=true&keys=size", headers=headers
+    )
+    assert [t["k"] for t in response.json()] == ["size"]
+    # back in time, before foo's color
+    response = client.get(
+        f"/product/{BARCODE_1}",
+        params={"owner": "foo", "overlay": "true", "as_of": before[0]["last_edit"]},
+        headers=headers,
+    )
+    assert [(t["k"], t["v"], t["owner"]) for t in response.json()] == [
+        ("color", "red", ""),
+        ("private", "private", "foo"),
+        ("size", "medium", ""),
+    ]
+    # overridden values are not matched
+    response = client.get("/products?k=color&owner=foo&overlay=true", headers=headers)
+    assert sorted(response.json(), key=lambda d: d["product"]) == [
+        {"product": BARCODE_1, "k": "color", "v": "blue", "owner": "foo"},
+        {"product": BARCODE_2, "k": "color", "v": "green", "owner": ""},
+        {"product": BARCODE_3, "k": "color", "v": "red", "owner": ""},
+    ]
+    response = client.get(
+        "/products?k=color&v=red&owner=foo&overlay=true", headers=headers
+    )
+    assert response.json() == [
+        {"product": BARCODE_3, "k": "color", "v": "red", "owner": ""}
+    ]
+    response = client.get(
+        "/products?k=color&owner=foo&overlay=true",
+        headers={**headers, "Accept": formats.COLUMNAR_JSON},
+    )
+    assert sorted(zip(*response.json().values())) == [
+        (BARCODE_1, "color", "blue", "foo"),
+        (BARCODE_2, "color", "green", ""),
+        (BARCODE_3, "color", "red", ""),
+    ]
+    response = client.get(
+        f"/values?codes={BARCODE_1},{BARCODE_2}&owner=foo&overlay=true",
+        headers=headers,
+    )
+    assert [(d["product"], d["k"], d["v"], d["owner"]) for d in response.json()] == [
+        (BARCODE_1, "color", "blue", "foo"),
+        (BARCODE_1, "private", "private", "foo"),
+        (BARCODE_1, "size", "medium", ""),
+        (BARCODE_2, "color", "green", ""),
+        (BARCODE_2, "size", "small", ""),
+    ]
+    # public tags only, without owner
+    response = client.get("/values?keys=color&overlay=true")
+    assert [(d["product"], d["v"]) for d in response.json()] == [
+        (BARCODE_1, "red"),
+        (BARCODE_2, "green"),
+        (BARCODE_3, "red"),
+    ]
+
+
 @pytest.mark.asyncio
 async def test_products_list_private(with_sample, client, auth_tokens):
     response = client.get("/products?owner=foo&k=private")
@@ -529,6 +742,147 @@ async def test_product_key_versions_missing(with_sample, client):
     assert response.json() == []
 
 
+@pytest.mark.asyncio
+async def test_product_history(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    before = client.get(f"/product/{BARCODE_3}").json()
+    response = client.put(
+        "/product",
+        headers=headers,
+        json={"product": BARCODE_3, "k": "color", "v": "blue", "version": 4},
+    )
+    assert response.status_code == 200, response.text
+    updated = client.get(f"/product/{BARCODE_3}").json()
+    response = client.delete(f"/product/{BARCODE_3}/color?version=4", headers=headers)
+    assert response.status_code == 200, response.text
+    # all versions, most recent first
+    response = client.get(f"/product/{BARCODE_3}/history")
+    assert response.status_code == 200
+    data = response.json()
+    assert [(r["k"], r["version"]) for r in data["results"]] == [
+        ("color", 0),
+        ("color", 4),
+        ("color", 3),
+        ("color", 2),
+        ("color", 1),
+    ]
+    assert data["next_after"] is None
+    # pagination
+    results, after = [], None
+    while True:
+        params = {"limit": 2} if after is None else {"limit": 2, "after": after}
+        page = client.get(f"/product/{BARCODE_3}/history", params=params).json()
+        results += page["results"]
+        after = page["next_after"]
+        if after is None:
+            break
+    assert results == data["results"]
+    response = client.get(f"/product/{BARCODE_3}/history", params={"after": "x"})
+    assert response.status_code == 422
+    # private history
+    response = client.get(f"/product/{BARCODE_1}/history?owner=foo")
+    assert response.status_code == 401
+    response = client.get(f"/product/{BARCODE_1}/history?owner=foo", headers=headers)
+    assert [r["k"] for r in response.json()["results"]] == ["private"]
+
+    # tags at a point in time
+    def as_of(when):
+        response = client.get(f"/product/{BARCODE_3}", params={"as_of": when})
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    assert as_of(before[0]["last_edit"]) == before
+    assert as_of(before[0]["last_edit"] + "+00:00") == before
+    assert as_of(updated[0]["last_edit"]) == updated
+    assert as_of("2000-01-01T00:00:00") == []
+    assert (
+        as_of(time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 60))) == []
+    )
+    response = client.get(
+        f"/product/{BARCODE_3}",
+        params={"as_of": updated[0]["last_edit"], "keys": "color,size"},
+    )
+    assert response.json() == updated
+    # update and deletion in the same transaction, archived with the same last_edit
+    async with db.transaction():
+        await db.db_exec(
+            "UPDATE folksonomy SET v = 'blue', version = 3 "
+            "WHERE product = %s AND owner = '' AND k = 'color'",
+            (BARCODE_2,),
+        )
+        await db.db_exec(
+            "DELETE FROM folksonomy WHERE product = %s AND owner = '' AND k = 'color'",
+            (BARCODE_2,),
+        )
+    history = client.get(f"/product/{BARCODE_2}/history").json()["results"]
+    assert [(r["k"], r["version"]) for r in history][:2] == [("color", 0), ("color", 3)]
+    response = client.get(
+        f"/product/{BARCODE_2}", params={"as_of": history[0]["last_edit"]}
+    )
+    assert [r["k"] for r in response.json()] == ["size"]
+
+
+@pytest.mark.asyncio
+async def test_versions_history(with_sample):
+    # after sample insertions we have history
+    async with db.transaction():
+        cur, _ = await db.db_exec(
+            """SELECT product, k, version, v, owner, editor, comment from folksonomy_versions"""
+        )
+        data = await cur.fetchall()
+        data = [
+            dict(zip(["product", "k", "version", "v", "owner", "editor", "comment"], d))
+            for d in data
+        ]
+    assert len(data) == 11  # cumulated versions of SAMPLE
+    # get data corresponding to sample (that is last version)
+    data_by_keys = {(d["product"], d["k"], d["version"]): d for d in data}
+    for k in sample_by_keys.keys():
+        version_data = data_by_keys.pop(k)
+        assert version_data == sample_by_keys[k]
+    # 4 older versions remaining (other where popped)
+    assert len(data_by_keys) == 4
+    old_versions = [data_by_keys[k] for k in sorted(data_by_keys.keys())]
+    assert old_versions == [
+        {
+            "product": "3701027900001",
+            "k": "other",
+            "version": 1,
+            "v": "so-private - 1",
+            "owner": "bar",
+            "editor": "bar",
+            "comment": "",
+        },
+        {
+            "product": "3701027900002",
+            "k": "color",
+            "version": 1,
+            "v": "green - 1",
+            "owner": "",
+            "editor": "foo",
+            "comment": "",
+        },
+        {
+            "product": "3701027900003",
+            "k": "color",
+            "version": 1,
+            "v": "red - 1",
+            "owner": "",
+            "editor": "foo",
+            "comment": "",
+        },
+        {
+            "product": "3701027900003",
+            "k": "color",
+            "version": 2,
+            "v": "red - 2",
+            "owner": "",
+            "editor": "foo",
+            "comment": "",
+        },
+    ]
+
+
 @pytest.mark.asyncio
 async def test_products_stats_key(with_sample, client):
     response = client.get("/products/stats?k=color")
@@ -554,6 +908,65 @@ async def test_products_stats_key_value(with_sample, client):
     ]
 
 
+@pytest.mark.asyncio
+async def test_products_query(with_sample, client, auth_tokens):
+    def products_query(query, **params):
+        response = client.post("/products/query", params=params, json={"query": query})
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    red_without_size = {"and": [{"k": "color", "v": "red"}, {"not": {"k": "size"}}]}
+    green_or_medium = {
+        "or": [{"k": "color", "v": "green"}, {"k": "size", "v": "medium"}]
+    }
+    # without statistics, then with them (anti-join instead of EXCEPT)
+    for merged in (False, True):
+        if merged:
+            await stats.merge_all()
+        assert products_query(red_without_size)["products"] == [BARCODE_3]
+        assert products_query(green_or_medium)["products"] == [BARCODE_1, BARCODE_2]
+        assert products_query({"and": [{"k": "color"}, {"k": "size"}]}) == {
+            "products": [BARCODE_1, BARCODE_2],
+            "next_after": None,
+        }
+    # private tags
+    assert products_query({"k": "private"})["products"] == []
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    response = client.post(
+        "/products/query?owner=foo",
+        json={"query": {"or": [{"k": "private"}, {"k": "other"}]}},
+        headers=headers,
+    )
+    assert response.json()["products"] == [BARCODE_1]
+    # pagination
+    page = products_query({"k": "color"}, limit=2)
+    assert page == {"products": [BARCODE_1, BARCODE_2], "next_after": BARCODE_2}
+    page = products_query({"k": "color"}, limit=2, after=page["next_after"])
+    assert page == {"products": [BARCODE_3], "next_after": None}
+    # not must be combined with other conditions
+    for invalid in ({"not": {"k": "color"}}, {"and": [{"not": {"k": "color"}}]}):
+        response = client.post("/products/query", json={"query": invalid})
+        assert response.status_code == 422
+    response = client.post("/products/query", json={"query": {"k": "color", "x": 1}})
+    assert response.status_code == 422
+
+
+def test_query_selectivity_order():
+    condition = models.AndCondition.model_validate(
+        {"and": [{"k": "common"}, {"k": "rare", "v": "x"}, {"not": {"k": "other"}}]}
+    )
+    stats = {"common": (1000, 10), "rare": (100, 50), "other": (10, 1)}
+    sql, params = query.compile_condition(condition, "", None, stats)
+    # rarest first, and excluded tags are more common than matches: anti-join
+    assert params == ["", "rare", "x", "", "common", "", "other"]
+    assert "INTERSECT" in sql and "NOT EXISTS" in sql
+    # excluding less products than matches: EXCEPT
+    stats["other"] = (1, 1)
+    sql, params = query.compile_condition(condition, "", "123", stats)
+    assert "EXCEPT" in sql and "NOT EXISTS" not in sql
+    assert params[-3:] == ["", "other", "123"]
+
+
 @pytest.mark.asyncio
 async def test_products_list_key(with_sample, client):
     response = client.get("/products?k=color")
@@ -577,6 +990,106 @@ async def test_products_list_key_value(with_sample, client):
     ]
 
 
+@pytest.mark.asyncio
+async def test_products_list_columnar(with_sample, client):
+    response = client.get(
+        "/products?k=color&v=red",
+        headers={"Accept": "application/vnd.folksonomy.columnar+json"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == formats.COLUMNAR_JSON
+    assert response.headers["vary"] == "Accept"
+    data = response.json()
+    assert sorted(data["product"]) == [BARCODE_1, BARCODE_3]
+    assert data["k"] == ["color", "color"]
+    assert data["v"] == ["red", "red"]
+    # empty result keeps columns
+    response = client.get("/products?k=nope", headers={"Accept": formats.COLUMNAR_JSON})
+    assert response.json() == {"product": [], "k": [], "v": []}
+
+
+@pytest.mark.asyncio
+async def test_compression(with_sample, client, monkeypatch):
+    monkeypatch.setattr(settings, "COMPRESSION_MIN_SIZE", 50)
+    compression.cache.clear()
+    uncompressed = client.get("/keys", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in uncompressed.headers
+    assert uncompressed.headers["vary"] == "Accept-Encoding"
+    for coding in compression.COMPRESSORS:
+        response = client.get("/keys", headers={"Accept-Encoding": coding})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == coding
+        assert int(response.headers["content-length"]) < len(uncompressed.content)
+        assert response.json() == uncompressed.json()
+    # compressed bodies are kept once seen twice, then reused
+    assert len(compression.cache) == 0
+    response = client.get("/keys", headers={"Accept-Encoding": "gzip"})
+    assert len(compression.cache) == 1
+    assert compression.cache.hits == 0
+    response = client.get("/keys", headers={"Accept-Encoding": "gzip"})
+    assert compression.cache.hits == 1
+    # large bodies are compressed in a thread
+    monkeypatch.setattr(settings, "COMPRESSION_THREAD_SIZE", 100)
+    response = client.get("/products?k=color", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 3
+    # small responses are not compressed
+    response = client.get("/ping", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    # Vary is extended, and not repeated
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    middleware = compression.CompressionMiddleware(None)
+    for vary, expected in [
+        (b"Accept", [b"Accept, Accept-Encoding"]),
+        (b"accept, accept-encoding", [b"accept, accept-encoding"]),
+        (b"*", [b"*"]),
+    ]:
+        start = {
+            "type": "http.response.start",
+            "headers": [(b"content-type", b"application/json"), (b"vary", vary)],
+        }
+        await middleware.send_response(start, b"[0]" * 50, "gzip", send)
+        headers = sent[-2]["headers"]
+        assert [v for n, v in headers if n == b"vary"] == expected
+
+
+def test_negotiate_compression():
+    assert compression.negotiate(None) is None
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate("gzip, deflate") == "gzip"
+    assert compression.negotiate("gzip;q=0.5, *") == next(iter(compression.COMPRESSORS))
+    assert compression.negotiate("gzip;q=0") is None
+    assert compression.negotiate("br;q=0.5, gzip") == "gzip"
+
+
+def test_negotiate_format():
+    assert formats.negotiate(None) == formats.JSON
+    assert formats.negotiate("text/html, */*;q=0.8") == formats.JSON
+    assert formats.negotiate(formats.COLUMNAR_JSON) == formats.COLUMNAR_JSON
+    assert (
+        formats.negotiate(f"application/json;q=0.5, {formats.COLUMNAR_JSON}")
+        == formats.COLUMNAR_JSON
+    )
+    assert (
+        formats.negotiate(f"application/json, {formats.COLUMNAR_JSON};q=0.9")
+        == formats.JSON
+    )
+    # exact media types are preferred over wildcards with the same quality
+    assert formats.negotiate(f"*/*, {formats.COLUMNAR_JSON}") == formats.COLUMNAR_JSON
+    assert (
+        formats.negotiate(f"application/*, {formats.COLUMNAR_JSON}")
+        == formats.COLUMNAR_JSON
+    )
+    assert formats.negotiate(f"*/*, {formats.COLUMNAR_JSON};q=0.5") == formats.JSON
+    assert formats.negotiate(f"{formats.COLUMNAR_JSON};q=0, */*") == formats.JSON
+    if formats.msgpack is not None:
+        assert formats.negotiate("*/*, application/msgpack") == formats.MSGPACK
+
+
 @pytest.mark.asyncio
 async def test_keys_list(with_sample, client):
     response = client.get("/keys")
@@ -600,6 +1113,60 @@ async def test_keys_list(with_sample, client):
     assert response.json() == []
 
 
+@pytest.mark.asyncio
+async def test_approximate_stats(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    await stats.merge_all()
+    response = client.get("/keys?approx=true")
+    assert response.status_code == 200
+    assert sorted(response.json(), key=lambda d: d["k"]) == [
+        {"k": "color", "count": 3, "values": 2},
+        {"k": "size", "count": 2, "values": 2},
+    ]
+    response = client.get("/keys?approx=true&owner=foo", headers=headers)
+    assert response.json() == [{"k": "private", "count": 1, "values": 1}]
+    response = client.get("/products/stats?approx=true")
+    assert response.status_code == 200
+    assert sorted((d["product"], d["keys"], d["editors"]) for d in response.json()) == [
+        (BARCODE_1, 2, 1),
+        (BARCODE_2, 2, 2),
+        (BARCODE_3, 1, 1),
+    ]
+    # statistics follow changes, once merged
+    response = client.delete(f"/product/{BARCODE_2}/size?version=1", headers=headers)
+    assert response.status_code == 200, response.text
+    response = client.put(
+        "/product",
+        headers=headers,
+        json={"product": BARCODE_3, "k": "color", "v": "blue", "version": 4},
+    )
+    assert response.status_code == 200, response.text
+    await stats.merge_all()
+    response = client.get("/keys?approx=true")
+    assert sorted(response.json(), key=lambda d: d["k"]) == [
+        {"k": "color", "count": 3, "values": 3},
+        {"k": "size", "count": 1, "values": 1},
+    ]
+    response = client.get("/products/stats?approx=true")
+    assert sorted((d["product"], d["keys"], d["editors"]) for d in response.json()) == [
+        (BARCODE_1, 2, 1),
+        (BARCODE_2, 1, 1),
+        (BARCODE_3, 1, 1),
+    ]
+
+
+def test_hll_estimate():
+    sketch = hll.HyperLogLog(str(i) for i in range(50000))
+    assert abs(sketch.estimate() - 50000) < 50000 * 3 * hll.ERROR
+    # small counts are exact, and sketches can be merged
+    small = hll.HyperLogLog(["a", "b", "c"])
+    assert small.estimate() == 3
+    small.merge(hll.HyperLogLog(["c", "d"]))
+    assert hll.HyperLogLog.from_bytes(small.to_bytes()).estimate() == 4
+    sketch.merge(small)
+    assert hll.HyperLogLog.from_bytes(sketch.to_bytes()).estimate() == sketch.estimate()
+
+
 @pytest.mark.asyncio
 async def test_get_unique_values(with_sample, client):
     response = client.get("/values/color")
@@ -697,6 +1264,26 @@ async def test_get_values_filter_codes_and_keys(with_sample, client):
     assert data[0]["v"] == "red"
 
 
+@pytest.mark.asyncio
+async def test_get_values_msgpack(with_sample, client):
+    msgpack = pytest.importorskip("msgpack")
+    response = client.get(
+        f"/values?codes={BARCODE_1},{BARCODE_2}&keys=color",
+        headers={"Accept": "application/msgpack"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == formats.MSGPACK
+    data = msgpack.unpackb(response.content)
+    assert data["product"] == [BARCODE_1, BARCODE_2]
+    assert data["v"] == ["red", "green"]
+    assert data["version"] == [1, 2]
+    # same values as in JSON
+    json_data = client.get(f"/values?codes={BARCODE_1},{BARCODE_2}&keys=color").json()
+    assert [d[:19] for d in data["last_edit"]] == [
+        d["last_edit"][:19] for d in json_data
+    ]
+
+
 @pytest.mark.asyncio
 async def test_get_values_multi_filter(with_sample, client):
     url = f"/values?codes={BARCODE_1},{BARCODE_2}&keys=size"
@@ -738,6 +1325,58 @@ async def test_get_values_malformed_csv(with_sample, client):
     assert len(data) >= 2
 
 
+@pytest.mark.asyncio
+async def test_lookup_values(with_sample, client):
+    response = client.post(
+        "/values/lookup",
+        json={
+            "codes": [BARCODE_1, " " + BARCODE_3, "0000000000000"],
+            "pairs": [[BARCODE_2, "size"], [BARCODE_2, "missing"], [BARCODE_1, "size"]],
+        },
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {
+        BARCODE_1: {"color": "red", "size": "medium"},
+        BARCODE_2: {"size": "small"},
+        BARCODE_3: {"color": "red"},
+    }
+    # codes restricted to keys
+    response = client.post(
+        "/values/lookup",
+        json={"codes": [BARCODE_1, BARCODE_2], "keys": ["color"]},
+    )
+    assert response.json() == {
+        BARCODE_1: {"color": "red"},
+        BARCODE_2: {"color": "green"},
+    }
+    # no match
+    response = client.post("/values/lookup", json={"pairs": [["0000000000000", "k"]]})
+    assert response.status_code == 200
+    assert response.json() == {}
+
+
+@pytest.mark.asyncio
+async def test_lookup_values_private(with_sample, client, auth_tokens):
+    lookup = {"codes": [BARCODE_1]}
+    response = client.post("/values/lookup?owner=foo", json=lookup)
+    assert response.status_code == 401
+    response = client.post(
+        "/values/lookup?owner=foo",
+        json=lookup,
+        headers={"Authorization": "Bearer foo__Utest-token"},
+    )
+    assert response.json() == {BARCODE_1: {"private": "private"}}
+
+
+def test_lookup_values_invalid(client):
+    response = client.post("/values/lookup", json={"keys": ["color"]})
+    assert response.status_code == 422
+    response = client.post("/values/lookup", json={"pairs": [[BARCODE_1]]})
+    assert response.status_code == 422
+    response = client.post("/values/lookup", json={"codes": ["1"] * 50001})
+    assert response.status_code == 422
+
+
 def test_auth_empty(client):
     response = client.post("/auth")
     assert response.status_code == 422
@@ -759,6 +1398,45 @@ def test_auth_ok(fake_authentication, client):
     assert access_token.startswith("off__U")
 
 
+@pytest.mark.asyncio
+async def test_read_your_writes_on_replica(with_sample, auth_tokens, monkeypatch):
+    # the primary stands for its own replica
+    monkeypatch.setattr(settings, "POSTGRES_REPLICA_HOSTS", [settings.POSTGRES_HOST])
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    with TestClient(app) as replica_client:
+        response = replica_client.post(
+            "/product",
+            headers=headers,
+            json={"product": BARCODE_1, "version": 1, "k": "test_new", "v": "test"},
+        )
+        assert response.status_code == 200, response.text
+        lsn = response.headers["x-pg-lsn"]
+        headers["x-pg-lsn"] = lsn
+        # authenticated read, on the replica
+        response = replica_client.get(
+            f"/product/{BARCODE_1}/private?owner=foo", headers=headers
+        )
+        assert response.status_code == 200, response.text
+        assert response.json()["v"] == "private"
+        response = replica_client.get(f"/product/{BARCODE_1}/test_new", headers=headers)
+        assert response.json()["v"] == "test"
+        # no lsn on reads or errors
+        assert "x-pg-lsn" not in response.headers
+        response = replica_client.post("/product", headers=headers, json={})
+        assert response.status_code == 422
+        assert "x-pg-lsn" not in response.headers
+        # tickets are written after the response, they are read on the primary
+        in_replica = []
+
+        async def status(ticket):
+            in_replica.append(db.in_replica())
+
+        monkeypatch.setattr(writes, "status", status)
+        response = replica_client.get(f"/tickets/{uuid.uuid4()}", headers=headers)
+        assert response.status_code == 404
+        assert in_replica == [False]
+
+
 @pytest.mark.asyncio
 async def test_post_invalid(with_sample, client, auth_tokens):
     headers = {"Authorization": "Bearer foo__Utest-token"}
@@ -901,6 +1579,122 @@ async def test_post(with_sample, client, auth_tokens):
     await check_tag(BARCODE_1, "a-1:b_2:c-3:d_4", v="test", version=1)
 
 
+@pytest.mark.asyncio
+async def test_post_async(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    tags = [
+        {"product": BARCODE_3, "k": "size", "v": "large"},
+        # same key: the first one wins
+        {"product": BARCODE_3, "k": "size", "v": "small"},
+        # existing tag
+        {"product": BARCODE_1, "k": "color", "v": "blue"},
+        # refused by the database
+        {"product": BARCODE_2, "k": "weight", "v": "1", "comment": "x" * 300},
+    ]
+    tickets = []
+    for tag in tags:
+        response = client.post("/product?async=1", headers=headers, json=tag)
+        assert response.status_code == 202, response.text
+        assert response.json()["status"] == "pending"
+        ticket = response.json()["ticket"]
+        assert response.headers["location"] == f"/tickets/{ticket}"
+        tickets.append(ticket)
+    outcomes = []
+    deadline = time.monotonic() + 5
+    for ticket in tickets:
+        while True:
+            response = client.get(f"/tickets/{ticket}")
+            assert response.status_code == 200
+            if response.json()["status"] != "pending" or time.monotonic() > deadline:
+                break
+            time.sleep(0.01)
+        outcomes.append(response.json())
+    assert [outcome["status"] for outcome in outcomes] == [
+        "created",
+        "conflict",
+        "conflict",
+        "failed",
+    ]
+    assert "too long" in outcomes[3]["error"]
+    await check_tag(BARCODE_3, "size", v="large", version=1)
+    await check_tag(BARCODE_1, "color", v="red")
+    # versions are checked before
+    response = client.post(
+        "/product?async=1",
+        headers=headers,
+        json={"product": BARCODE_3, "k": "new", "v": "new", "version": 2},
+    )
+    assert response.status_code == 422
+    # authentication is needed
+    response = client.post("/product?async=1", json=tags[0])
+    assert response.status_code == 401
+    assert client.get(f"/tickets/{uuid.uuid4()}").status_code == 404
+    assert client.get("/tickets/not-a-ticket").status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"result": len(calls)}
+
+    results = await asyncio.gather(*(coalesce.run("key", fetch) for _ in range(5)))
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    # other keys are not shared
+    await asyncio.gather(coalesce.run("key", fetch), coalesce.run("other", fetch))
+    assert len(calls) == 3
+
+    # errors are raised to all callers
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(
+        *(coalesce.run("key", fail) for _ in range(3)), return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    # if the first caller is cancelled, others fetch themselves
+    first = asyncio.create_task(coalesce.run("key", fetch))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(coalesce.run("key", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert (await second) == {"result": 5}
+    assert not coalesce.flights[asyncio.get_running_loop()]
+
+
+@pytest.mark.asyncio
+async def test_coalesced_requests(with_sample, monkeypatch):
+    queries = []
+    db_exec = db.db_exec
+
+    async def counting_db_exec(query, params=()):
+        if "FROM folksonomy" in query:
+            queries.append(params)
+        return await db_exec(query, params)
+
+    monkeypatch.setattr(db, "db_exec", counting_db_exec)
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            urls = [f"/product/{BARCODE_1}"] * 5 + [f"/product/{BARCODE_2}"] * 5
+            responses = await asyncio.gather(*(c.get(url) for url in urls))
+            assert len({r.content for r in responses[:5]}) == 1
+            assert [t["k"] for t in responses[0].json()] == ["color", "size"]
+            assert responses[5].json()[0]["v"] == "green"
+            # at least some requests were served by another one query
+            assert len(queries) < len(urls)
+            # owners are checked before sharing
+            response = await c.get(f"/product/{BARCODE_1}?owner=foo")
+            assert response.status_code == 401
+    finally:
+        await db.terminate()
+
+
 @pytest.mark.asyncio
 async def test_product_key_stripped_on_post(auth_tokens, client):
     headers = {"Authorization": "Bearer foo__Utest-token"}
@@ -982,6 +1776,84 @@ async def test_put(with_sample, client, auth_tokens):
     await check_tag(BARCODE_1, "color", v="brown", version=3)
 
 
+@pytest.mark.asyncio
+async def test_put_version_conflict_message(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    response = client.put(
+        "/product",
+        headers=headers,
+        json={"product": BARCODE_2, "k": "color", "v": "test", "version": 4},
+    )
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["msg"] == (
+        "Value error, version must be exactly 3"
+    )
+    await check_tag(BARCODE_2, "color", v="green", version=2)
+
+
+@pytest.mark.asyncio
+async def test_upsert(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    tag = {"product": BARCODE_1, "k": "test_new", "v": "test"}
+    # create
+    response = client.post("/product/upsert", headers=headers, json=tag)
+    assert response.status_code == 200, response.text
+    assert response.json() == {"version": 1}
+    await check_tag(BARCODE_1, "test_new", v="test", version=1, editor="foo")
+    # update, whatever the version in body
+    response = client.post(
+        "/product/upsert", headers=headers, json=dict(tag, v="test2", version=7)
+    )
+    assert response.json() == {"version": 2}
+    await check_tag(BARCODE_1, "test_new", v="test2", version=2)
+    # history is kept
+    response = client.get(f"/product/{BARCODE_1}/test_new/versions")
+    assert [d["version"] for d in response.json()] == [2, 1]
+    # with expected version
+    response = client.post(
+        "/product/upsert?expected_version=2", headers=headers, json=dict(tag, v="t3")
+    )
+    assert response.json() == {"version": 3}
+    await check_tag(BARCODE_1, "test_new", v="t3", version=3)
+    response = client.post(
+        "/product/upsert?expected_version=2", headers=headers, json=dict(tag, v="t4")
+    )
+    assert response.status_code == 422
+    assert "Version conflict" in response.json()["detail"]
+    # create only
+    response = client.post(
+        "/product/upsert?expected_version=0", headers=headers, json=dict(tag, v="t4")
+    )
+    assert response.status_code == 422
+    await check_tag(BARCODE_1, "test_new", v="t3", version=3)
+    response = client.post(
+        "/product/upsert?expected_version=0",
+        headers=headers,
+        json=dict(tag, k="other"),
+    )
+    assert response.json() == {"version": 1}
+    # update of a missing tag
+    response = client.post(
+        "/product/upsert?expected_version=1",
+        headers=headers,
+        json=dict(tag, k="missing"),
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upsert_invalid(with_sample, client, auth_tokens):
+    tag = {"product": BARCODE_1, "k": "test_new", "v": "test"}
+    response = client.post("/product/upsert", json=tag)
+    assert response.status_code == 401
+    response = client.post(
+        "/product/upsert",
+        headers={"Authorization": "Bearer foo__Utest-token"},
+        json=dict(tag, owner="bar"),
+    )
+    assert response.status_code == 422
+
+
 @pytest.mark.asyncio
 async def test_delete_invalid(with_sample, client, auth_tokens):
     headers = {"Authorization": "Bearer foo__Utest-token"}
@@ -1010,6 +1882,18 @@ async def test_delete_invalid(with_sample, client, auth_tokens):
     assert response.status_code == 422, (
         f"invalid version should return 422, got {response.status_code} {response.text}"
     )
+    assert response.json()["detail"] == (
+        "version mismatch, last version for this product/k is 2"
+    )
+
+    response = client.delete(
+        f"/product/{BARCODE_1}/not-existing?version=1",
+        headers=headers,
+    )
+    assert response.status_code == 404, (
+        f"missing tag should return 404, got {response.status_code} {response.text}"
+    )
+    assert response.json()["detail"] == "Unknown product/k for this owner"
 
 
 @pytest.mark.asyncio
@@ -1045,6 +1929,104 @@ async def test_delete(with_sample, client, auth_tokens):
     await check_tag(BARCODE_1, "color", v="brown", version=2)
 
 
+@pytest.mark.asyncio
+async def test_delete_keeps_history(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer bar__Utest-token"}
+    response = client.delete(f"/product/{BARCODE_2}/color?version=2", headers=headers)
+    assert response.status_code == 200, response.text
+    response = client.get(f"/product/{BARCODE_2}/color")
+    assert response.json() == []
+    response = client.get(f"/product/{BARCODE_2}/color/versions")
+    versions = response.json()
+    assert [(d["version"], d["v"]) for d in versions] == [
+        (2, "green"),
+        (1, "green - 1"),
+        (0, "green"),
+    ]
+    assert versions[-1]["editor"] == "bar"
+    assert versions[-1]["comment"] == "DELETE"
+    # missing and version mismatch
+    response = client.delete(f"/product/{BARCODE_2}/color?version=2", headers=headers)
+    assert response.status_code == 404
+    response = client.delete(f"/product/{BARCODE_1}/color?version=2", headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"] == (
+        "version mismatch, last version for this product/k is 1"
+    )
+    # keys are case insensitive
+    response = client.delete(f"/product/{BARCODE_1}/COLOR?version=1", headers=headers)
+    assert response.status_code == 200, response.text
+    # the deleting user only applies to the statement setting it
+    async with db.transaction():
+        await db.db_exec(
+            *db.delete_product_tag_req(BARCODE_2, "", "size", 1, "moderator")
+        )
+        await db.db_exec(
+            "DELETE FROM folksonomy WHERE product = %s AND owner = '' AND k = 'color'",
+            (BARCODE_3,),
+        )
+    response = client.get(f"/product/{BARCODE_2}/size/versions")
+    assert response.json()[-1]["editor"] == "moderator"
+    response = client.get(f"/product/{BARCODE_3}/color/versions")
+    assert response.json()[-1]["version"] == 0
+    # the last editor of the tag
+    assert response.json()[-1]["editor"] == "foo"
+
+
+@pytest.mark.asyncio
+async def test_batch_delete(with_sample, client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    response = client.request(
+        "DELETE",
+        "/product",
+        headers=headers,
+        json=[
+            {"product": BARCODE_1, "k": "color", "version": 1},
+            {"product": BARCODE_2, "k": "color", "version": 2},
+            {"product": BARCODE_3, "k": "color", "version": 1},
+            {"product": BARCODE_3, "k": "missing", "version": 1},
+        ],
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {
+        "deleted": 2,
+        "not_deleted": [
+            {"product": BARCODE_3, "k": "color", "version": 1},
+            {"product": BARCODE_3, "k": "missing", "version": 1},
+        ],
+    }
+    response = client.get("/products?k=color")
+    assert [d["product"] for d in response.json()] == [BARCODE_3]
+    # entries are told apart by version, keys are case insensitive
+    response = client.request(
+        "DELETE",
+        "/product",
+        headers=headers,
+        json=[
+            {"product": BARCODE_3, "k": "color", "version": 1},
+            {"product": BARCODE_3, "k": "COLOR", "version": 3},
+        ],
+    )
+    assert response.json() == {
+        "deleted": 1,
+        "not_deleted": [{"product": BARCODE_3, "k": "color", "version": 1}],
+    }
+    response = client.get(f"/product/{BARCODE_1}/color/versions")
+    assert response.json()[-1]["version"] == 0
+    assert response.json()[-1]["editor"] == "foo"
+    # private tags are deleted only for owner
+    private = [{"product": BARCODE_1, "k": "private", "version": 1}]
+    response = client.request("DELETE", "/product", headers=headers, json=private)
+    assert response.json()["deleted"] == 0
+    response = client.request(
+        "DELETE", "/product?owner=foo", headers=headers, json=private
+    )
+    assert response.json()["deleted"] == 1
+    # authentication is needed
+    response = client.request("DELETE", "/product", json=private)
+    assert response.status_code == 401
+
+
 @pytest.mark.asyncio
 async def test_auth_by_cookie(fake_authentication, monkeypatch, client):
     # avoid waiting for too long on bad auth
@@ -1098,6 +2080,50 @@ async def test_auth_by_cookie(fake_authentication, monkeypatch, client):
         )
 
 
+@pytest.mark.asyncio
+async def test_token_expiry(client, auth_tokens):
+    headers = {"Authorization": "Bearer foo__Utest-token"}
+    async with db.transaction():
+        # only a digest of the token is stored
+        cur, _ = await db.db_exec(
+            "SELECT user_id FROM auth WHERE token_hash = %s",
+            (tokens.hash_token("foo__Utest-token"),),
+        )
+        assert (await cur.fetchone())[0] == "foo"
+        # token not used for a while, but not expired yet
+        await db.db_exec(
+            """
+            UPDATE auth SET last_use = last_use - interval '1 day',
+                expires_at = current_timestamp AT TIME ZONE 'GMT' + interval '1 hour'
+            WHERE user_id = 'foo'
+            """
+        )
+    response = client.get("/user/me", headers=headers)
+    assert response.status_code == 200
+    # its use extended its lifetime
+    async with db.transaction():
+        cur, _ = await db.db_exec(
+            """
+            SELECT expires_at > current_timestamp AT TIME ZONE 'GMT' + interval '1 day'
+            FROM auth WHERE user_id = 'foo'
+            """
+        )
+        assert (await cur.fetchone())[0]
+        await db.db_exec(
+            """
+            UPDATE auth SET expires_at = current_timestamp AT TIME ZONE 'GMT'
+            WHERE user_id = 'foo'
+            """
+        )
+    response = client.get("/user/me", headers=headers)
+    assert response.status_code == 401
+    # purge deletes expired tokens only
+    assert await tokens.purge() == 1
+    async with db.transaction():
+        cur, _ = await db.db_exec("SELECT user_id FROM auth")
+        assert [row[0] for row in await cur.fetchall()] == ["bar"]
+
+
 @pytest.mark.asyncio
 async def test_get_user_info_unauthenticated(client):
     """Test /user/me endpoint without authentication"""
@@ -1127,3 +2153,224 @@ async def test_get_user_info_authenticated(client, auth_tokens):
     assert isinstance(data["admin"], bool)
     assert isinstance(data["moderator"], bool)
     assert isinstance(data["user"], bool)
+
+
+def wait_job(client, headers, job_id, timeout=10):
+    """Wait for a job to be finished, returning it"""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/admin/jobs/{job_id}", headers=headers).json()
+        if job["status"] not in ("pending", "running") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_background_delete_property(
+    with_sample, client, moderator_token, monkeypatch
+):
+    monkeypatch.setattr(settings, "JOBS_BATCH_SIZE", 1)
+    monkeypatch.setattr(settings, "JOBS_POLL_INTERVAL", 0.05)
+    response = client.request(
+        "DELETE",
+        "/admin/property?background=true",
+        headers=moderator_token,
+        json={"property": "color"},
+    )
+    assert response.status_code == 202, response.text
+    job = response.json()
+    assert job["kind"] == "property_delete"
+    assert job["total"] == 3
+    job = wait_job(client, moderator_token, job["id"])
+    assert job["status"] == "done"
+    assert job["processed"] == 3
+    assert client.get("/products?k=color").json() == []
+    versions = client.get(f"/product/{BARCODE_1}/color/versions").json()
+    assert versions[-1]["editor"] == "mod"
+    # jobs listing
+    response = client.get("/admin/jobs?status=done", headers=moderator_token)
+    assert [j["id"] for j in response.json()] == [job["id"]]
+    # nothing to do
+    response = client.request(
+        "DELETE",
+        "/admin/property?background=true",
+        headers=moderator_token,
+        json={"property": "color"},
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_background_rename_and_replace(
+    with_sample, client, moderator_token, monkeypatch
+):
+    monkeypatch.setattr(settings, "JOBS_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings, "JOBS_POLL_INTERVAL", 0.05)
+    # values are the same once stripped
+    response = client.post(
+        "/admin/value/replace?background=true",
+        headers=moderator_token,
+        json={"property": "color", "old_value": " red", "new_value": "red "},
+    )
+    assert response.status_code == 422, response.text
+    # a replace by the same value has nothing to process
+    async with db.transaction():
+        params = {"k": "color", "v": "red", "new_v": "red"}
+        assert await jobs._run_batch("value_replace", params, "mod") == 0
+    response = client.post(
+        "/admin/value/replace?background=true",
+        headers=moderator_token,
+        json={"property": "color", "old_value": "red", "new_value": "blue"},
+    )
+    assert response.status_code == 202, response.text
+    assert wait_job(client, moderator_token, response.json()["id"])["status"] == "done"
+    await check_tag(BARCODE_3, "color", v="blue", version=4, editor="mod")
+    # size exists on BARCODE_1 and BARCODE_2: it wins over renamed color
+    response = client.post(
+        "/admin/property/rename?background=true",
+        headers=moderator_token,
+        json={"old_property": "color", "new_property": "size"},
+    )
+    assert response.status_code == 202, response.text
+    job = wait_job(client, moderator_token, response.json()["id"])
+    assert job["status"] == "done"
+    assert job["processed"] == 3
+    response = client.get("/products?k=size")
+    assert sorted((d["product"], d["v"]) for d in response.json()) == [
+        (BARCODE_1, "medium"),
+        (BARCODE_2, "small"),
+        (BARCODE_3, "blue"),
+    ]
+    assert client.get("/products?k=color").json() == []
+
+
+async def _insert_paused_job():
+    async with db.transaction():
+        cur, _ = await db.db_exec(
+            """
+            INSERT INTO folksonomy_jobs (kind, params, status, editor, total)
+            VALUES ('value_delete', '{"k": "color", "v": "red"}', 'paused', 'mod', 2)
+            RETURNING id
+            """
+        )
+        return (await cur.fetchone())[0]
+
+
+@pytest.mark.asyncio
+async def test_jobs_status_changes(with_sample, client, moderator_token, auth_tokens):
+    job_id = await _insert_paused_job()
+    # a paused job does not run
+    await jobs.run_job(job_id, "value_delete", {"k": "color", "v": "red"}, "mod")
+    assert len(client.get("/products?k=color&v=red").json()) == 2
+    response = client.post(f"/admin/jobs/{job_id}/pause", headers=moderator_token)
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Only pending or running jobs can be paused"
+    response = client.post(f"/admin/jobs/{job_id}/cancel", headers=moderator_token)
+    assert response.status_code == 200
+    assert response.json()["status"] == "cancelled"
+    response = client.post(f"/admin/jobs/{job_id}/resume", headers=moderator_token)
+    assert response.status_code == 409
+    response = client.post(f"/admin/jobs/{job_id + 1}/cancel", headers=moderator_token)
+    assert response.status_code == 404
+    # only moderators
+    response = client.get(
+        f"/admin/jobs/{job_id}", headers={"Authorization": "Bearer foo__Utest-token"}
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_check_property_clash(with_sample, client, moderator_token):
+    clash = {"old_property": "color", "new_property": "size"}
+    response = client.post(
+        "/admin/property/check-clash", headers=moderator_token, json=clash
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {
+        "products_with_both": 2,
+        "products_with_old_only": 1,
+        "products_with_new_only": 0,
+        "conflicting_products": [
+            {"product": BARCODE_1, "old_value": "red", "new_value": "medium"},
+            {"product": BARCODE_2, "old_value": "green", "new_value": "small"},
+        ],
+        "next_after": None,
+    }
+    # paginated
+    response = client.post(
+        "/admin/property/check-clash?limit=1", headers=moderator_token, json=clash
+    )
+    data = response.json()
+    assert [d["product"] for d in data["conflicting_products"]] == [BARCODE_1]
+    assert data["next_after"] == BARCODE_1
+    response = client.post(
+        f"/admin/property/check-clash?limit=1&after={BARCODE_1}",
+        headers=moderator_token,
+        json=clash,
+    )
+    data = response.json()
+    assert [d["product"] for d in data["conflicting_products"]] == [BARCODE_2]
+    assert data["next_after"] is None
+    assert data["products_with_both"] == 2
+    response = client.post(
+        "/admin/property/check-clash",
+        headers=moderator_token,
+        json={"old_property": "missing", "new_property": "size"},
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_check_property_clashes(with_sample, client, moderator_token):
+    response = client.post(
+        "/admin/property/check-clashes",
+        headers=moderator_token,
+        json={
+            "renames": [
+                {"old_property": "size", "new_property": "color"},
+                {"old_property": "missing", "new_property": "other"},
+                {"old_property": "color", "new_property": "new"},
+            ]
+        },
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == [
+        {
+            "old_property": "size",
+            "new_property": "color",
+            "products_with_both": 2,
+            "products_with_old_only": 0,
+            "products_with_new_only": 1,
+        },
+        {
+            "old_property": "missing",
+            "new_property": "other",
+            "products_with_both": 0,
+            "products_with_old_only": 0,
+            "products_with_new_only": 0,
+        },
+        {
+            "old_property": "color",
+            "new_property": "new",
+            "products_with_both": 0,
+            "products_with_old_only": 3,
+            "products_with_new_only": 0,
+        },
+    ]
+
+
+@pytest.mark.asyncio
+async def test_bulk_update_versions(with_sample, client, moderator_token):
+    response = client.post(
+        "/admin/value/replace",
+        headers=moderator_token,
+        json={"property": "color", "old_value": "red", "new_value": "blue"},
+    )
+    assert response.json()["renamed_products"] == 2
+    # each row of the statement is archived
+    for product, version in ((BARCODE_1, 2), (BARCODE_3, 4)):
+        versions = client.get(f"/product/{product}/color/versions").json()
+        assert versions[0]["version"] == version
+        assert versions[0]["v"] == "blue"
+        assert versions[0]["editor"] == "mod"
+        assert versions[0]["last_edit"] is not None